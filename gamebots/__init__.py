@@ -1,3 +1,13 @@
 import logging
 from .bot import *
-
+from .device import Device, DeviceError, AdbError, DeviceTimeout
+from .buffers import BufferPool
+from .tm import TM
+from .digits import DigitReader
+from .drops import DropCounter
+from .engine import Engine, Task
+from .screens import ScreenClassifier
+from .cards import CardReader, Cards, pick_cards
+from .skills import SkillReader, Skills
+from .assist import MailboxTask, GachaTask, RewardTask
+from .supervisor import Supervisor
@@ -0,0 +1,70 @@
+"""
+Background archiving of screen frames.
+"""
+
+import logging
+import queue
+import threading
+import zipfile
+from pathlib import Path
+from time import strftime
+
+import cv2 as cv
+import numpy as np
+
+logger = logging.getLogger('archive')
+
+
+class FrameArchive:
+    """
+    A zip archive of JPEG-encoded frames, written by a background thread.
+    """
+
+    def __init__(self, path: str, quality: int = 85):
+        """
+
+        :param path: the path to the zip file. Frames are appended if it exists.
+        :param quality: the JPEG quality, in [0, 100].
+        """
+        self.path = Path(path).absolute()
+        self.quality = quality
+
+        # the number of frames written
+        self.count = 0
+
+        self.__queue = queue.Queue()
+        self.__thread = threading.Thread(target=self.__work, daemon=True)
+        self.__thread.start()
+
+    def add(self, frame: np.ndarray, name: str = ''):
+        """
+        Queue a frame to be written. Never blocks.
+
+        :param frame: the frame. A copy is not made, so it must not be modified afterwards.
+        :param name: the name of the frame in the archive. If not given, use the current time.
+        """
+        name = name or strftime('%Y%m%d-%H%M%S')
+        self.__queue.put((frame, name))
+
+    def close(self):
+        """
+        Write the queued frames and close the archive.
+        """
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __work(self):
+        with zipfile.ZipFile(str(self.path), 'a', compression=zipfile.ZIP_STORED) as zf:
+            while True:
+                item = self.__queue.get()
+                if item is None:
+                    break
+                frame, name = item
+                ok, buf = cv.imencode('.jpg', frame, [cv.IMWRITE_JPEG_QUALITY, self.quality])
+                if not ok:
+                    logger.error('Failed to encode frame {}.'.format(name))
+                    continue
+                zf.writestr('{}.jpg'.format(name), buf.tobytes())
+                self.count += 1
+                logger.debug('Archived frame {}.'.format(name))
+        logger.info('{} frames archived to {}.'.format(self.count, self.path))
@@ -0,0 +1,338 @@
+"""
+Assist tasks: mailbox sorting, summoning and reward-box drawing.
+"""
+
+import logging
+from pathlib import Path
+from time import sleep, time
+from typing import List
+
+from .archive import FrameArchive
+from .device import TapWorker
+from .engine import Engine, Task, INTERVAL_SHORT, INTERVAL_MID
+from .tm import frame_diff
+
+logger = logging.getLogger('assist')
+
+
+class MailboxTask(Task):
+    """
+    Receive the wanted items from the mailbox.
+    """
+
+    name = 'mailbox'
+
+    # the seconds between two queued taps in batch mode
+    tap_interval = 0.3
+
+    # the mean difference below which the list is considered unchanged after a swipe
+    end_diff = 2.0
+
+    # the max number of frames handled in batch mode
+    max_rounds = 9999
+    # the max number of times in a row the same rows are found again after tapping them in batch mode
+    max_stalls = 3
+
+    def __init__(self, engine: Engine, n_iter: int, threshold: float = 0.98):
+        """
+
+        :param engine: the engine to run on.
+        :param n_iter: the number of swipes without any wanted item before stopping.
+        :param threshold: the matching threshold of the items.
+        """
+        super().__init__(engine)
+        self.n_iter = n_iter
+        self.threshold = threshold
+
+    def __find_exp(self, length):
+        for eid in range(length):
+            im = 'e_{}'.format(eid)
+            if self.engine.exists(im, threshold=self.threshold):
+                return im
+
+    def run(self, expstr: List[str] = None, batch: bool = False) -> int:
+        """
+        Sort the mailbox.
+
+        :param expstr: paths to the images of the wanted items.
+        :param batch: if set True, use the batch mode (see `run_batch`).
+        :return: 0 if successful, -1 if no item is given.
+        """
+        if expstr is None:
+            expstr = ["exp_1.png"]
+        if len(expstr) >= 1:
+            explength = len(expstr)
+            for eid in range(explength):
+                path = Path(expstr[eid]).absolute()
+                self.tm.load_image(path, name='e_{}'.format(eid))
+        else:
+            return -1
+        self.engine.wait_until('close1')
+        if batch:
+            return self.run_batch(['e_{}'.format(eid) for eid in range(explength)])
+        start = time()
+        counter = 0
+        for _ in range(9999):
+            exp = self.__find_exp(explength)
+            if not exp:
+                self.device.swipe((640, 650), (640, 250))
+                counter += 1
+                logger.info("Counter: {} .".format(counter))
+                self.checkpoint(counter)
+                self.engine.wait(0.2)
+            else:
+                self.engine.find_and_tap(exp, threshold=self.threshold)
+                self.engine.wait(INTERVAL_SHORT)
+            if counter >= self.n_iter:
+                end = time()
+                logger.info("Time: {} sec.".format(end - start))
+                return 0
+
+    def run_batch(self, ims: List[str]) -> int:
+        """
+        Sort the mailbox, recognizing all the visible rows in one frame.
+
+        Every row of the list holding a wanted item is tapped before the screen is captured again.
+        The rows are tapped from bottom to top, so that receiving an item never shifts the rows still queued.
+        As in the normal mode, the sorting stops after `n_iter` swipes, and each swipe is a checkpoint. It stops
+        earlier at the end of the list, detected when a swipe no longer changes the list.
+        If the tapped rows are still there after `max_stalls` rounds, e.g. when the inventory is full or a dialog
+        is in the way, the sorting stops.
+
+        :param ims: the names of the images of the wanted items.
+        :return: 0 if successful, -1 if stopped because the tapped rows stayed.
+        """
+        roi = self.engine.button('mailbox')
+        row_height = self.engine.buttons['mailbox_row_height']
+        start = time()
+        received = 0
+        swipes = 0
+        stalls = 0
+        prev_hits = []
+        for _ in range(self.max_rounds):
+            hits = [(im, loc) for im, loc in self.tm.find_rows(ims, roi, row_height, self.threshold) if im]
+            stalls = stalls + 1 if hits and hits == prev_hits else 0
+            prev_hits = hits
+            if stalls >= self.max_stalls:
+                logger.warning("The same {} rows are still there after {} rounds. Stop.".format(len(hits), stalls))
+                return -1
+            if hits:
+                for im, (x, y) in reversed(hits):
+                    w, h = self.tm.getsize(im)
+                    self.device.tap_rand(x, y, w, h)
+                    sleep(self.tap_interval)
+                received += len(hits)
+                logger.info("Received {} items, {} in total.".format(len(hits), received))
+                self.engine.wait(INTERVAL_SHORT)
+                continue
+
+            before = self.tm.crop(roi)
+            self.device.swipe((640, 650), (640, 250))
+            swipes += 1
+            self.checkpoint(swipes)
+            if swipes >= self.n_iter:
+                break
+            self.engine.wait(0.5)
+            if frame_diff(before, self.tm.crop(roi)) < self.end_diff:
+                break
+        else:
+            logger.warning("Stopped after {} rounds.".format(self.max_rounds))
+
+        end = time()
+        logger.info("{} items received, {} swipes. Time: {} sec.".format(received, swipes, end - start))
+        return 0
+
+
+class GachaTask(Task):
+    """
+    Draw cards in the summon screen.
+    """
+
+    name = 'gacha'
+
+    # the seconds between two captures in pipelined mode
+    poll_interval = 0.2
+
+    def __init__(self, engine: Engine, n_iter: int, threshold: float = 0.98):
+        """
+
+        :param engine: the engine to run on.
+        :param n_iter: the number of summons.
+        :param threshold: the matching threshold of the buttons.
+        """
+        super().__init__(engine)
+        self.n_iter = n_iter
+        self.threshold = threshold
+
+    def run(self, pipelined: bool = False, archive: str = None):
+        """
+        Summon `n_iter` times.
+
+        :param pipelined: if set True, use the pipelined mode (see `run_pipelined`).
+        :param archive: path to a zip file to save the result frames to, in pipelined mode.
+        """
+        if pipelined:
+            return self.run_pipelined(archive)
+        start = time()
+        i = 0
+        for i in range(self.n_iter):
+            self.engine.wait_until('draw10cards')
+            self.engine.find_and_tap('draw10cards', self.threshold)
+            self.engine.wait(INTERVAL_SHORT)
+            if self.engine.find_and_tap('decide1', self.threshold):
+                self.engine.wait(INTERVAL_SHORT * 3)
+                self.device.tap_rand(20, 700, 10, 10)
+                logger.info("{}-th draw".format(i + 1))
+                self.engine.wait(INTERVAL_SHORT * 2)
+                self.device.tap_rand(20, 700, 10, 10)
+                self.checkpoint(i + 1)
+            else:
+                break
+        end = time()
+        logger.info("{}-th draw. Time: {} sec.".format(i + 1, end - start))
+
+    def run_pipelined(self, archive: str = None):
+        """
+        Summon `n_iter` times, moving on as soon as the screen changes instead of sleeping.
+
+        The summon animation is skipped as soon as it starts, and the result is dismissed as soon as the
+        result screen stops changing. The rate of summons is reported after each one.
+
+        :param archive: path to a zip file to save the result frames to. Frames are written in the background.
+        """
+        frames = FrameArchive(archive) if archive else None
+        skip = (20, 700, 10, 10)
+        start = time()
+        i = 0
+        try:
+            for i in range(self.n_iter):
+                self.engine.wait_until('draw10cards', self.threshold, interval=self.poll_interval)
+                self.engine.find_and_tap('draw10cards', self.threshold)
+                # the dialog fades in, so wait until it can be matched
+                if not self.engine.wait_until('decide1', self.threshold, interval=self.poll_interval,
+                                              timeout=INTERVAL_MID):
+                    logger.warning('The summon dialog did not show up. Stop.')
+                    break
+                self.engine.find_and_tap('decide1', self.threshold)
+
+                # skip the animation as soon as it starts
+                if not self.engine.wait_change(interval=self.poll_interval):
+                    logger.warning('The summon did not start. Stop.')
+                    break
+                self.device.tap_rand(*skip)
+
+                # the result is shown when the cards stop moving
+                if not self.engine.wait_stable(interval=self.poll_interval):
+                    logger.warning('The result screen did not stop changing in {} seconds.'.format(INTERVAL_MID))
+                if frames is not None:
+                    frames.add(self.tm.screen.copy(), 'summon_{:05d}'.format(i + 1))
+                self.device.tap_rand(*skip)
+
+                minutes = (time() - start) / 60
+                logger.info("{}-th draw. {:.2f} draws per minute.".format(i + 1, (i + 1) / minutes))
+                self.checkpoint(i + 1)
+        finally:
+            if frames is not None:
+                frames.close()
+        end = time()
+        logger.info("{}-th draw. Time: {} sec.".format(i + 1, end - start))
+
+
+class RewardTask(Task):
+    """
+    Draw the event reward boxes.
+    """
+
+    name = 'reward'
+
+    # the seconds between two captures in streaming mode
+    poll_interval = 0.2
+
+    # the matching threshold of the reset dialogs while waiting for them. It is stricter than the one of the
+    # manifest used to tap them, so that they are only tapped once they have faded in.
+    dialog_threshold = 0.97
+
+    def __init__(self, engine: Engine, n_iter: int, threshold: float = 0.98):
+        """
+
+        :param engine: the engine to run on.
+        :param n_iter: the number of boxes to draw.
+        :param threshold: the matching threshold of the empty box.
+        """
+        super().__init__(engine)
+        self.n_iter = n_iter
+        self.threshold = threshold
+
+    def run(self, stream: bool = False, rate: float = 5.0, burst: int = 1):
+        """
+        Draw `n_iter` boxes.
+
+        :param stream: if set True, use the streaming mode (see `run_stream`).
+        :param rate: the number of taps per second in streaming mode.
+        :param burst: the number of taps sent with a single adb command in streaming mode.
+        """
+        if stream:
+            return self.run_stream(rate, burst)
+        i = 0
+        self.engine.wait_until('menu')
+        start = time()
+        while i < self.n_iter:
+            if self.engine.exists('0_300', self.threshold):
+                end = time()
+                logger.info("{}-th pool. Time: {} sec.".format(i + 1, end - start))
+                i += 1
+                self.engine.find_and_tap('reset')
+                self.engine.wait_until('confirm', self.dialog_threshold)
+                self.engine.find_and_tap('confirm')
+                self.engine.wait_until('close', self.dialog_threshold)
+                self.engine.find_and_tap('close')
+                self.checkpoint(i)
+                start = time()
+                continue
+            self.engine.wait(INTERVAL_SHORT)
+            self.device.tap_rand(330, 445, 10, 10)
+
+    def run_stream(self, rate: float = 5.0, burst: int = 1):
+        """
+        Draw `n_iter` boxes, streaming the draw taps from a background worker.
+
+        The worker keeps tapping the draw button at `rate` taps per second, while the main loop only captures
+        the screen and looks for the empty box and the reset dialogs in their own regions. The reset button is
+        searched on the whole screen, as its place differs between events.
+        The worker is paused while the box is being reset.
+
+        :param rate: the number of taps per second.
+        :param burst: the number of taps sent with a single adb command.
+        """
+        box_roi = self.engine.button('reward_box')
+        dialog_roi = self.engine.button('reward_dialog')
+        worker = TapWorker(self.device, *self.engine.button('reward_draw'), rate=rate, burst=burst)
+
+        i = 0
+        self.engine.wait_until('menu')
+        start = time()
+        worker.start()
+        worker.resume()
+        try:
+            while i < self.n_iter:
+                self.engine.wait(self.poll_interval)
+                if not self.engine.exists('0_300', self.threshold, roi=box_roi):
+                    continue
+
+                worker.pause()
+                end = time()
+                logger.info("{}-th pool. Time: {} sec. {} taps sent.".format(i + 1, end - start, worker.count))
+                i += 1
+                if not self.engine.find_and_tap('reset'):
+                    logger.warning('The reset button is not on the screen. Stop.')
+                    break
+                self.engine.wait_until('confirm', self.dialog_threshold, roi=dialog_roi, interval=self.poll_interval)
+                self.engine.find_and_tap('confirm', roi=dialog_roi)
+                self.engine.wait_until('close', self.dialog_threshold, roi=dialog_roi, interval=self.poll_interval)
+                self.engine.find_and_tap('close', roi=dialog_roi)
+                self.checkpoint(i)
+                start = time()
+                if i < self.n_iter:
+                    worker.resume()
+        finally:
+            worker.stop()
@@ -1,35 +1,78 @@
-import json
 import logging
-from functools import partial
+from contextlib import contextmanager
 from pathlib import Path
-from random import randint
 from time import sleep, time
-from typing import Callable
-from typing import List, Union
+from typing import Callable, TYPE_CHECKING
+from typing import List, Tuple, Union
 
-from .device import Device
-from .tm import TM
+from .assist import MailboxTask, GachaTask, RewardTask
+from .cards import CardReader, Cards
+from .drops import DropCounter
+from .device import DeviceError
+from .engine import Engine, Task, get_engine, INTERVAL_SHORT, INTERVAL_MID, INTERVAL_LONG
+from .screens import signature, distance, STABLE_DISTANCE
+from .skills import SkillReader, Skills
+
+if TYPE_CHECKING:
+    # for the annotation only, so that `python -m gamebots.telemetry` does not import itself twice
+    from .telemetry import Telemetry
 
 logger = logging.getLogger('bot')
 
-INTERVAL_SHORT = 1
-INTERVAL_MID = 10
-INTERVAL_LONG = 25
+# states of the battle loop
+ENTER = 'enter'
+REENTER = 'reenter'
+FRIEND = 'friend'
+BATTLE = 'battle'
+END = 'end'
+
+# the seconds it takes to regenerate 1 AP
+AP_REGEN = 300
 
 
-class BattleBot:
+class BattleBot(Task):
     """
     A class of the bot that automatically plays.
     """
 
+    name = 'battle'
+
+    # the seconds between two captures on the result screens in fast mode
+    poll_interval = 0.2
+
     def __init__(self,
                  quest: str = 'quest.png',
                  friend: Union[str, List[str]] = 'friend.png',
                  stage_count: int = 3,
                  ap: List[str] = None,
                  mode: int = 0,
-                 threshold: float = 0.97
+                 threshold: float = 0.97,
+                 engine: Engine = None,
+                 fast_end: bool = False,
+                 drops: DropCounter = None,
+                 telemetry: 'Telemetry' = None,
+                 ap_cost: int = 0,
+                 wait_ap: bool = False
                  ):
+        """
+
+        :param quest: path to the image of the target quest.
+        :param friend: path(s) to the image(s) of the expected friend servants.
+        :param stage_count: the number of stages of the quest.
+        :param ap: the AP items to use when AP is insufficient, in order.
+        :param mode: the template image set to use. Ignored if `engine` is given.
+        :param threshold: the matching threshold of the quest and friend images.
+        :param engine: the engine to run on. If not given, a new one is created, or the shared one is used
+            (see `share_engines`).
+        :param fast_end: if set True, handle each result screen as soon as it stops changing (see `end_battle`).
+        :param drops: the counter to hand the drop screens to. If not given, drops are not counted.
+        :param telemetry: the store to record the battles to. If not given, they are only logged.
+        :param ap_cost: the AP cost of the quest, needed by `wait_ap`.
+        :param wait_ap: if set True, sleep until enough AP is regenerated when AP is insufficient and no AP item
+            can be used, instead of quitting. The AP is read with the digit reader of the engine, which needs the
+            glyph masks (see `calibrate`); without them, the bot sleeps for the full cost of the quest.
+        """
+        super().__init__(engine or get_engine(mode=mode))
 
         # A dict of the handler functions that are called repeatedly at each stage.
         # Use `at_stage` to register functions.
@@ -41,16 +84,11 @@ class BattleBot:
         self.stage_count = stage_count
         logger.info('Stage count set to {}.'.format(self.stage_count))
 
-        # Device
-        self.device = Device()
-
-        self.mode = mode
-
-        # Template matcher
-        self.tm = TM(feed=partial(self.device.capture, method=Device.FROM_SHELL), mode=self.mode)
+        self.mode = self.engine.mode
 
         # Target quest
         path = Path(quest).absolute()
+        self.quest = path.name
         self.tm.load_image(path, name='quest')
 
         if isinstance(friend, str):
@@ -67,99 +105,90 @@ class BattleBot:
         # AP strategy
         self.ap = ap
         logger.info('AP strategy is {}.'.format(self.ap))
+        self.ap_cost = ap_cost
+        self.wait_ap = wait_ap
+        assert not wait_ap or ap_cost > 0, 'The AP cost of the quest is needed to wait for AP.'
+        if wait_ap and not self.engine.digits.ready:
+            logger.warning('No glyph mask for {}, AP cannot be read. Waiting for AP sleeps for the full cost of the '
+                           'quest.'.format(' '.join(self.engine.digits.missing)))
 
         self.threshold = threshold
 
-        # Load button coords from config
-        btn_path = Path(__file__).absolute().parent / 'config' / 'buttons.json'
-        with open(btn_path) as f:
-            self.buttons = json.load(f)
-
-        logger.debug('Bot initialized.')
-
-    def __button(self, btn):
-        """
-        Return the __button coords and size.
+        self.fast_end = fast_end
 
-        :param btn: the name of __button
-        :return: (x, y, w, h)
-        """
-        btn = self.buttons[btn]
-        return btn['x'], btn['y'], btn['w'], btn['h']
+        self.drops = drops
 
-    def __swipe(self, track):
-        """
-        Swipe in given track.
+        self.telemetry = telemetry
 
-        :param track:
-        :return:
-        """
-        x1, y1, x2, y2 = map(lambda x: x + randint(-5, 5), self.buttons['swipe'][track])
-        self.device.swipe((x1, y1), (x2, y2))
+        self.buttons = self.engine.buttons
 
-    def __find_and_tap(self, im: str, threshold: float = None) -> bool:
-        """
-        Find the given image on screen and tap.
+        # the reader of the command cards, see `read_cards`
+        self.cards = CardReader(self.buttons)
+        # the reader of the skill availability, see `read_skills`
+        self.skills = SkillReader(self.buttons)
 
-        :param im: the name of image
-        :param threshold: the matching threshold
-        :return: whether successful
-        """
-        x, y = self.tm.find(im, threshold=threshold)
-        if (x, y) == (-1, -1):
-            logger.warning('Failed to find image {} on screen.'.format(im))
-            return False
-        w, h = self.tm.getsize(im)
-        return self.device.tap_rand(x, y, w, h)
+        # the number of battles played and the start time of the run
+        self.count = 0
+        self.start_time = time()
 
-    def __exists(self, im: str, threshold: float = None) -> bool:
-        """
-        Check if a given image exists on screen.
+        logger.debug('Bot initialized.')
 
-        :param im: the name of the image
-        :param threshold: threshold of matching
+    def __add_stage_handler(self, stage: int, f: Callable):
         """
-        return self.tm.exists(im, threshold=threshold)
+        Register a handler function to a given stage of the battle.
 
-    def __wait(self, sec):
+        :param stage: the stage number
+        :param f: the handler function
         """
-        Wait some seconds and update the screen feed.
+        assert not self.stage_handlers.get(stage), 'Cannot register multiple function to a single stage.'
+        logger.debug('Function {} registered to stage {}'.format(f.__name__, stage))
+        self.stage_handlers[stage] = f
 
-        :param sec: the seconds to wait
+    @contextmanager
+    def __phase(self, name: str):
         """
-        logger.debug('Sleep {} seconds.'.format(sec))
-        sleep(sec)
-        self.tm.update_screen()
+        Time a phase of the battle and record it to the telemetry, if any.
 
-    def __wait_until(self, im: str):
+        :param name: the name of the phase, see `telemetry.PHASES`.
         """
-        Wait until the given image appears. Useful when try to use skills, etc.
-        """
-        logger.debug("Wait until image '{}' appears.".format(im))
-        self.tm.update_screen()
-        while not self.__exists(im):
-            self.__wait(INTERVAL_SHORT)
-            if self.__exists('reconnect'):
-                self.__find_and_tap('reconnect')
+        start = time()
+        try:
+            yield
+        finally:
+            if self.telemetry is not None:
+                self.telemetry.add_phase(name, time() - start)
 
-    def __add_stage_handler(self, stage: int, f: Callable):
+    def __read_stage(self) -> int:
         """
-        Register a handler function to a given stage of the battle.
+        Read the wave counter of the current screen with the digit reader.
 
-        :param stage: the stage number
-        :param f: the handler function
+        :return: current stage. Return -1 if the counter cannot be read, e.g. when the glyph masks are missing.
         """
-        assert not self.stage_handlers.get(stage), 'Cannot register multiple function to a single stage.'
-        logger.debug('Function {} registered to stage {}'.format(f.__name__, stage))
-        self.stage_handlers[stage] = f
+        stage, total = self.engine.digits.read_fraction(self.tm.screen, self.engine.button('wave'))
+        if stage == -1:
+            return -1
+        if total != self.stage_count:
+            logger.warning('Read stage count {}, expected {}.'.format(total, self.stage_count))
+        if not 1 <= stage <= self.stage_count:
+            logger.warning('Read stage {} out of range.'.format(stage))
+            return -1
+        return stage
 
     def __get_current_stage(self) -> int:
         """
         Get the current stage in battle.
 
+        The wave counter is read by the digit reader. If it cannot be read, fall back to the
+        '{stage}_{stage_count}' template images.
+
         :return: current stage. Return -1 if error occurs.
         """
-        self.__wait_until('attack')
+        self.engine.wait_until('attack')
+        stage = self.__read_stage()
+        if stage != -1:
+            logger.debug('Got current stage: {}'.format(stage))
+            return stage
+
         max_prob, max_stage = 0.8, -1
         for stage in range(1, self.stage_count + 1):
             im = '{}_{}'.format(stage, self.stage_count)
@@ -175,16 +204,100 @@ class BattleBot:
         return max_stage
 
     def __find_friend(self) -> str:
-        self.__wait_until('refresh_friends')
+        self.engine.wait_until('refresh_friends')
         for _ in range(6):
-            self.__wait(INTERVAL_SHORT)
+            self.engine.wait(INTERVAL_SHORT)
             for fid in range(self.friend_count):
                 im = 'f_{}'.format(fid)
-                if self.__exists(im, threshold=self.threshold):
+                if self.engine.exists(im, threshold=self.threshold):
                     return im
-            self.__swipe('friend')
+            self.engine.swipe('friend')
         return ''
 
+    def __restore_ap(self) -> bool:
+        """
+        Use AP items if AP is insufficient.
+
+        :return: whether there is enough AP to enter the battle.
+        """
+        if not self.engine.exists('ap_regen'):
+            return True
+
+        logger.debug('Insufficient AP')
+        if not self.ap:
+            return False
+        self.engine.wait(INTERVAL_SHORT)
+        for ap_item in self.ap:
+            if ap_item == "apple_bronze":
+                self.device.swipe((640, 400), (640, 250))
+                self.engine.wait(INTERVAL_SHORT)
+            if self.engine.find_and_tap(ap_item):
+                self.engine.wait(INTERVAL_SHORT)
+                if self.engine.find_and_tap('decide'):
+                    logger.info(ap_item + " used")
+                    if self.telemetry is not None:
+                        self.telemetry.use_ap(ap_item)
+                    self.engine.wait_until('refresh_friends')
+                    return True
+        return False
+
+    def read_ap(self) -> Tuple[int, int]:
+        """
+        Read the current and max AP on the menu screen.
+
+        :return: the current and max AP. Return (-1, -1) if failed.
+        """
+        self.tm.update_screen()
+        ap, max_ap = self.engine.digits.read_fraction(self.tm.screen, self.engine.button('ap'))
+        logger.debug('AP: {}/{}'.format(ap, max_ap))
+        return ap, max_ap
+
+    def __wait_ap(self, at_least: int = 0) -> bool:
+        """
+        Sleep until enough AP is regenerated for the quest, as predicted from the AP read on the menu screen.
+        If the AP cannot be read, e.g. when the digit reader has no glyph masks, sleep for the full cost of the
+        quest. The device is not polled while sleeping.
+
+        :param at_least: the min number of AP to wait for, e.g. when the game refused to enter the quest.
+        :return: whether the quest can be entered afterwards.
+        """
+        self.engine.wait_until('menu')
+        ap, max_ap = self.read_ap()
+        if ap == -1:
+            logger.warning('Failed to read AP. Wait for the full cost of the quest.')
+            missing = self.ap_cost
+        elif max_ap < self.ap_cost:
+            logger.error('Max AP {} is below the cost of the quest {}.'.format(max_ap, self.ap_cost))
+            return False
+        else:
+            missing = self.ap_cost - ap
+        missing = max(missing, at_least)
+        if missing <= 0:
+            return True
+
+        # the next point may regenerate at any time in the current period, so wait for full periods
+        secs = missing * AP_REGEN
+        logger.info('AP {}/{}, {} AP missing. Sleep {} minutes.'.format(ap, max_ap, missing, secs // 60))
+        sleep(secs)
+        return True
+
+    def __choose_friend(self):
+        """
+        Look for a friend servant, refreshing the list until one is found, and choose it.
+        """
+        deadline = self.engine.deadline()
+        friend = self.__find_friend()
+        while not friend:
+            self.engine.check_deadline(deadline, 'Finding a friend servant')
+            if self.telemetry is not None:
+                self.telemetry.refresh_friends()
+            self.engine.find_and_tap('refresh_friends')
+            self.engine.wait(INTERVAL_SHORT)
+            self.engine.find_and_tap('yes')
+            self.engine.wait(INTERVAL_SHORT)
+            friend = self.__find_friend()
+        self.engine.find_and_tap(friend, threshold=self.threshold)
+
     def __enter_battle(self) -> bool:
         """
         Enter the battle.
@@ -192,45 +305,23 @@ class BattleBot:
         :return: whether successful.
         """
         logger.info('Trying to enter the battle')
-        self.__wait_until('menu')
-        while not self.__find_and_tap('quest', threshold=self.threshold):
-            self.__swipe('quest')
-            self.__wait(INTERVAL_SHORT)
-        self.__wait(INTERVAL_SHORT)
-
-        # no enough AP
-        if self.__exists('ap_regen'):
-            if not self.ap:
+        with self.__phase('enter'):
+            self.engine.wait_until('menu')
+            deadline = self.engine.deadline()
+            while not self.engine.find_and_tap('quest', threshold=self.threshold):
+                self.engine.check_deadline(deadline, 'Finding the quest')
+                self.engine.swipe('quest')
+                self.engine.wait(INTERVAL_SHORT)
+            self.engine.wait(INTERVAL_SHORT)
+
+            if not self.__restore_ap():
                 return False
-            else:
-                ok = False
-                self.__wait(INTERVAL_SHORT)
-                for ap_item in self.ap:
-                    if ap_item == "apple_bronze":
-                        self.device.swipe((640, 400), (640, 250))
-                        self.__wait(INTERVAL_SHORT)
-                    if self.__find_and_tap(ap_item):
-                        self.__wait(INTERVAL_SHORT)
-                        if self.__find_and_tap('decide'):
-                            logger.info(ap_item + " used")
-                            self.__wait_until('refresh_friends')
-                            ok = True
-                            break
-                if not ok:
-                    return False
 
-        # look for friend servant
-        friend = self.__find_friend()
-        while not friend:
-            self.__find_and_tap('refresh_friends')
-            self.__wait(INTERVAL_SHORT)
-            self.__find_and_tap('yes')
-            self.__wait(INTERVAL_SHORT)
-            friend = self.__find_friend()
-        self.__find_and_tap(friend, threshold=self.threshold)
-        self.__wait_until('start_quest')
-        self.__find_and_tap('start_quest')
-        self.__wait(INTERVAL_MID)
+        with self.__phase('friend'):
+            self.__choose_friend()
+            self.engine.wait_until('start_quest')
+            self.engine.find_and_tap('start_quest')
+            self.engine.wait(INTERVAL_MID)
         return True
 
     def __reenter_battle(self) -> bool:
@@ -240,79 +331,151 @@ class BattleBot:
         :return: whether successful.
         """
         logger.info('Trying to re-enter the battle')
-        while not self.__find_and_tap('cont'):
-            self.__wait(INTERVAL_SHORT)
-        self.__wait(INTERVAL_SHORT)
-
-        # no enough AP
-        if self.__exists('ap_regen'):
-            logger.debug('Insufficient AP')
-            if not self.ap:
+        with self.__phase('enter'):
+            self.tm.update_screen()
+            deadline = self.engine.deadline()
+            while not self.engine.find_and_confirm('cont'):
+                self.engine.check_deadline(deadline, 'Continuing the quest')
+                self.engine.wait(INTERVAL_SHORT)
+            self.engine.wait_stable(timeout=INTERVAL_SHORT * 2)
+
+            if not self.__restore_ap():
                 return False
-            else:
-                ok = False
-                self.__wait(INTERVAL_SHORT)
-                for ap_item in self.ap:
-                    if ap_item == "apple_bronze":
-                        self.device.swipe((640, 400), (640, 250))
-                        self.__wait(INTERVAL_SHORT)
-                    if self.__find_and_tap(ap_item):
-                        self.__wait(INTERVAL_SHORT)
-                        if self.__find_and_tap('decide'):
-                            logger.info(ap_item + " used")
-                            self.__wait_until('refresh_friends')
-                            ok = True
-                            break
-                if not ok:
-                    return False
 
-        # look for friend servant
-        friend = self.__find_friend()
-        while not friend:
-            self.__find_and_tap('refresh_friends')
-            self.__wait(INTERVAL_SHORT)
-            self.__find_and_tap('yes')
-            self.__wait(INTERVAL_SHORT)
-            friend = self.__find_friend()
-        self.__find_and_tap(friend, threshold=self.threshold)
-        self.__wait(INTERVAL_MID)
+        with self.__phase('friend'):
+            self.__choose_friend()
+            self.engine.wait(INTERVAL_MID)
         return True
 
-    def play_battle(self) -> int:
+    def play_battle(self, start: int = 1) -> int:
         """
         Play the battle.
 
+        Before each round, the wave counter is read if the digit reader is ready, so that a stage that is not
+        cleared in one round is played again by its handler, the last one included: the battle goes on as long as
+        the attack button shows up again. Otherwise, the stages are assumed to take one round each.
+
+        :param start: the stage to start from.
         :return: count of rounds.
         """
         logger.info('Handling the battle')
-        stage = 0
-        while stage < self.stage_count:
-            stage += 1
-            self.__wait_until('attack')
+        stage = start - 1
+        rounds = 0
+        while stage < self.stage_count or (self.engine.digits.ready and self.engine.exists('attack')):
+            self.engine.wait_until('attack')
+            read = self.__read_stage()
+            stage = read if read >= max(stage, 1) else min(stage + 1, self.stage_count)
+            logger.debug('Playing stage {}'.format(stage))
             self.stage_handlers[stage]()
-            self.__wait(INTERVAL_LONG)
-        return stage
+            rounds += 1
+            self.engine.wait(INTERVAL_LONG)
+        return rounds
 
     def end_battle(self):
-        self.__wait(INTERVAL_SHORT)
+        """
+        Go through the result screens after the battle.
+
+        In fast mode, each result screen is handled as soon as it stops changing, instead of after fixed waits.
+        """
+        if self.fast_end:
+            return self.__end_battle_fast()
+
+        self.engine.wait(INTERVAL_SHORT)
         logger.info('Finishing the battle.')
-        while not self.__exists('next_step'):
+        deadline = self.engine.deadline()
+        while not self.engine.exists('next_step'):
+            self.engine.check_deadline(deadline, 'Reaching the drop screen')
             self.device.tap_rand(640, 360, 50, 50)
-            self.__wait(INTERVAL_SHORT)
-            if self.__exists('reconnect'):
-                self.__find_and_tap('reconnect')
-
-        self.__find_and_tap('next_step')
-        self.__wait(INTERVAL_SHORT * 2)
-        if self.__exists('next_step'):
-            self.__find_and_tap('next_step')
-            self.__wait(INTERVAL_SHORT)
+            self.engine.wait(INTERVAL_SHORT)
+            if self.engine.exists('reconnect'):
+                self.engine.find_and_tap('reconnect')
+
+        if self.drops is not None:
+            self.drops.submit(self.tm.screen)
+        self.engine.find_and_tap('next_step')
+        self.engine.wait(INTERVAL_SHORT * 2)
+        if self.engine.exists('next_step'):
+            self.engine.find_and_tap('next_step')
+            self.engine.wait(INTERVAL_SHORT)
 
         # not send friend application
-        self.__wait(INTERVAL_SHORT * 2)
-        if self.__exists('not_apply'):
-            self.__find_and_tap('not_apply')
-        self.__wait(INTERVAL_SHORT)
+        self.engine.wait(INTERVAL_SHORT * 2)
+        if self.engine.exists('not_apply'):
+            self.engine.find_and_tap('not_apply')
+        self.engine.wait(INTERVAL_SHORT)
+
+    def __end_battle_fast(self):
+        """
+        Go through the result screens, handling each of them as soon as it stops changing.
+
+        A screen is handled as soon as two consecutive frames have the same signature, i.e. its animations are over.
+        The result screens ('bond', 'exp', 'drops', 'friend_request') are recognized from their signatures by the
+        screen classifier of the engine. A screen it does not know is told apart by the 'next_step' and
+        'not_apply' buttons, and learned by the classifier, so that it is recognized in the next battles without
+        matching the buttons.
+        """
+        logger.info('Finishing the battle.')
+        prev = None
+        counted = False
+        deadline = self.engine.deadline()
+        while True:
+            self.engine.check_deadline(deadline, 'Going through the result screens')
+            self.engine.wait(self.poll_interval)
+            if self.engine.exists('reconnect'):
+                self.engine.find_and_tap('reconnect')
+                prev = None
+                continue
+
+            sig = signature(self.tm.screen)
+            stable = prev is not None and distance(prev, sig) < STABLE_DISTANCE
+            prev = sig
+            if not stable:
+                continue
+
+            name, _ = self.engine.screens.classify(self.tm.screen)
+            if not name or not self.__on_result_screen(name):
+                # not the screen it looks like, or an unknown one
+                name = self.__tell_result_screen()
+                if name in ('drops', 'friend_request'):
+                    self.engine.screens.learn(name, self.tm.screen)
+                self.__on_result_screen(name)
+            logger.debug('Result screen: {}'.format(name or 'unknown'))
+            if name == 'drops' and self.drops is not None and not counted:
+                self.drops.submit(self.tm.screen)
+                counted = True
+            if name in ('friend_request', 'done'):
+                break
+            prev = None
+
+    def __tell_result_screen(self) -> str:
+        """
+        Tell the result screen shown by its buttons.
+
+        :return: 'friend_request', 'drops', or 'done' if the result screens are over. Return '' if not any of them.
+        """
+        if self.engine.exists('not_apply'):
+            return 'friend_request'
+        if self.engine.exists('cont') or self.engine.exists('menu'):
+            return 'done'
+        if self.engine.exists('next_step'):
+            return 'drops'
+        return ''
+
+    def __on_result_screen(self, name: str) -> bool:
+        """
+        Handle a result screen.
+
+        :param name: the name of the screen. '' for a screen to tap through, such as the bond and EXP screens.
+        :return: whether the screen is handled. Return False if its button is not found.
+        """
+        if name == 'friend_request':
+            # not send friend application
+            return self.engine.find_and_tap('not_apply')
+        if name == 'drops':
+            return self.engine.find_and_tap('next_step')
+        if name in ('', 'bond', 'exp'):
+            self.device.tap_rand(640, 360, 50, 50)
+        return True
 
     def at_stage(self, stage: int):
         """
@@ -327,34 +490,49 @@ class BattleBot:
 
         return decorator
 
-    def use_skill(self, servant: int, skill: int, obj=None):
+    def read_skills(self) -> Skills:
+        """
+        Read which skills are available on the battle screen, see `SkillReader.read`.
+        The screen is not captured again.
+
+        :return: the availability of the servant skills and, if the master skill menu is open, the master skills.
+        """
+        return self.skills.read(self.tm.screen)
+
+    def use_skill(self, servant: int, skill: int, obj=None, check: bool = False) -> bool:
         """
         Use a skill.
 
         :param servant: the servant id.
         :param skill: the skill id.
         :param obj: the object of skill, if required.
+        :param check: if set True, skip the skill without tapping if it is on cooldown.
+        :return: whether the skill was tapped.
         """
-        self.__wait_until('attack')
+        self.engine.wait_until('attack')
+        if check and not self.read_skills().servant[servant - 1][skill - 1]:
+            logger.info('Skill ({}, {}) is not available.'.format(servant, skill))
+            return False
 
-        x, y, w, h = self.__button('skill')
+        x, y, w, h = self.engine.button('skill')
         x += self.buttons['servant_distance'] * (servant - 1)
         x += self.buttons['skill_distance'] * (skill - 1)
         self.device.tap_rand(x, y, w, h)
         logger.debug('Used skill ({}, {})'.format(servant, skill))
-        self.__wait(INTERVAL_SHORT)
+        self.engine.wait(INTERVAL_SHORT)
 
-        if self.__exists('choose_object'):
+        if self.engine.exists('choose_object'):
             if obj is None:
                 logger.error('Must choose a skill object.')
             else:
-                x, y, w, h = self.__button('choose_object')
+                x, y, w, h = self.engine.button('choose_object')
                 x += self.buttons['choose_object_distance'] * (obj - 1)
                 self.device.tap_rand(x, y, w, h)
                 logger.debug('Chose skill object {}.'.format(obj))
-        self.__wait(INTERVAL_SHORT)
+        self.engine.wait(INTERVAL_SHORT)
+        return True
 
-    def use_master_skill(self, skill: int, obj=None, obj2=None):
+    def use_master_skill(self, skill: int, obj=None, obj2=None, check: bool = False) -> bool:
         """
         Use a master skill.
         Param `obj` is needed if the skill requires a object.
@@ -363,34 +541,41 @@ class BattleBot:
         :param skill: the skill id.
         :param obj: the object of skill, if required.
         :param obj2: the second object of skill, if required.
+        :param check: if set True, close the menu without tapping the skill if it is on cooldown.
+        :return: whether the skill was tapped.
         """
-        self.__wait_until('attack')
+        self.engine.wait_until('attack')
 
-        x, y, w, h = self.__button('master_skill_menu')
+        x, y, w, h = self.engine.button('master_skill_menu')
         self.device.tap_rand(x, y, w, h)
-        self.__wait(INTERVAL_SHORT)
+        self.engine.wait(INTERVAL_SHORT)
+        if check and not self.read_skills().master[skill - 1]:
+            logger.info('Master skill {} is not available.'.format(skill))
+            self.device.tap_rand(x, y, w, h)
+            self.engine.wait(INTERVAL_SHORT)
+            return False
 
-        x, y, w, h = self.__button('master_skill')
+        x, y, w, h = self.engine.button('master_skill')
         x += self.buttons['master_skill_distance'] * (skill - 1)
         self.device.tap_rand(x, y, w, h)
         logger.debug('Used master skill {}'.format(skill))
-        self.__wait(INTERVAL_SHORT)
+        self.engine.wait(INTERVAL_SHORT)
 
-        if self.__exists('choose_object'):
+        if self.engine.exists('choose_object'):
             if obj is None:
                 logger.error('Must choose a master skill object.')
             elif 1 <= obj <= 3:
-                x, y, w, h = self.__button('choose_object')
+                x, y, w, h = self.engine.button('choose_object')
                 x += self.buttons['choose_object_distance'] * (obj - 1)
                 self.device.tap_rand(x, y, w, h)
                 logger.debug('Chose master skill object {}.'.format(obj))
             else:
                 logger.error('Invalid master skill object.')
-        elif self.__exists('order_change'):
+        elif self.engine.exists('order_change'):
             if obj is None or obj2 is None:
                 logger.error('Must choose two objects for Order Change.')
             elif 1 <= obj <= 3 and 4 <= obj2 <= 6:
-                x, y, w, h = self.__button('change')
+                x, y, w, h = self.engine.button('change')
                 x += self.buttons['change_distance'] * (obj - 1)
                 self.device.tap_rand(x, y, w, h)
 
@@ -398,200 +583,197 @@ class BattleBot:
                 self.device.tap_rand(x, y, w, h)
                 logger.debug('Chose master skill object ({}, {}).'.format(obj, obj2))
 
-                self.__find_and_tap('change')
+                self.engine.find_and_tap('change')
                 logger.debug('Order Change')
             else:
                 logger.error('Invalid master skill object.')
 
-        self.__wait(INTERVAL_SHORT)
+        self.engine.wait(INTERVAL_SHORT)
+        return True
+
+    def read_cards(self) -> Cards:
+        """
+        Recognize the cards on the card selection screen, see `CardReader.read`.
+        The screen is not captured again.
 
-    def attack(self, cards: list):
+        :return: the colors and owners of the command cards, and the noble phantasm cards available.
         """
-        Tap attack __button and choose three cards.
+        return self.cards.read(self.tm.screen)
+
+    def attack(self, cards: Union[list, Callable[[Cards], list]]):
+        """
+        Tap attack button and choose three cards.
 
         1 ~ 5 stands for normal cards, 6 ~ 8 stands for noble phantasm cards.
 
-        :param cards: the cards id, as a list
+        :param cards: the cards id, as a list. Or a function that picks them from the cards on the screen
+            (see `read_cards`), e.g. `lambda cards: pick_cards(cards, nps=[1])`.
 
         """
+        self.engine.wait_until('attack')
+        self.engine.find_and_tap('attack')
+        self.engine.wait(INTERVAL_SHORT * 2)
+        if callable(cards):
+            recognized = self.read_cards()
+            cards = cards(recognized)
+            logger.debug('Picked cards {} from {}'.format(cards, recognized))
         assert len(cards) == 3, 'Number of cards must be 3.'
         assert len(set(cards)) == 3, 'Cards must be distinct.'
-        self.__wait_until('attack')
-        self.__find_and_tap('attack')
-        self.__wait(INTERVAL_SHORT * 2)
         for card in cards:
             if 1 <= card <= 5:
-                x, y, w, h = self.__button('card')
+                x, y, w, h = self.engine.button('card')
                 x += self.buttons['card_distance'] * (card - 1)
                 self.device.tap_rand(x, y, w, h)
             elif 6 <= card <= 8:
-                x, y, w, h = self.__button('noble_card')
+                x, y, w, h = self.engine.button('noble_card')
                 x += self.buttons['card_distance'] * (card - 6)
                 self.device.tap_rand(x, y, w, h)
             else:
                 logger.error('Card number must be in range [1, 8]')
         logger.debug('Attack.')
 
-    def run(self, max_loops: int = 999):
+    def locate(self) -> str:
+        """
+        Recognize where the bot is in the battle loop from the screen.
+
+        :return: the state to resume from (see `run`). Return '' if the screen is unknown.
+        """
+        self.tm.update_screen()
+        if self.engine.exists('attack'):
+            return BATTLE
+        if self.engine.exists('next_step') or self.engine.exists('not_apply'):
+            return END
+        if self.engine.exists('cont'):
+            return REENTER
+        if self.engine.exists('refresh_friends'):
+            return FRIEND
+        if self.engine.exists('menu'):
+            return ENTER
+        return ''
+
+    def leave(self):
+        """
+        Close the dialog to continue the quest shown after a battle, back to the quest menu.
+        """
+        self.tm.update_screen()
+        if self.engine.exists('cont'):
+            self.engine.find_and_tap('close')
+            self.engine.wait(INTERVAL_MID)
+
+    def __start_telemetry(self):
+        """
+        Start recording a run to the telemetry, identified by the device serial.
+        """
+        try:
+            device = self.device.serial()
+        except DeviceError:
+            device = self.device.addr
+        self.telemetry.start_run(device=device, quest=self.quest)
+
+    def run(self, max_loops: int = 999, state: str = ENTER, resume: bool = False):
         """
         Start the bot.
 
         :param max_loops: the max number of loops.
-        """
-        count = 0
-        enter_flag = 0
-        starttime = time()
+        :param state: the state to start from: ENTER, REENTER, FRIEND, BATTLE or END.
+        :param resume: if set True, keep the battle count and timing of the previous call.
+        """
+        if not resume:
+            self.count = 0
+            self.start_time = time()
+            if self.telemetry is not None:
+                self.__start_telemetry()
         battlestart = time()
-        if not self.__enter_battle():
-            logger.info('Quit...')
-            enter_flag = 1
-        if enter_flag == 0:
-            rounds = self.play_battle()
-            self.end_battle()
-            count += 1
-            battleend = time()
-            logger.info(
-                '{}-th Battle complete. {} rounds played. Time: {}'.format(count, rounds, battleend - battlestart))
-        while (count < max_loops) and (enter_flag == 0):
-            battlestart = time()
-            if not self.__reenter_battle():
-                logger.info('Quit...')
-                break
-            rounds = self.play_battle()
-            self.end_battle()
-            count += 1
-            battleend = time()
-            logger.info(
-                '{}-th Battle complete. {} rounds played. Time: {}'.format(count, rounds, battleend - battlestart))
+        rounds = 0
+        while True:
+            if state in (ENTER, REENTER):
+                if self.count >= max_loops:
+                    break
+                if state == ENTER and self.wait_ap and not self.__wait_ap():
+                    logger.info('Quit...')
+                    break
+                battlestart = time()
+                ok = self.__enter_battle() if state == ENTER else self.__reenter_battle()
+                if not ok and self.wait_ap:
+                    # leave the AP dialog for the menu, and enter again once AP is regenerated
+                    self.engine.find_and_tap('close')
+                    if not self.__wait_ap(at_least=1):
+                        logger.info('Quit...')
+                        break
+                    state = ENTER
+                    continue
+                if not ok:
+                    logger.info('Quit...')
+                    break
+                state = BATTLE
+            elif state == FRIEND:
+                with self.__phase('friend'):
+                    self.__choose_friend()
+                    self.engine.wait(INTERVAL_SHORT * 2)
+                    if self.engine.exists('start_quest'):
+                        self.engine.find_and_tap('start_quest')
+                    self.engine.wait(INTERVAL_MID)
+                state = BATTLE
+            elif state == BATTLE:
+                with self.__phase('battle'):
+                    start = self.__get_current_stage() if resume else 1
+                    rounds = self.play_battle(start=max(start, 1))
+                resume = False
+                state = END
+            else:
+                with self.__phase('end'):
+                    self.end_battle()
+                self.count += 1
+                self.checkpoint(self.count)
+                battleend = time()
+                logger.info(
+                    '{}-th Battle complete. {} rounds played. Time: {}'.format(self.count, rounds,
+                                                                               battleend - battlestart))
+                if self.telemetry is not None:
+                    self.telemetry.end_battle(battlestart, rounds)
+                state = REENTER
+
+        if self.drops is not None:
+            self.drops.flush()
 
         endtime = time()
         logger.info(
-            '{} Battles played.\nTotal time: {} sec, average time: {} sec\nEnd'.format(count, endtime - starttime,
-                                                                                       (endtime - starttime) / count))
+            '{} Battles played.\nTotal time: {} sec, average time: {} sec\nEnd'.format(
+                self.count, endtime - self.start_time, (endtime - self.start_time) / max(self.count, 1)))
 
 
 class AssistBot:
-    def __init__(self, n_iter, mode: int = 0,
-                 threshold: float = 0.98):
-        self.device = Device()
-        self.mode = mode
-        self.n_iter = n_iter
-        self.threshold = threshold
-        self.tm = TM(feed=partial(self.device.capture, method=Device.FROM_SHELL), mode=self.mode)
-
-    def __find_and_tap(self, im: str, threshold: float = 0.97) -> bool:
-        """
-        Find the given image on screen and tap.
-
-        :param im: the name of image
-        :param threshold: the matching threshold
-        :return: whether successful
-        """
-        x, y = self.tm.find(im, threshold=threshold)
-        if (x, y) == (-1, -1):
-            logger.warning('Failed to find image {} on screen.'.format(im))
-            return False
-        w, h = self.tm.getsize(im)
-        return self.device.tap_rand(x, y, w, h)
-
-    def __exists(self, im: str, threshold: float = 0.97) -> bool:
-        """
-        Check if a given image exists on screen.
+    """
+    A class of the bot that does chores: mailbox sorting, summoning and reward-box drawing.
+    """
 
-        :param im: the name of the image
-        :param threshold: threshold of matching
+    def __init__(self, n_iter, mode: int = 0,
+                 threshold: float = 0.98,
+                 engine: Engine = None):
         """
-        return self.tm.exists(im, threshold=threshold)
 
-    def __wait_until(self, im: str):
-        """
-        Wait until the given image appears. Useful when try to use skills, etc.
+        :param n_iter: the number of iterations of the tasks.
+        :param mode: the template image set to use. Ignored if `engine` is given.
+        :param threshold: the matching threshold of the items and buttons.
+        :param engine: the engine to run on. If not given, a new one is created, or the shared one is used
+            (see `share_engines`).
         """
-        logger.debug("Wait until image '{}' appears.".format(im))
-        self.tm.update_screen()
-        while not self.__exists(im):
-            self.__wait(INTERVAL_SHORT)
-            if self.__exists('reconnect'):
-                self.__find_and_tap('reconnect')
+        self.engine = engine or get_engine(mode=mode, threshold=0.97)
+        self.device = self.engine.device
+        self.tm = self.engine.tm
+        self.mode = self.engine.mode
+        self.n_iter = n_iter
+        self.threshold = threshold
 
-    def __wait(self, sec):
-        """
-        Wait some seconds and update the screen feed.
+        self.mailbox = MailboxTask(self.engine, n_iter, threshold)
+        self.gacha = GachaTask(self.engine, n_iter, threshold)
+        self.reward = RewardTask(self.engine, n_iter, threshold)
 
-        :param sec: the seconds to wait
-        """
-        logger.debug('Sleep {} seconds.'.format(sec))
-        sleep(sec)
-        self.tm.update_screen()
+    def sort_mailbox(self, expstr=None, batch: bool = False):
+        return self.mailbox.run(expstr, batch=batch)
 
-    def __find_exp(self, length):
-        for eid in range(length):
-            im = 'e_{}'.format(eid)
-            if self.__exists(im, threshold=self.threshold):
-                return im
-
-    def sort_mailbox(self, expstr=None):
-        if expstr is None:
-            expstr = ["exp_1.png"]
-        if len(expstr) >= 1:
-            explength = len(expstr)
-            for eid in range(explength):
-                path = Path(expstr[eid]).absolute()
-                self.tm.load_image(path, name='e_{}'.format(eid))
-        else:
-            return -1
-        self.__wait_until('close1')
-        start = time()
-        if explength > 0:
-            counter = 0
-            for _ in range(9999):
-                exp = self.__find_exp(explength)
-                if not exp:
-                    self.device.swipe((640, 650), (640, 250))
-                    counter += 1
-                    logger.info("Counter: {} .".format(counter))
-                    self.__wait(0.2)
-                else:
-                    self.__find_and_tap(exp, threshold=self.threshold)
-                    self.__wait(INTERVAL_SHORT)
-                if counter >= self.n_iter:
-                    end = time()
-                    logger.info("Time: {} sec.".format(end - start))
-                    return 0
-
-    def drawcard(self):
-        start = time()
-        i = 0
-        for i in range(self.n_iter):
-            self.__wait_until('draw10cards')
-            self.__find_and_tap('draw10cards', self.threshold)
-            self.__wait(INTERVAL_SHORT)
-            if self.__find_and_tap('decide1', self.threshold):
-                self.__wait(INTERVAL_SHORT * 3)
-                self.device.tap_rand(20, 700, 10, 10)
-                logger.info("{}-th draw".format(i + 1))
-                self.__wait(INTERVAL_SHORT * 2)
-                self.device.tap_rand(20, 700, 10, 10)
-            else:
-                break
-        end = time()
-        logger.info("{}-th draw. Time: {} sec.".format(i + 1, end - start))
+    def drawcard(self, pipelined: bool = False, archive: str = None):
+        self.gacha.run(pipelined=pipelined, archive=archive)
 
-    def drawreward(self):
-        i = 0
-        self.__wait_until('menu')
-        start = time()
-        while i < self.n_iter:
-            if self.__exists('0_300', self.threshold):
-                end = time()
-                logger.info("{}-th pool. Time: {} sec.".format(i + 1, end - start))
-                i += 1
-                self.__find_and_tap('reset', 0.9)
-                self.__wait_until('confirm')
-                self.__find_and_tap('confirm', 0.9)
-                self.__wait_until('close')
-                self.__find_and_tap('close', 0.9)
-                start = time()
-                continue
-            self.__wait(INTERVAL_SHORT)
-            self.device.tap_rand(330, 445, 10, 10)
+    def drawreward(self, stream: bool = False, rate: float = 5.0):
+        self.reward.run(stream=stream, rate=rate)
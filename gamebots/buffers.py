@@ -0,0 +1,65 @@
+"""
+Preallocated buffers shared by the device and the template matcher.
+"""
+
+import logging
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger('buffers')
+
+
+class BufferPool:
+    """
+    A pool of preallocated numpy buffers, reused across captures and matches.
+
+    Buffers are grouped into rings by tag, shape and dtype. Each ring holds `depth` buffers handed out in turn,
+    so a buffer stays valid until `depth` more buffers of the same ring are taken. Once every shape in use
+    has been seen, no more memory is allocated.
+    """
+
+    def __init__(self, depth: int = 2):
+        """
+
+        :param depth: the number of buffers of each ring.
+        """
+        self.depth = depth
+        # the buffers of each ring and the index of the next one to hand out
+        self.__rings = {}  # type: Dict[Tuple[str, tuple, str], List]
+        self.__lock = threading.Lock()
+
+    def get(self, tag: str, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        """
+        Return the next buffer of a ring. Its content is undefined.
+
+        :param tag: the name of the ring, so that unrelated buffers of the same shape are not shared.
+        :param shape: the shape of the buffer.
+        :param dtype: the dtype of the buffer.
+        :return: the buffer.
+        """
+        key = (tag, tuple(shape), np.dtype(dtype).str)
+        with self.__lock:
+            ring = self.__rings.get(key)
+            if ring is None:
+                ring = self.__rings[key] = [[np.empty(shape, dtype=dtype) for _ in range(self.depth)], 0]
+                logger.debug('Allocated {} buffers of {} {}.'.format(self.depth, tag, shape))
+            buffers, i = ring
+            ring[1] = (i + 1) % self.depth
+            return buffers[i]
+
+    def clear(self):
+        """
+        Release every buffer, e.g. after the screen size changed.
+        """
+        with self.__lock:
+            self.__rings = {}
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The total size of the buffers, in bytes.
+        """
+        with self.__lock:
+            return sum(b.nbytes for buffers, _ in self.__rings.values() for b in buffers)
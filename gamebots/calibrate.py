@@ -0,0 +1,372 @@
+"""
+Calibration of the template thresholds in the manifest from recorded frames.
+
+Usage: python -m gamebots.calibrate FRAMES_DIR [--mode 0] [--jobs N] [--scores FILE] [--write] [--only NAME ...]
+       python -m gamebots.calibrate SCREENSHOT --digits TEXT [--button wave] [--mode 0]
+       python -m gamebots.calibrate SCREENSHOT --screen NAME [--mode 0]
+
+FRAMES_DIR holds the recorded screens (in png format) and a `labels.json` that maps each file name to the
+list of template names visible on it. A template is taken as absent from every frame it is not listed for.
+
+For every template, the scores over all frames are computed with its current settings and with every faster
+configuration (downscaling, grayscale, a region around the positive matches). The fastest configuration that
+still separates the frames with the template from the others is suggested.
+
+With `--digits`, the glyph masks of the digit reader are cut instead from a screenshot that shows TEXT (e.g. 1/3)
+in the region of the button (`wave` or `ap`). The cut fails if the region does not hold exactly the glyphs of TEXT,
+which also checks the region in the button config.
+
+With `--screen`, the screenshot is added as a reference of the screen NAME (e.g. bond or exp) to the screen
+classifier.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+from itertools import product
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from .digits import DigitReader, glyph_file
+from .screens import ScreenClassifier
+from .tm import TM, prepare, score_map
+
+logger = logging.getLogger('calibrate')
+
+# the downscale factors and color modes tried
+SCALES = (1.0, 0.75, 0.5, 0.25)
+COLORS = ('color', 'gray')
+
+# the margin around the positive matches of the suggested region, in pixels
+ROI_PADDING = 16
+
+# the template matcher of a worker process, and the templates to calibrate
+_tm = None  # type: TM
+_templates = []  # type: List[str]
+
+
+def load_labels(frames_dir: Path) -> Dict[str, List[str]]:
+    """
+    Load the labels of the frames.
+
+    :param frames_dir: the directory of the frames.
+    :return: the template names visible on each frame, by file name.
+    """
+    with open(str(frames_dir / 'labels.json')) as f:
+        return json.load(f)
+
+
+def best_threshold(positives: np.ndarray, negatives: np.ndarray) -> Tuple[float, float]:
+    """
+    Return the threshold that best separates the scores of the positive frames from the negative ones.
+
+    :param positives: the scores on the frames where the template is present.
+    :param negatives: the scores on the frames where the template is absent.
+    :return: the threshold and the margin between the lowest positive and the highest negative score.
+        The margin is negative if they are not separable.
+    """
+    lo = positives.min() if len(positives) else 1.0
+    hi = negatives.max() if len(negatives) else 0.0
+    margin = float(lo - hi)
+    if margin > 0:
+        return float((lo + hi) / 2), margin
+
+    # not separable: the candidate threshold with the fewest errors
+    candidates = np.unique(np.concatenate([positives, negatives]))
+    errors = (positives[None, :] < candidates[:, None]).sum(axis=1) + \
+             (negatives[None, :] >= candidates[:, None]).sum(axis=1)
+    return float(candidates[errors.argmin()]), margin
+
+
+def cost(size: Tuple[int, int], template: Tuple[int, int], roi: Tuple[int, int, int, int], color: str,
+         scale: float) -> float:
+    """
+    Estimate the relative cost of matching a template, as the number of multiply-adds.
+
+    :param size: the size of the screen (w, h).
+    :param template: the size of the template (w, h).
+    :param roi: the region searched (x, y, w, h), or None for the whole screen.
+    :param color: 'color' or 'gray'.
+    :param scale: the downscale factor.
+    """
+    w, h = (roi[2], roi[3]) if roi else size
+    tw, th = template
+    res = max(w - tw + 1, 1) * max(h - th + 1, 1)
+    return res * tw * th * scale ** 4 * (3 if color == 'color' else 1)
+
+
+def _init(mode: int, templates: List[str]):
+    global _tm, _templates
+    _tm = TM(feed=None, mode=mode)
+    _templates = templates
+
+
+def _score(args: Tuple[str, Dict[str, Tuple[int, int, int, int]]]) -> Dict[str, Dict[tuple, float]]:
+    """
+    Score every template on a frame, with every configuration.
+
+    :param args: the path to the frame, and the region to try for each template (None to skip).
+    :return: the score of each template under each configuration (color, scale, roi).
+    """
+    path, rois = args
+    frame = cv.imread(path, cv.IMREAD_COLOR)
+    result = {}
+    for (color, scale) in product(COLORS, SCALES):
+        screen = prepare(frame, color == 'gray', scale)
+        for im, method in ((im, _tm.entry(im)['method']) for im in _templates):
+            template = prepare(_tm.images[im], color == 'gray', scale)
+            scores = result.setdefault(im, {})
+            if template.shape[0] > screen.shape[0] or template.shape[1] > screen.shape[1]:
+                continue
+            res = score_map(screen, template, method)
+            scores[color, scale, None] = float(res.max())
+
+            roi = rois.get(im)
+            if roi is not None:
+                x, y, w, h = (int(v * scale) for v in roi)
+                # the top-left corners whose match lies in the region
+                sub = res[y:y + max(h - template.shape[0] + 1, 1), x:x + max(w - template.shape[1] + 1, 1)]
+                scores[color, scale, tuple(roi)] = float(sub.max()) if sub.size else 0.0
+    return result
+
+
+def _locate(path: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Return the location of the best match of every template on a frame, with the current settings.
+    """
+    _tm.set_screen(cv.imread(path, cv.IMREAD_COLOR))
+    return {im: _tm.find(im, threshold=-1.0) for im in _templates}
+
+
+def tight_roi(locs: List[Tuple[int, int]], template: Tuple[int, int],
+              size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """
+    Return the region around the given matches of a template, padded by `ROI_PADDING`.
+    """
+    xs, ys = zip(*locs)
+    x0 = max(min(xs) - ROI_PADDING, 0)
+    y0 = max(min(ys) - ROI_PADDING, 0)
+    x1 = min(max(xs) + template[0] + ROI_PADDING, size[0])
+    y1 = min(max(ys) + template[1] + ROI_PADDING, size[1])
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def calibrate(frames_dir: Path, mode: int = 0, jobs: int = None, min_margin: float = 0.05,
+              templates: List[str] = None) -> dict:
+    """
+    Compute the score distributions of every template of the manifest over the frames, in parallel,
+    and suggest the fastest separating configuration.
+
+    :param frames_dir: the directory of the frames and labels.json.
+    :param mode: the template image set.
+    :param jobs: the number of worker processes. If not given, use all the cores.
+    :param min_margin: the min margin for a configuration to be considered separating.
+    :param templates: the templates to calibrate. If not given, every template of the manifest.
+    :return: the report of each template with at least one positive frame, as a dict with the keys
+        'positives', 'negatives' (scores with the current settings), 'threshold', 'margin', 'current' and
+        'suggested' (the configurations, each as a dict of color, scale, roi, threshold, margin and cost),
+        and 'scores' (the scores of each configuration, as (positives, negatives)).
+    """
+    labels = load_labels(frames_dir)
+    names = sorted(name for name in labels if (frames_dir / name).is_file())
+    paths = [str(frames_dir / name) for name in names]
+    logger.info('{} frames to process with {} workers.'.format(len(paths), jobs or os.cpu_count()))
+
+    tm = TM(feed=None, mode=mode)
+    templates = [im for im in templates if im in tm.manifest] if templates else list(tm.manifest)
+    size = cv.imread(paths[0], cv.IMREAD_COLOR).shape[1::-1] if paths else (1280, 720)
+
+    with Pool(jobs, initializer=_init, initargs=(mode, templates)) as pool:
+        # find where the templates appear, to try a tight region around them
+        locations = pool.map(_locate, paths)
+        rois = {}
+        for im in templates:
+            locs = [loc[im] for name, loc in zip(names, locations) if im in labels[name]]
+            if locs:
+                rois[im] = tight_roi(locs, tm.getsize(im), size)
+        scores = pool.map(_score, [(path, rois) for path in paths])
+
+    report = {}
+    for im in templates:
+        is_positive = np.array([im in labels[name] for name in names], dtype=bool)
+        if not is_positive.any():
+            continue
+        entry = tm.entry(im)
+        configs = set()
+        for s in scores:
+            configs.update(s.get(im, {}))
+        by_config = {}
+        for config in configs:
+            values = np.array([s[im].get(config, 0.0) for s in scores])
+            by_config[config] = (values[is_positive], values[~is_positive])
+
+        def describe(config):
+            color, scale, roi = config
+            threshold, margin = best_threshold(*by_config[config])
+            return {
+                'color': color, 'scale': scale, 'roi': list(roi) if roi else None,
+                'threshold': threshold, 'margin': margin,
+                'cost': cost(size, tm.getsize(im), roi, color, scale)
+            }
+
+        current = (entry['color'], entry['scale'], tuple(entry['roi']) if entry['roi'] else None)
+        if current not in by_config:
+            current = ('color', 1.0, None)
+        current = describe(current)
+        candidates = [describe(config) for config in by_config]
+        separating = [c for c in candidates if c['margin'] >= min_margin]
+        suggested = min(separating, key=lambda c: c['cost']) if separating else current
+
+        positives, negatives = by_config[current['color'], current['scale'],
+                                         tuple(current['roi']) if current['roi'] else None]
+        report[im] = {
+            'positives': positives, 'negatives': negatives,
+            'threshold': current['threshold'], 'margin': current['margin'],
+            'current': current, 'suggested': suggested,
+            'scores': by_config
+        }
+    return report
+
+
+def write_scores(report: dict, path: str):
+    """
+    Write every score of the report to a CSV file, one row per template, configuration and frame.
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['template', 'color', 'scale', 'roi', 'label', 'score'])
+        for im, r in sorted(report.items()):
+            for (color, scale, roi), (positives, negatives) in sorted(r['scores'].items(), key=str):
+                for label, values in ((1, positives), (0, negatives)):
+                    for v in values:
+                        writer.writerow([im, color, scale, ' '.join(map(str, roi)) if roi else '', label, v])
+
+
+def write_manifest(report: dict, mode: int = 0, path: Path = None):
+    """
+    Write the suggested configuration and threshold of every template of the report to the manifest.
+    The other templates and settings of the manifest are kept.
+
+    :param report: the report, see `calibrate`.
+    :param mode: the template image set.
+    :param path: the path to write to. If not given, the manifest of the image set.
+    """
+    tm = TM(feed=None, mode=mode)
+    for im, r in report.items():
+        s = r['suggested']
+        tm.manifest[im].update(color=s['color'], scale=s['scale'], roi=s['roi'], threshold=round(s['threshold'], 4))
+    path = path or Path(__file__).absolute().parent / 'images{}'.format(mode) / 'manifest.json'
+    with open(str(path), 'w') as f:
+        json.dump(tm.manifest, f, indent=2)
+        f.write('\n')
+    logger.info('Manifest written to {}.'.format(path))
+
+
+def cut_digits(screenshot: Path, text: str, button: str = 'wave', mode: int = 0) -> bool:
+    """
+    Cut the glyph masks of the digit reader from a screenshot, and write them to the glyph directory.
+
+    :param screenshot: the path to the screenshot.
+    :param text: the characters shown in the region of the button, e.g. '1/3'.
+    :param button: the button in the button config whose region holds the characters.
+    :param mode: the template image set.
+    :return: whether the glyphs are cut.
+    """
+    with open(str(Path(__file__).absolute().parent / 'config' / 'buttons.json')) as f:
+        btn = json.load(f)[button]
+    roi = btn['x'], btn['y'], btn['w'], btn['h']
+    image = cv.imread(str(screenshot), cv.IMREAD_COLOR)
+    if image is None:
+        logger.error('Cannot read {}.'.format(screenshot))
+        return False
+
+    reader = DigitReader(mode)
+    glyphs = reader.add_glyphs(image, roi, text)
+    if not glyphs:
+        logger.error('Check the region of {} in the button config.'.format(button))
+        return False
+    reader.glyph_dir.mkdir(parents=True, exist_ok=True)
+    for c, glyph in glyphs.items():
+        cv.imwrite(str(reader.glyph_dir / glyph_file(c)), glyph)
+    logger.info('Glyphs {} written to {}.'.format(' '.join(sorted(glyphs)), reader.glyph_dir))
+    if not reader.ready:
+        logger.info('Still missing: {}.'.format(' '.join(reader.missing)))
+    return True
+
+
+def add_screen(screenshot: Path, name: str, mode: int = 0) -> bool:
+    """
+    Add a screenshot as a reference screen of the screen classifier, next to the other references of the name.
+
+    :param screenshot: the path to the screenshot.
+    :param name: the name of the screen, e.g. 'bond'.
+    :param mode: the template image set.
+    :return: whether the screenshot is added.
+    """
+    image = cv.imread(str(screenshot), cv.IMREAD_COLOR)
+    if image is None:
+        logger.error('Cannot read {}.'.format(screenshot))
+        return False
+    classifier = ScreenClassifier(mode)
+    other, dist = classifier.classify(image)
+    if other and other != name:
+        logger.warning("The screenshot is near a reference of '{}' ({:.3f}).".format(other, dist))
+    classifier.screen_dir.mkdir(parents=True, exist_ok=True)
+    path = classifier.screen_dir / '{}.{}.png'.format(name, classifier.names.count(name) + 1)
+    cv.imwrite(str(path), image)
+    logger.info('Reference screen written to {}.'.format(path))
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate the template thresholds from recorded frames.')
+    parser.add_argument('frames', help='the directory of the frames and labels.json, '
+                                       'or a screenshot with --digits or --screen')
+    parser.add_argument('--mode', type=int, default=0, help='the template image set')
+    parser.add_argument('--jobs', type=int, default=None, help='the number of worker processes')
+    parser.add_argument('--min-margin', type=float, default=0.05, help='the min margin of a suggested configuration')
+    parser.add_argument('--only', nargs='+', metavar='NAME', help='calibrate only these templates')
+    parser.add_argument('--scores', help='write every score to this CSV file')
+    parser.add_argument('--write', action='store_true',
+                        help='write the suggested configurations and thresholds to the manifest')
+    parser.add_argument('--digits', metavar='TEXT', help='cut the glyph masks of TEXT shown on the screenshot')
+    parser.add_argument('--button', default='wave', help='the button whose region holds the digits')
+    parser.add_argument('--screen', metavar='NAME', help='add the screenshot as a reference of the screen NAME')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.digits:
+        cut_digits(Path(args.frames), args.digits, args.button, args.mode)
+        return
+    if args.screen:
+        add_screen(Path(args.frames), args.screen, args.mode)
+        return
+
+    report = calibrate(Path(args.frames), args.mode, args.jobs, args.min_margin, args.only)
+
+    for im, r in sorted(report.items()):
+        pos, neg = r['positives'], r['negatives']
+        print('{:16s} pos n={:<4d} min={:.4f} med={:.4f}  neg n={:<4d} max={:.4f} p99={:.4f}  '
+              'threshold {:.4f} margin {:+.4f}{}'.format(
+                im, len(pos), pos.min(), np.median(pos), len(neg),
+                neg.max() if len(neg) else 0.0, np.percentile(neg, 99) if len(neg) else 0.0,
+                r['threshold'], r['margin'], '' if r['margin'] > 0 else '  NOT SEPARABLE'))
+        s = r['suggested']
+        print('{:16s} suggested: {} scale={} roi={} threshold {:.4f} margin {:+.4f}, {:.1f}x faster'.format(
+            '', s['color'], s['scale'], s['roi'], s['threshold'], s['margin'], r['current']['cost'] / s['cost']))
+
+    if args.scores:
+        write_scores(report, args.scores)
+
+    if args.write:
+        write_manifest(report, args.mode)
+
+
+if __name__ == '__main__':
+    main()
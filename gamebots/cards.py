@@ -0,0 +1,162 @@
+"""
+Command card recognition on the card selection screen.
+"""
+
+import logging
+from collections import namedtuple
+from typing import Dict, List, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from .screens import signature
+
+logger = logging.getLogger('cards')
+
+BUSTER = 'buster'
+ARTS = 'arts'
+QUICK = 'quick'
+
+# the ranges of hue (in OpenCV's 0-180 scale) of each card color
+HUES = {
+    BUSTER: ((0, 12), (165, 180)),
+    ARTS: ((95, 130),),
+    QUICK: ((40, 85),),
+}
+COLORS = (BUSTER, ARTS, QUICK)
+
+# the min saturation and value of a pixel to count for a color
+MIN_SATURATION = 90
+MIN_VALUE = 80
+
+# the min ratio of colored pixels on a noble phantasm card slot for the card to be shown
+NP_MIN_COLORED = 0.2
+
+# the number of command cards and noble phantasm cards
+N_CARDS = 5
+N_NP = 3
+
+# the command cards and noble phantasm cards on the screen.
+# colors: the color of each command card; owners: the servant of each command card (see `CardReader.read`);
+# np_ready: whether each servant's noble phantasm card is available; np_colors: the color of each of them.
+Cards = namedtuple('Cards', ['colors', 'owners', 'np_ready', 'np_colors'])
+
+
+class CardReader:
+    """
+    A reader of the command cards, by the hue and portrait of fixed card regions.
+
+    The regions are the 'card' and 'noble_card' buttons, repeated every 'card_distance' pixels.
+    All the regions are converted and measured at once.
+    """
+
+    def __init__(self, buttons: dict, max_distance: float = 0.3):
+        """
+
+        :param buttons: the button config, see `Engine.buttons`.
+        :param max_distance: the max distance between the portraits of two cards of the same servant.
+        """
+        self.max_distance = max_distance
+
+        self.rois = []  # type: List[Tuple[int, int, int, int]]
+        for name, count in (('card', N_CARDS), ('noble_card', N_NP)):
+            btn = buttons[name]
+            for i in range(count):
+                self.rois.append((btn['x'] + buttons['card_distance'] * i, btn['y'], btn['w'], btn['h']))
+
+        # the portrait signatures of the servants, by servant number
+        self.portraits = {}  # type: Dict[int, np.ndarray]
+
+    def add_servant(self, servant: int, card: np.ndarray):
+        """
+        Add the portrait of a servant, so that its cards are recognized as its own.
+
+        :param servant: the servant number, 1 to 3.
+        :param card: an image of one of its command cards, in BGR, in the size of a card region.
+        """
+        self.portraits[servant] = signature(card)
+
+    def __stack(self, image: np.ndarray) -> np.ndarray:
+        """
+        Return the card regions stacked vertically, so that they can be processed as one image.
+        """
+        h = min(r[3] for r in self.rois)
+        w = min(r[2] for r in self.rois)
+        return np.concatenate([image[y:y + h, x:x + w] for x, y, _, _ in self.rois])
+
+    def __owners(self, cards: np.ndarray) -> List[int]:
+        """
+        Return the servant of each command card.
+        """
+        sigs = np.stack([signature(card) for card in cards])
+        if self.portraits:
+            servants = sorted(self.portraits)
+            dists = 1 - sigs.dot(np.stack([self.portraits[s] for s in servants]).T)
+            best = dists.argmin(axis=1)
+            return [servants[b] if dists[i, b] <= self.max_distance else -1 for i, b in enumerate(best)]
+
+        # without portraits, number the servants in order of appearance
+        dists = 1 - sigs.dot(sigs.T)
+        owners = []
+        for i in range(len(sigs)):
+            same = [owners[j] for j in range(i) if dists[i, j] <= self.max_distance]
+            owners.append(same[0] if same else max(owners, default=0) + 1)
+        return owners
+
+    def read(self, image: np.ndarray) -> Cards:
+        """
+        Recognize the cards on the card selection screen.
+
+        :param image: the screen, in BGR.
+        :return: the cards. A servant is given by its number (1 to 3) if its portrait was added,
+            else the servants are numbered in order of appearance. The owner is -1 if not recognized.
+        """
+        stack = self.__stack(image)
+        n = len(self.rois)
+        hsv = cv.cvtColor(stack, cv.COLOR_BGR2HSV).reshape(n, -1, 3)
+        hue, sat, val = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+        colored = (sat >= MIN_SATURATION) & (val >= MIN_VALUE)
+
+        # (regions, colors) ratio of pixels of each color
+        ratios = np.stack([
+            (colored & np.any([(hue >= lo) & (hue < hi) for lo, hi in HUES[c]], axis=0)).mean(axis=1)
+            for c in COLORS
+        ], axis=1)
+        colors = [COLORS[i] for i in ratios.argmax(axis=1)]
+
+        cards = stack.reshape((n, -1) + stack.shape[1:])
+        owners = self.__owners(cards[:N_CARDS])
+        np_ready = [bool(r) for r in colored[N_CARDS:].mean(axis=1) >= NP_MIN_COLORED]
+
+        result = Cards(colors[:N_CARDS], owners, np_ready,
+                       [c if ready else '' for c, ready in zip(colors[N_CARDS:], np_ready)])
+        logger.debug('Cards: {}'.format(result))
+        return result
+
+
+def pick_cards(cards: Cards, nps: List[int] = ()) -> List[int]:
+    """
+    Pick three cards to play, in the numbering of `BattleBot.attack`, preferring a chain.
+
+    The noble phantasms given are played first if ready. The command cards are then picked to make a chain of
+    one color if possible, else a chain of one servant, else Buster cards first.
+    A chain with noble phantasms of another servant is only recognized if the portraits were added.
+
+    :param cards: the cards on the screen, see `CardReader.read`.
+    :param nps: the servants (1 to 3) whose noble phantasm to play when ready.
+    :return: the card numbers: 1 ~ 5 for the command cards, 6 ~ 8 for the noble phantasm cards.
+    """
+    picked = [5 + s for s in nps if cards.np_ready[s - 1]][:3]
+    colors = [cards.np_colors[p - 6] for p in picked]
+    need = 3 - len(picked)
+    order = sorted(range(N_CARDS), key=lambda i: COLORS.index(cards.colors[i]))
+
+    for c in COLORS:
+        same = [i for i in order if cards.colors[i] == c]
+        if len(same) >= need and all(color == c for color in colors):
+            return picked + [i + 1 for i in same[:need]]
+    for owner in sorted(set(cards.owners) - {-1}, key=cards.owners.count, reverse=True):
+        same = [i for i in order if cards.owners[i] == owner]
+        if len(same) >= need and all(p - 5 == owner for p in picked):
+            return picked + [i + 1 for i in same[:need]]
+    return picked + [i + 1 for i in order[:need]]
@@ -2,13 +2,50 @@
 Android device interaction.
 """
 
+import json
+import os
+import socket
+import struct
 import subprocess
 import logging
 import re
+import threading
 import cv2 as cv
 import numpy as np
+from pathlib import Path
 from random import randint
-from typing import List, Tuple, Union
+from time import time
+from typing import Dict, List, Tuple, Union
+
+from .buffers import BufferPool
+
+# where the capture benchmark results are stored, by device serial
+CAPTURE_CACHE = Path.home() / '.fgo-bot' / 'capture.json'
+
+# the options of OpenCV's FFmpeg backend for the screen stream: decode from the first bytes instead of probing
+STREAM_OPTIONS = 'probesize;32|analyzeduration;0'
+# OpenCV only reads them from the environment when a capture is opened, so the openings are serialized
+_stream_open_lock = threading.Lock()
+# the bit rate of the screen stream. Compression artifacts lower the matching values.
+STREAM_BIT_RATE = 8000000
+
+
+class DeviceError(Exception):
+    """
+    An error in controlling the device.
+    """
+
+
+class AdbError(DeviceError):
+    """
+    An adb command failed, e.g. the device is disconnected.
+    """
+
+
+class DeviceTimeout(DeviceError):
+    """
+    An adb command timed out, e.g. the emulator hangs.
+    """
 
 
 class Device:
@@ -16,21 +53,42 @@ class Device:
     A class of the android device controller that provides interface such as screenshots and clicking.
     """
 
-    def __init__(self, timeout: int = 30, adb_path: str = 'adb'):
+    def __init__(self, timeout: int = 30, adb_path: Union[str, List[str]] = 'adb', pool: BufferPool = None):
         """
 
         :param timeout: the timeout of executing commands.
-        :param adb_path: the path to the adb executable.
+        :param adb_path: the path to the adb executable, or the command line to run it as a list.
+        :param pool: the pool of the capture buffers, see `BufferPool`. If not given, a new one is created.
         """
 
         self.logger = logging.getLogger('device')
 
         self.adb_path = adb_path
 
+        # the address of the last connection, used to reconnect
+        self.addr = ''
+
         self.timeout = timeout
 
         self.size = (1280, 720)
 
+        # the buffers the raw screen is read into and decoded into, shared with the template matcher
+        self.pool = pool or BufferPool()
+
+        # the capturing method used by `AUTO`, chosen by `select_capture`
+        self.capture_method = None
+        # the results of the last capture benchmark
+        self.capture_stats = {}
+
+        # the screen stream used by `STREAM`, see `start_stream`
+        self.stream = None  # type: ScreenStream
+
+    def __adb(self) -> List[str]:
+        """
+        Return the command line of adb as a list.
+        """
+        return list(self.adb_path) if isinstance(self.adb_path, (list, tuple)) else [self.adb_path]
+
     def __run_cmd(self, cmd: List[str], raw: bool = False) -> Union[bytes, List[str]]:
         """
         Execute an adb command.
@@ -40,10 +98,19 @@ class Device:
         :param cmd: the command to execute, separated as a string list.
         :param raw: whether to return the raw output
         :return: a list of the output, utf-8 decoded, separated by line, as a list.
+        :raise AdbError: if the command fails.
+        :raise DeviceTimeout: if the command times out.
         """
-        cmd = [self.adb_path] + cmd
+        cmd = self.__adb() + cmd
         self.logger.debug('Executing command: {}'.format(' '.join(cmd)))
-        output = subprocess.check_output(cmd, timeout=self.timeout)
+        try:
+            output = subprocess.check_output(cmd, timeout=self.timeout)
+        except subprocess.TimeoutExpired as e:
+            self.logger.error('Command timed out: {}'.format(' '.join(cmd)))
+            raise DeviceTimeout(str(e)) from e
+        except (subprocess.CalledProcessError, OSError) as e:
+            self.logger.error('Command failed: {}'.format(' '.join(cmd)))
+            raise AdbError(str(e)) from e
         if raw:
             return output
         else:
@@ -60,6 +127,7 @@ class Device:
         :param restart: if set True, run kill-server before connecting.
         :return: whether connection is successful.
         """
+        self.addr = addr
         if restart:
             self.__run_cmd(['kill-server'])
         output = self.__run_cmd(['connect', addr])
@@ -71,11 +139,40 @@ class Device:
         self.logger.error('Error message: {}'.format('\n'.join(output)))
         return False
 
+    def reconnect(self, restart: bool = False) -> bool:
+        """
+        Connect to the device again.
+
+        Only the connection of this device is reset: it is disconnected and connected again if it was connected
+        via tcp/ip, else `adb reconnect` is run. The adb server serves every device of the host, so it is only
+        restarted if asked to.
+
+        :param restart: if set True, restart the adb server instead, which drops the other devices as well.
+        :return: whether connection is successful.
+        """
+        if self.addr:
+            if not restart:
+                try:
+                    self.__run_cmd(['disconnect', self.addr])
+                except AdbError:
+                    # not connected any more
+                    pass
+            return self.connect(self.addr, restart=restart)
+        self.__run_cmd(['kill-server'] if restart else ['reconnect'])
+        return self.connected()
+
     def connected(self) -> bool:
         """
         Check if a device is connected.
+
+        If connected via tcp/ip, check the device at that address, else check that exactly one device is connected.
         """
         output = self.__run_cmd(['devices'])
+        if self.addr:
+            if any(line.split() == [self.addr, 'device'] for line in output):
+                return True
+            self.logger.error('Device at {} not connected.'.format(self.addr))
+            return False
         devices = 0
         for line in output:
             if line.endswith('device'):
@@ -90,6 +187,15 @@ class Device:
             self.logger.info('device connected.')
             return True
 
+    def serial(self) -> str:
+        """
+        Get the serial number of the device.
+
+        :return: the serial number. Return '' if failed.
+        """
+        output = self.__run_cmd(['get-serialno'])
+        return output[0].strip() if output else ''
+
     def get_size(self) -> bool:
         """
         Get the resolution (screen size) of the device.
@@ -137,6 +243,23 @@ class Device:
         y = randint(y, y + h - 1)
         return self.tap(x, y)
 
+    def tap_seq(self, points: List[Tuple[int, int]]) -> bool:
+        """
+        Input a sequence of tap events with a single adb command.
+
+        :param points: the coords of the taps in pixels.
+        :return: whether the events are successful.
+        """
+        cmds = '; '.join('input tap {:d} {:d}'.format(x, y) for x, y in points)
+        output = self.__run_cmd(['shell', cmds])
+        for line in output:
+            if line.startswith('error'):
+                self.logger.error('Failed to tap {} times'.format(len(points)))
+                self.logger.error('Error message: {}'.format('\n'.join(output)))
+                return False
+        self.logger.debug('Tapped {} times'.format(len(points)))
+        return True
+
     def swipe(self, pos0: Tuple[int, int], pos1: Tuple[int, int], duration: int = 500) -> bool:
         """
         Input a swipe event from `pos0` to `pos1`, taking `duration` milliseconds.
@@ -158,14 +281,31 @@ class Device:
         return True
 
     # methods of capturing the screen.
+    AUTO = -1
     FROM_SHELL = 0
     SDCARD_PULL = 1
+    EXEC_OUT = 2
+    RAW = 3
+    # the latest frame of a continuous screen recording, see `start_stream`.
+    # Not benchmarked: its latency is that of a copy, but the frame may lag the screen by a few frames.
+    STREAM = 4
+
+    # the methods tried by `benchmark_capture`
+    CAPTURE_METHODS = {
+        'FROM_SHELL': FROM_SHELL,
+        'SDCARD_PULL': SDCARD_PULL,
+        'EXEC_OUT': EXEC_OUT,
+        'RAW': RAW,
+    }
 
     @staticmethod
     def __png_sanitize(s: bytes) -> bytes:
         """
         Auto-detect and replace '\r\n' or '\r\r\n' by '\n' in the given byte string.
 
+        The pattern is detected from the line ending of the PNG signature. Nothing is replaced if it is
+        not one of the two, so that a misdetection cannot corrupt the image.
+
         :param s: the string to sanitize
         :return: the result string
         """
@@ -174,27 +314,462 @@ class Device:
         pos2 = s.find(b'\n', pos1)
         pattern = s[pos1 + 1:pos2 + 1]
         logging.getLogger('device').debug("Pattern detected: '{}'".format(pattern))
-        return re.sub(pattern, b'\n', s)
+        if pattern not in (b'\r\n', b'\r\r\n'):
+            return s
+        return s.replace(pattern, b'\n')
+
+    def __capture_raw(self) -> np.ndarray:
+        """
+        Capture the screen as raw RGBA pixels through `exec-out`, which needs neither sanitizing nor PNG decoding.
+
+        The pixels are read from the pipe as they arrive into a buffer of the pool, and converted into a frame
+        of the pool, so the previous `pool.depth - 1` frames stay valid.
+
+        :return: the screen in BGR.
+        :raise AdbError: if the command fails or the output is incomplete.
+        :raise DeviceTimeout: if the command times out.
+        """
+        cmd = self.__adb() + ['exec-out', 'screencap']
+        self.logger.debug('Executing command: {}'.format(' '.join(cmd)))
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            raise AdbError(str(e)) from e
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            proc.kill()
+
+        timer = threading.Timer(self.timeout, kill)
+        timer.start()
+        n = size = 0
+        try:
+            header = proc.stdout.read(12)
+            if len(header) == 12:
+                w, h, _ = struct.unpack('<III', header)
+                size = w * h * 4
+                # newer versions put a 4-byte color space after the header
+                raw = self.pool.get('raw', (size + 4,))
+                view = memoryview(raw)
+                while n < len(view):
+                    k = proc.stdout.readinto(view[n:])
+                    if not k:
+                        break
+                    n += k
+            proc.wait()
+        finally:
+            timer.cancel()
+            proc.stdout.close()
+        if timed_out.is_set():
+            raise DeviceTimeout('Command timed out: {}'.format(' '.join(cmd)))
+        if proc.returncode != 0 or not size or n not in (size, size + 4):
+            raise AdbError('Failed to read the raw screen ({} of {} bytes).'.format(n, size))
+
+        rgba = raw[n - size:n].reshape(h, w, 4)
+        frame = self.pool.get('frame', (h, w, 3))
+        cv.cvtColor(rgba, cv.COLOR_RGBA2BGR, dst=frame)
+        return frame
+
+    def start_stream(self, source: Union[List[str], str] = None, bit_rate: int = STREAM_BIT_RATE) -> 'ScreenStream':
+        """
+        Start recording the screen continuously, for the `STREAM` capturing method.
+        A running stream is stopped first.
+
+        :param source: the H.264 stream to decode instead of the screen recording: a file, or a command line
+            writing it to stdout.
+        :param bit_rate: the bit rate of the screen recording.
+        :return: the stream.
+        """
+        self.stop_stream()
+        if source is None:
+            source = self.__adb() + ['exec-out', 'screenrecord', '--output-format=h264',
+                                     '--size', '{}x{}'.format(*self.size), '--bit-rate', str(bit_rate), '-']
+        self.stream = ScreenStream(source, pool=self.pool, timeout=self.timeout)
+        self.stream.start()
+        return self.stream
+
+    def stop_stream(self):
+        """
+        Stop the screen stream, if any.
+        """
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream = None
+
+    def benchmark_capture(self, rounds: int = 5, duration: float = 2.0) -> Dict[str, dict]:
+        """
+        Measure the latency and throughput of every capturing method.
+
+        :param rounds: the number of timed captures per method.
+        :param duration: the seconds of back-to-back captures per method to measure the throughput.
+        :return: the stats of each method by name: 'latency' (mean seconds per capture), 'min' and 'max'
+            latency, and 'fps' (captures per second sustained over `duration`). The methods that fail are left out.
+        """
+        stats = {}
+        for name, method in self.CAPTURE_METHODS.items():
+            times = []
+            try:
+                # the first capture warms up the method and is not counted
+                self.capture(method)
+                for _ in range(rounds):
+                    start = time()
+                    self.capture(method)
+                    times.append(time() - start)
+
+                count = 0
+                start = time()
+                while count == 0 or time() - start < duration:
+                    self.capture(method)
+                    count += 1
+                fps = count / (time() - start)
+            except DeviceError as e:
+                self.logger.warning('Capturing method {} failed: {}'.format(name, e))
+                continue
+            latency = sum(times) / len(times)
+            stats[name] = {'latency': latency, 'min': min(times), 'max': max(times), 'fps': fps}
+            self.logger.info('Capturing method {}: {:.3f} sec per capture, {:.1f} fps.'.format(name, latency, fps))
+        self.capture_stats = stats
+        return stats
+
+    def select_capture(self, rounds: int = 5, cache: Path = CAPTURE_CACHE, refresh: bool = False,
+                       duration: float = 2.0) -> int:
+        """
+        Choose the fastest capturing method of the device, used by `AUTO`.
+
+        The choice is stored per device serial in `cache`, so the benchmark only runs once per device.
+
+        :param rounds: the number of captures per method in the benchmark.
+        :param cache: the path to the file of the stored results.
+        :param refresh: if set True, run the benchmark even if a result is stored.
+        :param duration: the seconds of back-to-back captures per method in the benchmark.
+        :return: the chosen method.
+        """
+        serial = self.serial()
+        results = {}
+        if cache.is_file():
+            with open(str(cache)) as f:
+                results = json.load(f)
+
+        if refresh or serial not in results:
+            stats = self.benchmark_capture(rounds, duration)
+            if not stats:
+                raise AdbError('No capturing method works.')
+            best = min(stats, key=lambda name: stats[name]['latency'])
+            results[serial] = {'method': best, 'stats': stats}
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            with open(str(cache), 'w') as f:
+                json.dump(results, f, indent=2)
+        else:
+            self.capture_stats = results[serial]['stats']
+
+        name = results[serial]['method']
+        self.capture_method = self.CAPTURE_METHODS[name]
+        self.logger.info('Capturing method {} selected for device {}.'.format(name, serial))
+        return self.capture_method
 
     def capture(self, method=FROM_SHELL) -> Union[np.ndarray, None]:
         """
         Capture the screen.
 
+        :param method: the capturing method. `AUTO` uses the fastest method, see `select_capture`.
         :return: a cv2 image as numpy ndarray
+        :raise AdbError: if the screen cannot be decoded.
         """
+        if method == self.AUTO:
+            if self.capture_method is None:
+                self.select_capture()
+            method = self.capture_method
+
         if method == self.FROM_SHELL:
             self.logger.debug('Capturing screen from shell...')
             img = self.__run_cmd(['shell', 'screencap -p'], raw=True)
             img = self.__png_sanitize(img)
             img = np.frombuffer(img, np.uint8)
             img = cv.imdecode(img, cv.IMREAD_COLOR)
-            return img
         elif method == self.SDCARD_PULL:
             self.logger.debug('Capturing screen from sdcard pull...')
             self.__run_cmd(['shell', 'screencap -p /sdcard/sc.png'])
             self.__run_cmd(['pull', '/sdcard/sc.png', './sc.png'])
             img = cv.imread('./sc.png', cv.IMREAD_COLOR)
-            return img
+        elif method == self.EXEC_OUT:
+            self.logger.debug('Capturing screen from exec-out...')
+            img = self.__run_cmd(['exec-out', 'screencap -p'], raw=True)
+            img = np.frombuffer(img, np.uint8)
+            img = cv.imdecode(img, cv.IMREAD_COLOR)
+        elif method == self.RAW:
+            self.logger.debug('Capturing raw screen from exec-out...')
+            img = self.__capture_raw()
+        elif method == self.STREAM:
+            if self.stream is None or self.stream.failed:
+                self.start_stream()
+            img = self.stream.latest()
         else:
             self.logger.error('Unsupported screen capturing method.')
             return None
+        if img is None:
+            raise AdbError('Failed to decode the screen.')
+        return img
+
+
+class TapWorker(threading.Thread):
+    """
+    A background worker that streams taps into a region at a given rate.
+    """
+
+    def __init__(self, device: Device, x: int, y: int, w: int, h: int, rate: float = 5.0, burst: int = 1):
+        """
+
+        :param device: the device to tap on.
+        :param x: the top x coord of the region in pixels.
+        :param y: the left y coord of the region in pixels.
+        :param w: the width of the region in pixels.
+        :param h: the height of the region in pixels.
+        :param rate: the number of taps per second.
+        :param burst: the number of taps sent with a single adb command.
+        """
+        super().__init__(daemon=True)
+        self.logger = logging.getLogger('device')
+        self.device = device
+        self.region = (x, y, w, h)
+        self.rate = rate
+        self.burst = burst
+
+        # the number of taps sent
+        self.count = 0
+
+        self.__running = threading.Event()
+        self.__stopped = threading.Event()
+        # held while a tap command is in flight
+        self.__lock = threading.Lock()
+
+    def pause(self):
+        """
+        Stop tapping until `resume` is called. Return after the tap in flight, if any, is done.
+        """
+        self.__running.clear()
+        with self.__lock:
+            pass
+
+    def resume(self):
+        """
+        Start or continue tapping.
+        """
+        self.__running.set()
+
+    def stop(self):
+        """
+        Stop the worker and wait for it to exit.
+        """
+        self.__stopped.set()
+        self.__running.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        x, y, w, h = self.region
+        period = self.burst / self.rate
+        self.logger.debug('Tap worker started at {:.1f} taps per second.'.format(self.rate))
+        while True:
+            self.__running.wait()
+            if self.__stopped.is_set():
+                break
+            start = time()
+            points = [(randint(x, x + w - 1), randint(y, y + h - 1)) for _ in range(self.burst)]
+            with self.__lock:
+                if not self.__running.is_set() or self.__stopped.is_set():
+                    continue
+                if self.burst == 1:
+                    self.device.tap(*points[0])
+                else:
+                    self.device.tap_seq(points)
+                self.count += self.burst
+            self.__stopped.wait(max(0.0, period - (time() - start)))
+        self.logger.debug('Tap worker stopped after {} taps.'.format(self.count))
+
+
+class ScreenStream:
+    """
+    A continuous capture of the screen from an H.264 stream, e.g. `adb exec-out screenrecord`.
+
+    A background thread relays the stream to OpenCV's FFmpeg backend through a local TCP socket, and another
+    decodes it, so that the latest frame is always at hand. The recording only sends frames when the screen
+    changes, and stops after a time limit (3 minutes), so the command is run again when it ends.
+    A frame is only decoded once the next one starts arriving, which takes a frame period while the screen
+    animates, but holds back the last change of a still screen.
+    A file is decoded as fast as possible, and its last frame stays available after it ends.
+    """
+
+    def __init__(self, source: Union[List[str], str], pool: BufferPool = None, timeout: float = 30,
+                 max_restarts: int = 3):
+        """
+
+        :param source: the command line writing the stream to stdout, or the path to a file of it.
+        :param pool: the pool of the frames returned by `latest`. If not given, a new one is created.
+        :param timeout: the seconds to wait for the first frame.
+        :param max_restarts: the max number of times in a row the command is run again without any frame decoded.
+        """
+        self.logger = logging.getLogger('device')
+        self.source = source
+        self.pool = pool or BufferPool()
+        self.timeout = timeout
+        self.max_restarts = max_restarts
+
+        # the number of frames decoded, and the time of the last one
+        self.frames = 0
+        self.frame_time = 0.0
+        # the reason the stream stopped, if it could not be restarted
+        self.error = ''
+
+        self.__proc = None  # type: subprocess.Popen
+        self.__frame = None  # type: np.ndarray
+        self.__cond = threading.Condition()
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    @property
+    def failed(self) -> bool:
+        """
+        Whether the stream stopped with an error.
+        """
+        return bool(self.error)
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop the stream and wait for the threads to exit.
+        """
+        self.__stopped.set()
+        self.__kill()
+        if self.__thread.is_alive():
+            self.__thread.join()
+
+    def __kill(self):
+        proc = self.__proc
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+
+    def latest(self) -> np.ndarray:
+        """
+        Return the latest frame, waiting for the first one if needed.
+
+        The frame is copied into a frame of the pool, so the previous `pool.depth - 1` frames stay valid.
+
+        :return: the frame in BGR.
+        :raise AdbError: if the stream stopped before any frame.
+        :raise DeviceTimeout: if no frame came in time.
+        """
+        with self.__cond:
+            self.__cond.wait_for(lambda: self.__frame is not None or self.failed, self.timeout)
+            if self.__frame is None:
+                if self.failed:
+                    raise AdbError(self.error)
+                raise DeviceTimeout('No frame from the screen stream in {} sec.'.format(self.timeout))
+            frame = self.pool.get('frame', self.__frame.shape)
+            np.copyto(frame, self.__frame)
+        return frame
+
+    def __open(self):
+        """
+        Return the stream as a binary file.
+        """
+        if isinstance(self.source, str):
+            return open(self.source, 'rb')
+        self.logger.debug('Executing command: {}'.format(' '.join(self.source)))
+        self.__proc = subprocess.Popen(self.source, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return self.__proc.stdout
+
+    def __relay(self, server: socket.socket, stream):
+        """
+        Send the stream to the decoder, as it arrives.
+        """
+        try:
+            conn, _ = server.accept()
+        except OSError as e:
+            self.logger.error('The decoder did not connect to the screen stream: {}'.format(e))
+            self.__kill()
+            return
+        with conn:
+            try:
+                while not self.__stopped.is_set():
+                    chunk = stream.read1(1 << 16)
+                    if not chunk:
+                        break
+                    conn.sendall(chunk)
+            except OSError as e:
+                self.logger.debug('Screen stream relay stopped: {}'.format(e))
+
+    def __decode(self, url: str) -> int:
+        """
+        Decode the stream until it ends, publishing every frame.
+
+        :return: the number of frames decoded.
+        """
+        # the options are only set while opening, so that other captures of the process are not affected
+        with _stream_open_lock:
+            previous = os.environ.get('OPENCV_FFMPEG_CAPTURE_OPTIONS')
+            os.environ['OPENCV_FFMPEG_CAPTURE_OPTIONS'] = STREAM_OPTIONS
+            try:
+                cap = cv.VideoCapture(url, cv.CAP_FFMPEG)
+            finally:
+                if previous is None:
+                    del os.environ['OPENCV_FFMPEG_CAPTURE_OPTIONS']
+                else:
+                    os.environ['OPENCV_FFMPEG_CAPTURE_OPTIONS'] = previous
+        n = 0
+        # the frame being decoded into, swapped with the published one
+        back = None
+        try:
+            while not self.__stopped.is_set() and cap.grab():
+                ok, back = cap.retrieve(back)
+                if not ok:
+                    continue
+                with self.__cond:
+                    self.__frame, back = back, self.__frame
+                    self.frames += 1
+                    self.frame_time = time()
+                    self.__cond.notify_all()
+                n += 1
+        finally:
+            cap.release()
+        return n
+
+    def __run(self):
+        restarts = 0
+        while not self.__stopped.is_set():
+            try:
+                stream = self.__open()
+            except OSError as e:
+                self.error = 'Failed to open the screen stream: {}'.format(e)
+                break
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                server.bind(('127.0.0.1', 0))
+                server.listen(1)
+                server.settimeout(self.timeout)
+                relay = threading.Thread(target=self.__relay, args=(server, stream), daemon=True)
+                relay.start()
+                n = self.__decode('tcp://127.0.0.1:{}'.format(server.getsockname()[1]))
+                self.__kill()
+                relay.join()
+            finally:
+                server.close()
+                stream.close()
+            self.logger.debug('Screen stream ended after {} frames.'.format(n))
+
+            if isinstance(self.source, str):
+                if not self.frames:
+                    self.error = 'No frame decoded from {}.'.format(self.source)
+                break
+            restarts = 0 if n else restarts + 1
+            if restarts > self.max_restarts:
+                self.error = 'The screen stream failed {} times in a row.'.format(restarts)
+                break
+            # wait a moment before restarting a failing command
+            self.__stopped.wait(0.5 * restarts)
+        if self.error:
+            self.logger.error(self.error)
+        with self.__cond:
+            self.__cond.notify_all()
@@ -0,0 +1,187 @@
+"""
+Digit recognition on fixed screen regions.
+"""
+
+import logging
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import cv2 as cv
+import numpy as np
+
+logger = logging.getLogger('digits')
+
+# the characters that can be recognized
+GLYPHS = '0123456789/'
+
+# the size (width, height) every glyph is normalized to
+GLYPH_SIZE = (12, 18)
+
+
+def glyph_file(c: str) -> str:
+    """
+    Return the file name of the mask of a glyph.
+    """
+    return '{}.png'.format('slash' if c == '/' else c)
+
+
+class DigitReader:
+    """
+    A reader of white digits, such as the wave counter and the AP, based on binary glyph masks.
+
+    The masks are loaded from `digits/0.png` ... `digits/9.png` and `digits/slash.png` in the template image
+    directory. They are cut from screenshots of the game showing known digits, see `add_glyphs` and
+    `python -m gamebots.calibrate --digits`. Nothing is read until every glyph has a mask, so the callers
+    fall back to other means instead of misreading.
+    """
+
+    def __init__(self, mode: int = 0, threshold: int = 200, min_score: float = 0.9):
+        """
+
+        :param mode: the template image set to load the glyphs from.
+        :param threshold: the gray level above which a pixel belongs to a digit.
+        :param min_score: the min ratio of matching pixels to accept a glyph.
+        """
+        self.threshold = threshold
+        self.min_score = min_score
+        self.glyph_dir = Path(__file__).absolute().parent / 'images{}'.format(mode) / 'digits'
+
+        # glyph masks in shape (len(GLYPHS), h, w), and whether each glyph has one
+        self.masks = np.zeros((len(GLYPHS), GLYPH_SIZE[1], GLYPH_SIZE[0]), dtype=bool)
+        self.loaded = np.zeros(len(GLYPHS), dtype=bool)
+        self.__load_masks()
+
+    @property
+    def ready(self) -> bool:
+        """
+        Whether every glyph has a mask, so that the reader can be used.
+        """
+        return bool(self.loaded.all())
+
+    @property
+    def missing(self) -> List[str]:
+        """
+        The glyphs without a mask.
+        """
+        return [c for c, loaded in zip(GLYPHS, self.loaded) if not loaded]
+
+    def __load_masks(self):
+        """
+        Load the glyph masks found in the glyph directory.
+        """
+        for c in GLYPHS:
+            path = self.glyph_dir / glyph_file(c)
+            if path.is_file():
+                self.add_glyph(c, cv.imread(str(path), cv.IMREAD_GRAYSCALE) > self.threshold)
+        if self.ready:
+            logger.debug('Glyph masks loaded.')
+        else:
+            logger.debug('No glyph mask for {}, digits are not read.'.format(' '.join(self.missing)))
+
+    def add_glyph(self, c: str, mask: np.ndarray):
+        """
+        Set the mask of a glyph.
+
+        :param c: the character, in `GLYPHS`.
+        :param mask: the binary image of the glyph.
+        """
+        i = GLYPHS.index(c)
+        self.masks[i] = self.__normalize(mask)
+        self.loaded[i] = True
+
+    def add_glyphs(self, image: np.ndarray, roi: Tuple[int, int, int, int], text: str) -> Dict[str, np.ndarray]:
+        """
+        Cut the masks of the glyphs from a region of a screenshot showing known characters.
+
+        :param image: the screenshot, in BGR.
+        :param roi: the region (x, y, w, h) of the characters.
+        :param text: the characters shown, e.g. '1/3'.
+        :return: the binary image (0 or 255) of each character cut. Return an empty dict if the region does not
+            split into as many glyphs as `text` has characters, or if it cuts through a glyph, e.g. when it is off.
+        """
+        binary = self.__binarize(image, roi)
+        segments = self.__segment(binary)
+        if len(segments) != len(text):
+            logger.error('Found {} glyphs in region {} for {} characters.'.format(len(segments), roi, len(text)))
+            return {}
+        if binary[0].any() or binary[-1].any() or binary[:, 0].any() or binary[:, -1].any():
+            logger.error('Region {} cuts through the glyphs.'.format(roi))
+            return {}
+        glyphs = {}
+        for c, segment in zip(text, segments):
+            glyphs[c] = segment.astype(np.uint8) * 255
+            self.add_glyph(c, segment)
+        return glyphs
+
+    @staticmethod
+    def __normalize(mask: np.ndarray) -> np.ndarray:
+        """
+        Crop a binary glyph to its bounding box and resize it to `GLYPH_SIZE`.
+        """
+        ys, xs = np.nonzero(mask)
+        if len(xs) == 0:
+            return np.zeros(GLYPH_SIZE[::-1], dtype=bool)
+        mask = mask[ys.min():ys.max() + 1, xs.min():xs.max() + 1].astype(np.uint8) * 255
+        return cv.resize(mask, GLYPH_SIZE, interpolation=cv.INTER_AREA) > 127
+
+    @staticmethod
+    def __segment(binary: np.ndarray) -> List[np.ndarray]:
+        """
+        Split a binary image into glyphs, one per connected component, from left to right. Unlike splitting by the
+        empty columns, glyphs that share columns, such as a slash leaning over the next digit, are kept apart.
+
+        :return: the binary image of each glyph, cropped to its bounding box.
+        """
+        n, labels, stats, _ = cv.connectedComponentsWithStats(binary.astype(np.uint8), connectivity=8)
+        segments = []
+        for i in sorted(range(1, n), key=lambda i: stats[i, cv.CC_STAT_LEFT]):
+            x, y, w, h = stats[i, :4]
+            segments.append(labels[y:y + h, x:x + w] == i)
+        return segments
+
+    def __binarize(self, image: np.ndarray, roi: Tuple[int, int, int, int]) -> np.ndarray:
+        """
+        Return the pixels of a region that belong to the digits.
+        """
+        x, y, w, h = roi
+        return cv.cvtColor(image[y:y + h, x:x + w], cv.COLOR_BGR2GRAY) > self.threshold
+
+    def read(self, image: np.ndarray, roi: Tuple[int, int, int, int]) -> str:
+        """
+        Read the characters in a region of an image.
+
+        :param image: the image, in BGR.
+        :param roi: the region (x, y, w, h).
+        :return: the characters read. Return '' if any glyph cannot be recognized, or if the reader is not ready.
+        """
+        if not self.ready:
+            return ''
+        binary = self.__binarize(image, roi)
+
+        segments = self.__segment(binary)
+        if not segments:
+            return ''
+        glyphs = np.stack([self.__normalize(segment) for segment in segments])
+
+        # (glyphs, masks) ratio of matching pixels, in one pass
+        scores = (glyphs[:, None] == self.masks[None]).mean(axis=(2, 3))
+        best = scores.argmax(axis=1)
+        best_scores = scores[np.arange(len(best)), best]
+        text = ''.join(GLYPHS[i] for i in best)
+        logger.debug('Read {} with scores {}'.format(text, best_scores))
+        if (best_scores < self.min_score).any():
+            return ''
+        return text
+
+    def read_fraction(self, image: np.ndarray, roi: Tuple[int, int, int, int]) -> Tuple[int, int]:
+        """
+        Read a fraction such as '1/3' in a region of an image.
+
+        :param image: the image, in BGR.
+        :param roi: the region (x, y, w, h).
+        :return: the numerator and the denominator. Return (-1, -1) if failed.
+        """
+        parts = self.read(image, roi).split('/')
+        if len(parts) != 2 or not parts[0] or not parts[1]:
+            return -1, -1
+        return int(parts[0]), int(parts[1])
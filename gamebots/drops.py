@@ -0,0 +1,124 @@
+"""
+Counting the drops on the battle result screen, in the background.
+"""
+
+import csv
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import strftime
+from typing import Dict, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from .tm import match_all
+
+logger = logging.getLogger('drops')
+
+
+class DropCounter:
+    """
+    A counter of the items dropped in each battle.
+
+    Drop screens are handed to a pool of background workers, which count every item icon of a template library
+    on them and append one row per run to a CSV log. Submitting a screen never blocks.
+    """
+
+    def __init__(self,
+                 item_dir: str,
+                 log_path: str = 'drops.csv',
+                 threshold: float = 0.9,
+                 roi: Tuple[int, int, int, int] = None,
+                 ap_cost: int = 0,
+                 workers: int = 2
+                 ):
+        """
+
+        :param item_dir: the directory of the item icons (in png format), named after the items.
+        :param log_path: the path to the CSV log. Rows are appended if it exists.
+        :param threshold: the threshold of matching of the icons.
+        :param roi: the region of the drop screen holding the items (x, y, w, h). If not given, use the whole screen.
+        :param ap_cost: the AP cost of the quest, logged with each run.
+        :param workers: the number of background workers.
+        """
+        self.threshold = threshold
+        self.roi = roi
+        self.ap_cost = ap_cost
+        self.script = Path(sys.argv[0]).name
+
+        self.items = {}  # type: Dict[str, np.ndarray]
+        for im in sorted(Path(item_dir).glob('*.png')):
+            self.items[im.name[:-4]] = cv.imread(str(im), cv.IMREAD_COLOR)
+        logger.info('{} item icons loaded.'.format(len(self.items)))
+
+        self.log_path = Path(log_path).absolute()
+        self.__columns = ['time', 'script', 'run', 'ap_cost'] + list(self.items)
+        self.__lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        self.__futures = []
+
+        # the number of runs submitted
+        self.runs = 0
+
+    def submit(self, frame: np.ndarray):
+        """
+        Queue a drop screen to be counted.
+
+        :param frame: the drop screen, in BGR. A copy is made.
+        """
+        self.runs += 1
+        row = {
+            'time': strftime('%Y-%m-%d %H:%M:%S'),
+            'script': self.script,
+            'run': self.runs,
+            'ap_cost': self.ap_cost
+        }
+        self.__futures = [f for f in self.__futures if not f.done()]
+        self.__futures.append(self.__executor.submit(self.__count, frame.copy(), row))
+
+    def flush(self):
+        """
+        Wait until all the queued drop screens are counted.
+        """
+        for f in self.__futures:
+            f.result()
+        self.__futures = []
+
+    def close(self):
+        """
+        Count the queued drop screens and stop the workers.
+        """
+        self.__executor.shutdown(wait=True)
+
+    def __count(self, frame: np.ndarray, row: dict):
+        """
+        Count the items on a drop screen and append the result to the log.
+        """
+        try:
+            self.__count_items(frame, row)
+        except Exception:
+            logger.exception('Failed to count the drops of run {}.'.format(row['run']))
+
+    def __count_items(self, frame: np.ndarray, row: dict):
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            frame = frame[y:y + h, x:x + w]
+        for name, icon in self.items.items():
+            row[name] = len(match_all(frame, icon, self.threshold))
+        logger.debug('Run {} drops: {}'.format(row['run'], row))
+
+        with self.__lock:
+            columns = self.__columns
+            new = not self.log_path.is_file()
+            if not new:
+                # keep the columns of the existing log
+                with open(str(self.log_path), newline='') as f:
+                    columns = next(csv.reader(f), columns)
+            with open(str(self.log_path), 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+                if new:
+                    writer.writeheader()
+                writer.writerow(row)
@@ -0,0 +1,438 @@
+"""
+The shared engine of the bots.
+
+The engine owns the device, the template matcher and the capture -> match -> act loop.
+Routines such as battles or mailbox sorting are implemented as tasks that run on an engine,
+so every improvement made to the loop applies to all of them.
+"""
+
+import json
+import logging
+from copy import copy
+from functools import partial
+from pathlib import Path
+from random import randint
+from time import sleep, time
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+
+from .device import Device
+from .digits import DigitReader
+from .screens import ScreenClassifier
+from .tm import TM, frame_diff
+
+logger = logging.getLogger('engine')
+
+INTERVAL_SHORT = 1
+INTERVAL_MID = 10
+INTERVAL_LONG = 25
+
+# the mean difference above which the screen is considered changed
+CHANGE_DIFF = 8.0
+# the mean difference below which two consecutive frames are considered the same
+STABLE_DIFF = 1.0
+
+# the seconds to wait for a tap to show on screen before tapping again
+TAP_TIMEOUT = 1.0
+# the margin around a tapped region that is compared to acknowledge the tap, in pixels
+TAP_MARGIN = 20
+
+
+class ScreenError(Exception):
+    """
+    The screen is not the one expected, e.g. an image waited for does not appear.
+    """
+
+
+# the engines shared by the bots created without one, by mode, see `share_engines`
+_shared_engines = None  # type: Dict[int, Engine]
+# the device of the shared engines
+_shared_device = None  # type: Device
+
+
+class Engine:
+    """
+    A class that drives the capture -> match -> act loop for the tasks.
+    """
+
+    def __init__(self,
+                 mode: int = 0,
+                 threshold: float = 0.85,
+                 device: Device = None,
+                 capture_method: int = Device.FROM_SHELL,
+                 match_server: str = None
+                 ):
+        """
+
+        :param mode: the template image set to use.
+        :param threshold: the default threshold of matching.
+        :param device: the device to control. If not given, a new one is created.
+        :param capture_method: the screen capturing method of the device. `Device.AUTO` benchmarks the methods once
+            per device and uses the fastest, see `Device.select_capture`.
+        :param match_server: the address of the matching service to match with, see `matchserver`.
+            If not given, or if it cannot be reached, match in this process.
+        """
+        self.mode = mode
+        # the default threshold of matching, for the images without one in the manifest, see `with_threshold`
+        self.threshold = threshold
+
+        # Device
+        self.device = device or Device()
+
+        # Matching service client
+        client = None
+        if match_server:
+            try:
+                # imported here, as the service needs Python 3.8 while matching locally does not
+                from .matchserver import MatchClient
+                client = MatchClient(match_server, mode=self.mode)
+            except (ImportError, OSError) as e:
+                logger.warning('Cannot reach the matching service on {}, match locally: {}'.format(match_server, e))
+
+        # Template matcher, sharing the buffer pool of the device
+        self.tm = TM(feed=partial(self.device.capture, method=capture_method), threshold=threshold, mode=self.mode,
+                     pool=self.device.pool, client=client)
+
+        # Digit reader
+        self.digits = DigitReader(mode=self.mode)
+
+        # Screen classifier
+        self.screens = ScreenClassifier(mode=self.mode)
+
+        # Load button coords from config
+        btn_path = Path(__file__).absolute().parent / 'config' / 'buttons.json'
+        with open(btn_path) as f:
+            self.buttons = json.load(f)
+
+        # The tasks registered on this engine
+        self.tasks = {}  # type: Dict[str, Task]
+
+        # The max seconds `wait_until` waits when no timeout is given, and the loops of the tasks wait for a screen,
+        # after which they raise `ScreenError`, see `deadline`. None to wait forever.
+        self.wait_timeout = None  # type: float
+
+        logger.debug('Engine initialized.')
+
+    def button(self, btn: str) -> Tuple[int, int, int, int]:
+        """
+        Return the button coords and size.
+
+        :param btn: the name of button
+        :return: (x, y, w, h)
+        """
+        btn = self.buttons[btn]
+        return btn['x'], btn['y'], btn['w'], btn['h']
+
+    def swipe(self, track: str):
+        """
+        Swipe in given track.
+
+        :param track: the name of the track in the button config.
+        """
+        x1, y1, x2, y2 = map(lambda x: x + randint(-5, 5), self.buttons['swipe'][track])
+        self.device.swipe((x1, y1), (x2, y2))
+
+    def find_and_tap(self, im: str, threshold: float = None, roi: Tuple[int, int, int, int] = None) -> bool:
+        """
+        Find the given image on screen and tap.
+
+        :param im: the name of image
+        :param threshold: the matching threshold
+        :param roi: the region to search in (x, y, w, h). If not given, search the whole screen.
+        :return: whether successful
+        """
+        x, y = self.tm.find(im, threshold=self.tm.get_threshold(im, threshold, self.threshold), roi=roi)
+        if (x, y) == (-1, -1):
+            logger.warning('Failed to find image {} on screen.'.format(im))
+            return False
+        w, h = self.tm.getsize(im)
+        return self.device.tap_rand(x, y, w, h)
+
+    def tap_and_confirm(self, x: int, y: int, w: int, h: int, roi: Tuple[int, int, int, int] = None,
+                        retries: int = 2, interval: float = 0.05, timeout: float = TAP_TIMEOUT,
+                        diff: float = CHANGE_DIFF) -> bool:
+        """
+        Tap in a region and wait until the screen around it changes, tapping again if it does not.
+
+        The current screen is the reference, so it should be fresh. Fresh frames are captured until the region
+        differs from it, so the call returns as soon as the game responds.
+
+        :param x: the top x coord in pixels.
+        :param y: the left y coord in pixels.
+        :param w: the width in pixels.
+        :param h: the height in pixels.
+        :param roi: the region to compare (x, y, w, h). If not given, the tapped region with a margin of
+            `TAP_MARGIN` pixels.
+        :param retries: the max number of taps after the first one.
+        :param interval: the seconds between two captures.
+        :param timeout: the seconds to wait for a change after each tap.
+        :param diff: the mean difference above which the region is considered changed.
+        :return: whether the screen changed.
+        """
+        if roi is None:
+            x0, y0 = max(x - TAP_MARGIN, 0), max(y - TAP_MARGIN, 0)
+            x1 = min(x + w + TAP_MARGIN, self.device.size[0])
+            y1 = min(y + h + TAP_MARGIN, self.device.size[1])
+            roi = (x0, y0, x1 - x0, y1 - y0)
+        if self.tm.screen is None:
+            self.tm.update_screen()
+        ref = self.tm.crop(roi)
+
+        for attempt in range(retries + 1):
+            self.device.tap_rand(x, y, w, h)
+            start = time()
+            while time() - start < timeout:
+                self.wait(interval)
+                if frame_diff(ref, self.tm.crop(roi)) > diff:
+                    logger.debug('Tap acknowledged in {:.2f} sec after {} taps.'.format(time() - start, attempt + 1))
+                    return True
+            logger.debug('Tap at ({}, {}, {}, {}) not acknowledged.'.format(x, y, w, h))
+        logger.warning('The screen did not respond to {} taps.'.format(retries + 1))
+        return False
+
+    def find_and_confirm(self, im: str, threshold: float = None, roi: Tuple[int, int, int, int] = None,
+                         **kwargs) -> bool:
+        """
+        Find the given image on screen, tap it and wait until the screen around it changes.
+        See `tap_and_confirm`.
+
+        :param im: the name of image
+        :param threshold: the matching threshold
+        :param roi: the region to search in (x, y, w, h). If not given, search the whole screen.
+        :param kwargs: the options of `tap_and_confirm`.
+        :return: whether the image was found and the tap acknowledged.
+        """
+        x, y = self.tm.find(im, threshold=self.tm.get_threshold(im, threshold, self.threshold), roi=roi)
+        if (x, y) == (-1, -1):
+            logger.warning('Failed to find image {} on screen.'.format(im))
+            return False
+        w, h = self.tm.getsize(im)
+        return self.tap_and_confirm(x, y, w, h, **kwargs)
+
+    def exists(self, im: str, threshold: float = None, roi: Tuple[int, int, int, int] = None) -> bool:
+        """
+        Check if a given image exists on screen.
+
+        :param im: the name of the image
+        :param threshold: threshold of matching
+        :param roi: the region to search in (x, y, w, h). If not given, search the whole screen.
+        """
+        return self.tm.exists(im, threshold=self.tm.get_threshold(im, threshold, self.threshold), roi=roi)
+
+    def with_threshold(self, threshold: float) -> 'Engine':
+        """
+        Return a view of the engine with another default threshold of matching.
+
+        The view shares the device and the template matcher with the engine, but has its own tasks and settings,
+        so that bots of different thresholds can run on one engine.
+
+        :param threshold: the default threshold of matching.
+        :return: the view.
+        """
+        engine = copy(self)
+        engine.threshold = threshold
+        engine.tasks = {}
+        return engine
+
+    def wait(self, sec: float):
+        """
+        Wait some seconds and update the screen feed.
+
+        :param sec: the seconds to wait
+        """
+        logger.debug('Sleep {} seconds.'.format(sec))
+        sleep(sec)
+        self.tm.update_screen()
+
+    def wait_until(self, im: str, threshold: float = None, roi: Tuple[int, int, int, int] = None,
+                   interval: float = INTERVAL_SHORT, timeout: float = None) -> bool:
+        """
+        Wait until the given image appears. Useful when try to use skills, etc.
+
+        :param im: the name of the image
+        :param threshold: threshold of matching
+        :param roi: the region to search in (x, y, w, h). If not given, search the whole screen.
+        :param interval: the seconds between two captures.
+        :param timeout: the max seconds to wait. If not given, wait until the image appears, or for `wait_timeout`.
+        :return: whether the image appeared before timeout.
+        :raise ScreenError: if no timeout is given and the image does not appear in `wait_timeout`.
+        """
+        logger.debug("Wait until image '{}' appears.".format(im))
+        limit = self.wait_timeout if timeout is None else timeout
+        deadline = None if limit is None else time() + limit
+        self.tm.update_screen()
+        while not self.exists(im, threshold=threshold, roi=roi):
+            if deadline is not None and time() >= deadline:
+                if timeout is None:
+                    raise ScreenError("Image '{}' did not appear in {} seconds.".format(im, limit))
+                logger.debug("Image '{}' did not appear in {} seconds.".format(im, timeout))
+                return False
+            self.wait(interval)
+            if self.exists('reconnect'):
+                self.find_and_tap('reconnect')
+        return True
+
+    def deadline(self) -> float:
+        """
+        Return the time by which a loop waiting for a screen must be done, i.e. in `wait_timeout`.
+        Return None if there is no limit.
+        """
+        return None if self.wait_timeout is None else time() + self.wait_timeout
+
+    def check_deadline(self, deadline: float, what: str):
+        """
+        Check that a loop waiting for a screen is within its deadline, see `deadline`.
+
+        :param deadline: the deadline of the loop.
+        :param what: what the loop waits for, for the error message.
+        :raise ScreenError: if the deadline has passed.
+        """
+        if deadline is not None and time() >= deadline:
+            raise ScreenError('{} did not happen in {} seconds.'.format(what, self.wait_timeout))
+
+    def __region(self, roi: Tuple[int, int, int, int] = None) -> np.ndarray:
+        """
+        Return a copy of the screen, or a region of it.
+        """
+        if roi is None:
+            return self.tm.screen.copy()
+        return self.tm.crop(roi)
+
+    def wait_change(self, ref: np.ndarray = None, roi: Tuple[int, int, int, int] = None,
+                    interval: float = 0.2, timeout: float = INTERVAL_MID, diff: float = CHANGE_DIFF) -> bool:
+        """
+        Wait until the screen, or a region of it, changes.
+
+        :param ref: the reference image. If not given, use the current screen.
+        :param roi: the region to compare (x, y, w, h). If not given, compare the whole screen.
+        :param interval: the seconds between two captures.
+        :param timeout: the max seconds to wait.
+        :param diff: the mean difference above which the screen is considered changed.
+        :return: whether the screen changed before timeout.
+        """
+        if ref is None:
+            ref = self.__region(roi)
+        deadline = time() + timeout
+        while time() < deadline:
+            self.wait(interval)
+            if frame_diff(ref, self.__region(roi)) > diff:
+                return True
+        logger.debug('Screen did not change in {} seconds.'.format(timeout))
+        return False
+
+    def wait_stable(self, roi: Tuple[int, int, int, int] = None,
+                    interval: float = 0.2, timeout: float = INTERVAL_MID, diff: float = STABLE_DIFF) -> bool:
+        """
+        Wait until the screen, or a region of it, stops changing, e.g. when an animation is over.
+
+        :param roi: the region to compare (x, y, w, h). If not given, compare the whole screen.
+        :param interval: the seconds between two captures.
+        :param timeout: the max seconds to wait.
+        :param diff: the mean difference below which two consecutive frames are considered the same.
+        :return: whether the screen became stable before timeout.
+        """
+        self.tm.update_screen()
+        prev = self.__region(roi)
+        deadline = time() + timeout
+        while time() < deadline:
+            self.wait(interval)
+            cur = self.__region(roi)
+            if frame_diff(prev, cur) < diff:
+                return True
+            prev = cur
+        logger.debug('Screen did not become stable in {} seconds.'.format(timeout))
+        return False
+
+    def add_task(self, name: str, task: 'Task'):
+        """
+        Register a task on the engine.
+
+        :param name: the name of the task
+        :param task: the task
+        """
+        self.tasks[name] = task
+        logger.debug('Task {} registered.'.format(name))
+
+    def run_task(self, name: str, *args, **kwargs):
+        """
+        Run a registered task.
+
+        :param name: the name of the task
+        :return: the return value of the task
+        """
+        logger.info('Running task {}.'.format(name))
+        return self.tasks[name].run(*args, **kwargs)
+
+
+def share_engines(enabled: bool = True, device: Device = None):
+    """
+    Make the bots created without an engine share one engine per template image set, instead of creating their
+    own. Running several bots one after another in a process then sets up the device and loads the templates once.
+
+    :param enabled: whether to share the engines. If set False, the shared engines are dropped.
+    :param device: the device of the shared engines. If not given, the one created by the first engine.
+    """
+    global _shared_engines, _shared_device
+    _shared_engines = {} if enabled else None
+    _shared_device = device if enabled else None
+
+
+def get_engine(mode: int = 0, threshold: float = 0.85) -> Engine:
+    """
+    Return a new engine, or the shared one of the mode if engines are shared (see `share_engines`).
+
+    :param mode: the template image set to use.
+    :param threshold: the default threshold of matching. A shared engine is viewed with it, see `with_threshold`.
+    :return: the engine.
+    """
+    global _shared_device
+    if _shared_engines is None:
+        return Engine(mode=mode, threshold=threshold)
+    if mode not in _shared_engines:
+        _shared_engines[mode] = Engine(mode=mode, threshold=threshold, device=_shared_device)
+        _shared_device = _shared_engines[mode].device
+    return _shared_engines[mode].with_threshold(threshold)
+
+
+class Task:
+    """
+    Base class of the routines that run on an engine.
+    """
+
+    # the name the task is registered with
+    name = 'task'
+
+    def __init__(self, engine: Engine):
+        """
+
+        :param engine: the engine to run on.
+        """
+        self.engine = engine
+        self.engine.add_task(self.name, self)
+
+        # called with the number of iterations done after each of them, see `checkpoint`
+        self.on_checkpoint = None  # type: Callable[[int], None]
+
+    @property
+    def device(self) -> Device:
+        return self.engine.device
+
+    @property
+    def tm(self) -> TM:
+        return self.engine.tm
+
+    def checkpoint(self, done: int):
+        """
+        Report the progress of the task, e.g. to save it (see `jobs`). Called after each iteration.
+
+        :param done: the number of iterations done in this run of the task.
+        """
+        if self.on_checkpoint is not None:
+            self.on_checkpoint(done)
+
+    def run(self, *args, **kwargs):
+        """
+        Run the task.
+        """
+        raise NotImplementedError
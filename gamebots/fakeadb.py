@@ -0,0 +1,202 @@
+"""
+A fake adb executable for running the bots without a device.
+
+Run it as `python -m gamebots.fakeadb <adb arguments>`, e.g. by creating the device with
+`Device(adb_path=[sys.executable, '-m', 'gamebots.fakeadb'])`. The package must be importable by the child process.
+
+The state of the fake device is kept in the directory given by the `FGO_FAKE_ADB` environment variable
+(`./fakeadb` by default):
+
+- `screen.png`: the screen returned by screencap. A black screen is returned if missing.
+- `screen.h264`: the stream returned by screenrecord, which then waits to be killed as if the screen were still.
+- `taps.log`: every tap and swipe received, one per line.
+- `commands.log`: every command received, one per line.
+- `connected`: the addresses connected to with `connect`, listed by `devices` until `disconnect` or `kill-server`.
+- `fail`: failures to inject, one per line, each consumed by one command:
+  `error` makes the command fail as if the device were offline, `hang` makes it never return.
+"""
+
+import os
+import shutil
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+import cv2 as cv
+import numpy as np
+
+SERIAL = 'fake-0'
+SIZE = (1280, 720)
+
+
+def state_dir() -> Path:
+    """
+    Return the state directory of the fake device.
+    """
+    path = Path(os.environ.get('FGO_FAKE_ADB', 'fakeadb')).absolute()
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def inject(kind: str, count: int = 1):
+    """
+    Queue failures for the next commands.
+
+    :param kind: 'error' or 'hang'.
+    :param count: the number of commands to fail.
+    """
+    with open(str(state_dir() / 'fail'), 'a') as f:
+        f.write('{}\n'.format(kind) * count)
+
+
+def set_screen(image: np.ndarray):
+    """
+    Set the screen of the fake device.
+
+    :param image: the screen, in BGR.
+    """
+    cv.imwrite(str(state_dir() / 'screen.png'), image)
+
+
+def taps() -> List[str]:
+    """
+    Return the taps and swipes received so far.
+    """
+    path = state_dir() / 'taps.log'
+    if not path.is_file():
+        return []
+    return path.read_text().splitlines()
+
+
+def commands() -> List[str]:
+    """
+    Return the commands received so far.
+    """
+    path = state_dir() / 'commands.log'
+    if not path.is_file():
+        return []
+    return path.read_text().splitlines()
+
+
+def _connected(state: Path) -> List[str]:
+    path = state / 'connected'
+    return path.read_text().split() if path.is_file() else []
+
+
+def _set_connected(state: Path, addrs: List[str]):
+    (state / 'connected').write_text(''.join(addr + '\n' for addr in addrs))
+
+
+def _pop_failure(state: Path) -> str:
+    path = state / 'fail'
+    if not path.is_file():
+        return ''
+    lines = path.read_text().splitlines()
+    if not lines:
+        return ''
+    path.write_text(''.join(line + '\n' for line in lines[1:]))
+    return lines[0].strip()
+
+
+def _screen_png(state: Path) -> bytes:
+    path = state / 'screen.png'
+    if path.is_file():
+        return path.read_bytes()
+    _, buf = cv.imencode('.png', np.zeros((SIZE[1], SIZE[0], 3), dtype=np.uint8))
+    return buf.tobytes()
+
+
+def _screen_raw(state: Path) -> bytes:
+    image = cv.imdecode(np.frombuffer(_screen_png(state), np.uint8), cv.IMREAD_COLOR)
+    h, w = image.shape[:2]
+    # width, height, format (RGBA_8888) and color space, as newer versions output
+    header = struct.pack('<IIII', w, h, 1, 0)
+    return header + cv.cvtColor(image, cv.COLOR_BGR2RGBA).tobytes()
+
+
+def _shell(state: Path, cmd: str, translate: bool = True) -> bytes:
+    out = b''
+    for part in cmd.split(';'):
+        args = part.split()
+        if not args:
+            continue
+        if args[:2] == ['wm', 'size']:
+            out += 'Physical size: {}x{}\n'.format(*SIZE).encode()
+        elif args[:2] == ['screencap', '-p'] and len(args) == 3:
+            (state / 'sdcard').mkdir(exist_ok=True)
+            (state / 'sdcard' / Path(args[2]).name).write_bytes(_screen_png(state))
+        elif args[:2] == ['screencap', '-p']:
+            out += _screen_png(state)
+        elif args == ['screencap']:
+            out += _screen_raw(state)
+        elif args[:1] == ['input'] and args[1:2] in (['tap'], ['swipe']):
+            with open(str(state / 'taps.log'), 'a') as f:
+                f.write(' '.join(args[1:]) + '\n')
+        else:
+            out += '/system/bin/sh: {}: not found\n'.format(args[0]).encode()
+    # the shell of old adb versions translates '\n' to '\r\n', exec-out does not
+    return out.replace(b'\n', b'\r\n') if translate else out
+
+
+def main(argv: List[str]) -> int:
+    state = state_dir()
+    with open(str(state / 'commands.log'), 'a') as f:
+        f.write(' '.join(argv) + '\n')
+
+    failure = _pop_failure(state)
+    if failure == 'hang':
+        time.sleep(3600)
+    elif failure == 'error':
+        sys.stderr.write('error: device offline\n')
+        return 1
+
+    if not argv:
+        return 1
+    if argv[0] == 'connect':
+        _set_connected(state, [addr for addr in _connected(state) if addr != argv[1]] + [argv[1]])
+        out = 'connected to {}\n'.format(argv[1]).encode()
+    elif argv[0] == 'disconnect':
+        if argv[1] not in _connected(state):
+            sys.stderr.write("error: no such device '{}'\n".format(argv[1]))
+            return 1
+        _set_connected(state, [addr for addr in _connected(state) if addr != argv[1]])
+        out = 'disconnected {}\n'.format(argv[1]).encode()
+    elif argv[0] == 'kill-server':
+        _set_connected(state, [])
+        out = b''
+    elif argv[0] == 'reconnect':
+        out = b''
+    elif argv[0] == 'devices':
+        out = 'List of devices attached\n{}\tdevice\n'.format(SERIAL).encode()
+        out += ''.join('{}\tdevice\n'.format(addr) for addr in _connected(state)).encode()
+    elif argv[0] == 'get-serialno':
+        out = '{}\n'.format(SERIAL).encode()
+    elif argv[0] == 'pull':
+        shutil.copy(str(state / 'sdcard' / Path(argv[1]).name), argv[2])
+        out = b''
+    elif argv[0] == 'shell':
+        out = _shell(state, ' '.join(argv[1:]))
+    elif argv[:2] == ['exec-out', 'screenrecord']:
+        path = state / 'screen.h264'
+        if not path.is_file():
+            sys.stderr.write('screenrecord: no stream\n')
+            return 1
+        sys.stdout.buffer.write(path.read_bytes())
+        sys.stdout.flush()
+        time.sleep(3600)
+        return 0
+    elif argv[0] == 'exec-out':
+        out = _shell(state, ' '.join(argv[1:]), translate=False)
+    else:
+        sys.stderr.write('fakeadb: unknown command {}\n'.format(argv[0]))
+        return 1
+
+    sys.stdout.buffer.write(out)
+    sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,335 @@
+"""
+A persistent queue of bot jobs, run one after another by a worker that checkpoints their progress.
+
+Usage: python -m gamebots.jobs [--db FILE] add SCRIPT [--task TASK] [--count N] [--args JSON]
+       python -m gamebots.jobs [--db FILE] list
+       python -m gamebots.jobs [--db FILE] cancel ID
+       python -m gamebots.jobs [--db FILE] run [--connect ADDR] [--wait]
+
+A job runs a bot script, such as `bot0.py` or `sortmailbox.py`: the script is imported from its directory
+without running its `if __name__ == '__main__'` block, and the `bot` it defines is run. A `BattleBot` plays `count`
+battles under a `Supervisor`, or until it quits on its own if no count is given; the job fails if the bot quits
+before `count` battles. An `AssistBot` runs its task ('mailbox', 'gacha' or 'reward') for `count` iterations,
+with the keyword arguments of `args`; by default, the count is that of the script.
+
+The worker saves the progress of a job after every battle or iteration. A job left running by a killed worker is
+resumed first, for what it has left to do, and a battle in progress is resumed from the screen.
+The jobs of a worker share one engine per template image set (see `share_engines`), so the device and the
+templates are set up once for all of them. A queue is meant for a single worker and device: use a database
+per device to run several of them.
+"""
+
+import argparse
+import json
+import logging
+import os
+import runpy
+import sqlite3
+from collections import namedtuple
+from pathlib import Path
+from time import time, sleep, strftime, localtime
+from typing import List
+
+from .bot import BattleBot, AssistBot, ENTER
+from .device import Device
+from .engine import Task, share_engines
+from .supervisor import Supervisor
+
+logger = logging.getLogger('jobs')
+
+# the default location of the database
+JOBS_DB = Path.home() / '.fgo-bot' / 'jobs.db'
+
+# the status of a job
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# the tasks of a job
+BATTLE = 'battle'
+ASSIST_TASKS = ('mailbox', 'gacha', 'reward')
+
+# the number of battles of a battle job without a count, as in `BattleBot.run`
+MAX_LOOPS = 999
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    script TEXT NOT NULL,
+    task TEXT NOT NULL,
+    count INTEGER,
+    args TEXT NOT NULL,
+    status TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    updated REAL,
+    error TEXT
+);
+'''
+
+# a job of the queue. args: the keyword arguments of the task, as a dict.
+Job = namedtuple('Job', ['id', 'created', 'script', 'task', 'count', 'args', 'status', 'done', 'updated', 'error'])
+
+
+class JobQueue:
+    """
+    A queue of jobs in a SQLite database, shared by the command line and the worker.
+    """
+
+    def __init__(self, path: str = str(JOBS_DB)):
+        """
+
+        :param path: the path to the database. It is created if missing.
+        """
+        self.path = Path(path).absolute()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.__db = sqlite3.connect(str(self.path))
+        self.__db.executescript(SCHEMA)
+
+    def add(self, script: str, task: str = BATTLE, count: int = None, args: dict = None) -> int:
+        """
+        Add a job at the end of the queue.
+
+        :param script: the path to the bot script.
+        :param task: 'battle' for a `BattleBot` script, or the task of an `AssistBot` script.
+        :param count: the number of battles or iterations. If not given, use that of the script.
+        :param args: the keyword arguments of the task of an `AssistBot`, e.g. {"stream": true}.
+        :return: the id of the job.
+        """
+        assert task == BATTLE or task in ASSIST_TASKS, 'Unknown task {}'.format(task)
+        cur = self.__db.execute(
+            'INSERT INTO jobs (created, script, task, count, args, status) VALUES (?, ?, ?, ?, ?, ?)',
+            (time(), str(Path(script).absolute()), task, count, json.dumps(args or {}), QUEUED))
+        self.__db.commit()
+        logger.info('Job {} added: {} {}.'.format(cur.lastrowid, task, script))
+        return cur.lastrowid
+
+    @staticmethod
+    def __job(row: tuple) -> Job:
+        return Job(*row[:5], json.loads(row[5]), *row[6:])
+
+    def jobs(self, status: str = None) -> List[Job]:
+        """
+        Return the jobs in order, all of them or those of a status.
+        """
+        if status is None:
+            rows = self.__db.execute('SELECT * FROM jobs ORDER BY id')
+        else:
+            rows = self.__db.execute('SELECT * FROM jobs WHERE status = ? ORDER BY id', (status,))
+        return [self.__job(row) for row in rows.fetchall()]
+
+    def next(self) -> Job:
+        """
+        Take the next job to run and mark it running: a job left running, else the first one queued.
+
+        :return: the job, with the status it had. Return None if there is none.
+        """
+        jobs = self.jobs(RUNNING) or self.jobs(QUEUED)
+        if not jobs:
+            return None
+        self.__update(jobs[0].id, status=RUNNING)
+        return jobs[0]
+
+    def checkpoint(self, job_id: int, done: int):
+        """
+        Save the number of battles or iterations done by a job.
+        """
+        self.__update(job_id, done=done)
+
+    def set_count(self, job_id: int, count: int):
+        self.__update(job_id, count=count)
+
+    def finish(self, job_id: int, status: str = DONE, error: str = None):
+        """
+        Mark a job done or failed.
+        """
+        self.__update(job_id, status=status, error=error)
+
+    def cancel(self, job_id: int) -> bool:
+        """
+        Cancel a queued job. A running job cannot be cancelled.
+
+        :return: whether the job was cancelled.
+        """
+        cur = self.__db.execute('UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND status = ?',
+                                (CANCELLED, time(), job_id, QUEUED))
+        self.__db.commit()
+        return cur.rowcount > 0
+
+    def __update(self, job_id: int, **values):
+        columns = ', '.join('{} = ?'.format(name) for name in values)
+        self.__db.execute('UPDATE jobs SET {}, updated = ? WHERE id = ?'.format(columns),
+                          list(values.values()) + [time(), job_id])
+        self.__db.commit()
+
+    def close(self):
+        self.__db.close()
+
+
+class JobWorker:
+    """
+    A worker that runs the jobs of a queue one after another, on shared engines.
+    """
+
+    def __init__(self, queue: JobQueue, addr: str = '', device: Device = None):
+        """
+
+        :param queue: the queue to run.
+        :param addr: the address to connect the device to if it is not connected, see `Device.connect`.
+        :param device: the device of the engines. If not given, a new one is created.
+        """
+        self.queue = queue
+        self.addr = addr
+        share_engines(device=device)
+
+    def run(self, wait: bool = False, interval: float = 5.0) -> int:
+        """
+        Run the jobs until the queue is empty.
+
+        :param wait: if set True, wait for new jobs instead of returning when the queue is empty.
+        :param interval: the seconds between two checks for new jobs when waiting.
+        :return: the number of jobs run.
+        """
+        n = 0
+        while True:
+            job = self.queue.next()
+            if job is None:
+                if not wait:
+                    return n
+                sleep(interval)
+                continue
+            self.run_job(job)
+            n += 1
+
+    def run_job(self, job: Job) -> bool:
+        """
+        Run a job taken from the queue, from its checkpoint if it was running.
+
+        :param job: the job.
+        :return: whether the job is done.
+        """
+        resume = job.status == RUNNING
+        logger.info('{} job {}: {} {}, {} done.'.format('Resuming' if resume else 'Starting', job.id, job.task,
+                                                        Path(job.script).name, job.done))
+        cwd = os.getcwd()
+        try:
+            # the scripts give their images relative to their directory
+            os.chdir(str(Path(job.script).parent))
+            bot = runpy.run_path(job.script, run_name='__job__').get('bot')
+            if self.addr and not bot.device.connected():
+                bot.device.connect(self.addr)
+            if job.task == BATTLE:
+                error = self.__battle(job, bot, resume)
+            else:
+                error = self.__assist(job, bot)
+        except KeyboardInterrupt:
+            # left running, to be resumed
+            raise
+        except Exception as e:
+            logger.exception('Job {} failed.'.format(job.id))
+            self.queue.finish(job.id, FAILED, '{}: {}'.format(type(e).__name__, e))
+            return False
+        finally:
+            os.chdir(cwd)
+        if error:
+            logger.error('Job {} failed: {}'.format(job.id, error))
+            self.queue.finish(job.id, FAILED, error)
+            return False
+        self.queue.finish(job.id)
+        logger.info('Job {} done.'.format(job.id))
+        return True
+
+    def __track(self, job: Job, task: Task):
+        """
+        Save the progress of the job after each iteration of its task.
+        """
+        task.on_checkpoint = lambda done: self.queue.checkpoint(job.id, job.done + done)
+
+    def __battle(self, job: Job, bot: BattleBot, resume: bool) -> str:
+        """
+        Run a battle job.
+
+        :return: the reason the job failed. Return '' if it is done.
+        """
+        assert isinstance(bot, BattleBot), 'The script has no BattleBot named bot.'
+        self.__track(job, bot)
+        state = ENTER
+        if resume:
+            state = bot.locate() or ENTER
+            logger.info('Resuming from state {}.'.format(state))
+        ok = Supervisor(bot).run((job.count or MAX_LOOPS) - job.done, state=state, resume=resume)
+        # back to the menu, where the next job enters its quest
+        bot.leave()
+        if not ok:
+            return 'The bot gave up.'
+        done = job.done + bot.count
+        if job.count and done < job.count:
+            return 'The bot quit after {} of {} battles.'.format(done, job.count)
+        return ''
+
+    def __assist(self, job: Job, bot: AssistBot) -> str:
+        """
+        Run an assist job.
+
+        :return: the reason the job failed. Return '' if it is done.
+        """
+        assert isinstance(bot, AssistBot), 'The script has no AssistBot named bot.'
+        task = {'mailbox': bot.mailbox, 'gacha': bot.gacha, 'reward': bot.reward}[job.task]
+        count = job.count or task.n_iter
+        self.queue.set_count(job.id, count)
+        self.__track(job, task)
+        task.n_iter = count - job.done
+        if task.n_iter > 0:
+            task.run(**job.args)
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Queue and run bot jobs.')
+    parser.add_argument('--db', default=str(JOBS_DB), help='the path to the database')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    add = commands.add_parser('add', help='add a job')
+    add.add_argument('script', help='the bot script')
+    add.add_argument('--task', default=BATTLE, choices=(BATTLE,) + ASSIST_TASKS,
+                     help='battle for a BattleBot, the task to run for an AssistBot')
+    add.add_argument('--count', type=int, help='the number of battles or iterations')
+    add.add_argument('--args', default='{}', help='the keyword arguments of the task, as JSON')
+    commands.add_parser('list', help='list the jobs')
+    cancel = commands.add_parser('cancel', help='cancel a job')
+    cancel.add_argument('id', type=int)
+    run = commands.add_parser('run', help='run the jobs')
+    run.add_argument('--connect', default='', help='the address to connect the device to, e.g. 127.0.0.1:5555')
+    run.add_argument('--wait', action='store_true', help='wait for new jobs when the queue is empty')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    queue = JobQueue(args.db)
+    try:
+        if args.command == 'add':
+            if not Path(args.script).is_file():
+                raise SystemExit('No script at {}.'.format(args.script))
+            print(queue.add(args.script, args.task, args.count, json.loads(args.args)))
+        elif args.command == 'list':
+            for job in queue.jobs():
+                print('{:4d}  {:9s}  {:7s}  {:>4}/{:<4}  {}  {}  {}'.format(
+                    job.id, job.status, job.task, job.done, '' if job.count is None else job.count,
+                    strftime('%Y-%m-%d %H:%M', localtime(job.updated or job.created)), job.script,
+                    job.error or ''))
+        elif args.command == 'cancel':
+            if not queue.cancel(args.id):
+                raise SystemExit('Job {} is not queued.'.format(args.id))
+        else:
+            try:
+                n = JobWorker(queue, args.connect).run(wait=args.wait)
+                logger.info('{} jobs run.'.format(n))
+            except KeyboardInterrupt:
+                logger.info('Interrupted. The job in progress resumes on the next run.')
+    finally:
+        queue.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+"""
+A local template matching service shared by the bots of a host.
+
+Usage: python -m gamebots.matchserver [--address ADDRESS] [--workers N]
+
+The server holds the template images of every image set, and matches the screens sent by the clients on a fixed
+pool of worker processes, which caps the CPU used for matching on the host. Each request carries all the templates
+to match on a screen; they are spread over the pool, and the requests of all the clients are served in order of
+arrival. The screen of a client is handed to the workers through shared memory, and so are the templates a client
+loads, once when it sends them. Each worker converts every template it matches once, whether of an image set or of
+a client.
+
+Only the user running the server can use it: it listens on a socket in the user's `~/.fgo-bot` directory, readable
+by the user only, and the clients must know the random key kept in `~/.fgo-bot/match.key`. The messages are JSON
+headers followed by raw image bytes, so nothing received is unpickled.
+
+A template matcher uses the service when created with a `MatchClient`, see `TM`.
+"""
+
+import argparse
+import getpass
+import json
+import logging
+import multiprocessing as mp
+import os
+import secrets
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener, Connection
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from .tm import best_match, prepare
+
+logger = logging.getLogger('matchserver')
+
+# the directory of the socket and the key, readable by the user only
+RUN_DIR = Path.home() / '.fgo-bot'
+
+# the default address of the service: a named pipe on Windows, a Unix socket elsewhere
+if sys.platform == 'win32':
+    DEFAULT_ADDRESS = r'\\.\pipe\fgo-bot-match-{}'.format(getpass.getuser())
+else:
+    DEFAULT_ADDRESS = str(RUN_DIR / 'match.sock')
+
+# the file of the key the clients must know, created by the server
+KEY_FILE = RUN_DIR / 'match.key'
+
+# a matching query: the name of the template, the region (x, y, w, h) or None, the method, gray and scale
+Query = Tuple[str, Tuple[int, int, int, int], str, bool, float]
+
+# a template loaded by a client, in shared memory: its unique key, the name of the shared memory and its shape
+SharedImage = Tuple[str, str, Tuple[int, int, int]]
+
+# the converted templates in a worker process, by (mode or the key of the client template, name, gray, scale)
+_templates = {}  # type: Dict[tuple, np.ndarray]
+
+
+def load_authkey(path: Path = KEY_FILE, create: bool = False) -> bytes:
+    """
+    Read the key of the service.
+
+    :param path: the path to the key file.
+    :param create: if set True, create the key file with a random key if missing, readable by the user only.
+    :return: the key.
+    :raise OSError: if the key file cannot be read.
+    """
+    if create and not path.is_file():
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        try:
+            fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+    return path.read_text().strip().encode()
+
+
+def _send(conn: Connection, header: dict, payload=None):
+    """
+    Send a message: a JSON header, followed by raw bytes if any.
+    """
+    conn.send_bytes(json.dumps(header).encode())
+    if payload is not None:
+        conn.send_bytes(payload)
+
+
+def _recv(conn: Connection) -> dict:
+    """
+    Receive the JSON header of a message.
+
+    :raise OSError: if the header is malformed.
+    """
+    try:
+        header = json.loads(conn.recv_bytes(1 << 20).decode())
+    except ValueError as e:
+        raise OSError('Malformed message: {}'.format(e)) from e
+    if not isinstance(header, dict):
+        raise OSError('Malformed message.')
+    return header
+
+
+def _init_worker():
+    cv.setNumThreads(1)
+
+
+def _template(mode: int, name: str, gray: bool, scale: float, shared: SharedImage = None) -> np.ndarray:
+    """
+    Return a template converted for matching, loaded and converted once per worker.
+    Return None if the image set has no such template.
+
+    :param shared: the template loaded by the client, which takes precedence over the image set. None if not any.
+    """
+    key = (shared[0] if shared else mode, name, gray, scale)
+    if key not in _templates:
+        if shared:
+            block = SharedMemory(name=shared[1])
+            try:
+                image = np.ndarray(shared[2], np.uint8, block.buf).copy()
+            finally:
+                block.close()
+        else:
+            path = Path(__file__).absolute().parent / 'images{}'.format(mode) / '{}.png'.format(name)
+            image = cv.imread(str(path), cv.IMREAD_COLOR) if path.is_file() else None
+        _templates[key] = None if image is None else prepare(image, gray, scale)
+    return _templates[key]
+
+
+def _match(shm: str, offset: int, shape: tuple, mode: int, shared: SharedImage,
+           query: Query) -> Tuple[float, Tuple[int, int]]:
+    """
+    Match a template against a screen in shared memory, in a worker process.
+
+    :param shm: the name of the shared memory holding the converted screen.
+    :param offset: the offset of the converted screen in the shared memory.
+    :param shape: the shape of the converted screen.
+    :param mode: the image set of the client.
+    :param shared: the template loaded by the client, which takes precedence over the image set. None if not any.
+    :param query: the template and how to match it.
+    :return: the matching value and the top-left coords of the best match, in screen coords.
+        Return None if the template is unknown.
+    """
+    name, roi, method, gray, scale = query
+    template = _template(mode, name, gray, scale, shared)
+    if template is None:
+        return None
+    block = SharedMemory(name=shm)
+    try:
+        screen = np.ndarray(shape, np.uint8, block.buf, offset)
+        result = best_match(screen, template, method, roi, scale)
+        del screen
+        return result
+    finally:
+        block.close()
+
+
+class MatchServer:
+    """
+    The matching service. See the module docstring.
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, workers: int = 2, authkey: bytes = None):
+        """
+
+        :param address: the address to listen on.
+        :param workers: the number of matching processes, i.e. the max number of cores used.
+        :param authkey: the key the clients must know. If not given, the one of the key file, created if missing.
+        """
+        self.address = address
+        self.authkey = authkey or load_authkey(create=True)
+        self.workers = workers
+        self.__executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn'),
+                                              initializer=_init_worker)
+        self.__listener = None  # type: Listener
+        self.__lock = threading.Lock()
+        # the number of templates loaded by the clients, which makes their keys unique
+        self.__images = 0
+
+        # the number of templates matched
+        self.matches = 0
+
+    def serve_forever(self):
+        """
+        Accept clients until interrupted or closed, serving each of them on its own thread.
+        """
+        if sys.platform != 'win32':
+            Path(self.address).parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        with Listener(self.address, authkey=self.authkey) as listener:
+            self.__listener = listener
+            if sys.platform != 'win32':
+                os.chmod(self.address, 0o600)
+            logger.info('Matching service listening on {} with {} workers.'.format(self.address, self.workers))
+            while True:
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError, AuthenticationError) as e:
+                    logger.warning('Failed to accept a client: {}'.format(e))
+                    continue
+                if self.__listener is None:
+                    conn.close()
+                    break
+                threading.Thread(target=self.__serve, args=(conn,), daemon=True).start()
+
+    def close(self):
+        """
+        Stop accepting clients and stop the workers.
+        """
+        listener, self.__listener = self.__listener, None
+        if listener is not None:
+            # wake up the accepting thread, which then closes the listener
+            try:
+                Client(self.address, authkey=self.authkey).close()
+            except OSError:
+                pass
+        if sys.version_info >= (3, 9):
+            self.__executor.shutdown(cancel_futures=True)
+        else:
+            self.__executor.shutdown()
+
+    def __serve(self, conn: Connection):
+        """
+        Serve the requests of a client until it disconnects.
+        """
+        mode = 0
+        # the screen of the client, converted for matching, in shared memory: (offset, shape) by (gray, scale)
+        block = None  # type: SharedMemory
+        screen = None  # type: np.ndarray
+        prepared = {}  # type: Dict[tuple, Tuple[int, tuple]]
+        # the templates loaded by the client, which take precedence over the image set, and their shared memory
+        images = {}  # type: Dict[str, SharedImage]
+        blocks = {}  # type: Dict[str, SharedMemory]
+        try:
+            while True:
+                request = _recv(conn)
+                op = request.get('op')
+                if op == 'hello':
+                    mode = int(request['mode'])
+                elif op == 'screen':
+                    h, w, c = (int(v) for v in request['shape'])
+                    data = conn.recv_bytes()
+                    if len(data) != h * w * c:
+                        raise OSError('Screen of {} bytes, expected {}.'.format(len(data), h * w * c))
+                    screen = np.frombuffer(data, np.uint8).reshape((h, w, c))
+                    prepared = {}
+                elif op == 'image':
+                    image = cv.imdecode(np.frombuffer(conn.recv_bytes(), np.uint8), cv.IMREAD_COLOR)
+                    if image is not None:
+                        name = str(request['name'])
+                        images[name] = self.__share_image(image, blocks, name)
+                elif op == 'match':
+                    queries = [(str(name), tuple(int(v) for v in roi) if roi else None, str(method), bool(gray),
+                                float(scale)) for name, roi, method, gray, scale in request['queries']]
+                    if screen is None:
+                        raise OSError('No screen to match on.')
+                    if not prepared:
+                        block = self.__share(block, screen, {(q[3], q[4]) for q in queries}, prepared)
+                    elif any((q[3], q[4]) not in prepared for q in queries):
+                        keys = set(prepared) | {(q[3], q[4]) for q in queries}
+                        prepared.clear()
+                        block = self.__share(block, screen, keys, prepared)
+                    futures = [self.__executor.submit(_match, block.name, *prepared[q[3], q[4]], mode,
+                                                      images.get(q[0]), q) for q in queries]
+                    results = [f.result() for f in futures]
+                    with self.__lock:
+                        self.matches += sum(r is not None for r in results)
+                    _send(conn, {'results': [r or (0.0, (-1, -1)) for r in results]})
+                else:
+                    logger.error('Unexpected request {}'.format(op))
+                    _send(conn, {'error': 'unexpected request'})
+        except (EOFError, OSError, KeyError, TypeError, ValueError) as e:
+            logger.debug('Client disconnected: {}'.format(e))
+        finally:
+            conn.close()
+            for b in [block] + list(blocks.values()):
+                if b is not None:
+                    b.close()
+                    b.unlink()
+
+    def __share_image(self, image: np.ndarray, blocks: Dict[str, SharedMemory], name: str) -> SharedImage:
+        """
+        Copy a template loaded by a client to shared memory, replacing the previous one of the same name.
+
+        :param image: the template.
+        :param blocks: the shared memory of the templates of the client, by name.
+        :param name: the name of the template.
+        :return: the template in shared memory, with a key unique to the server so that the workers convert it anew.
+        """
+        if name in blocks:
+            blocks[name].close()
+            blocks[name].unlink()
+        block = blocks[name] = SharedMemory(create=True, size=image.nbytes)
+        np.ndarray(image.shape, np.uint8, block.buf)[...] = image
+        with self.__lock:
+            self.__images += 1
+            key = 'client-{}'.format(self.__images)
+        return key, block.name, image.shape
+
+    @staticmethod
+    def __share(block: SharedMemory, screen: np.ndarray, keys: set,
+                prepared: Dict[tuple, Tuple[int, tuple]]) -> SharedMemory:
+        """
+        Convert a screen for matching in every way asked, and copy the results to shared memory.
+
+        :param block: the shared memory of the client, reused if large enough.
+        :param screen: the screen.
+        :param keys: the conversions (gray, scale).
+        :param prepared: filled with the offset and the shape of each converted screen.
+        :return: the shared memory holding the converted screens.
+        """
+        converted = {key: prepare(screen, *key) for key in keys}
+        size = sum(image.nbytes for image in converted.values())
+        if block is None or block.size < size:
+            if block is not None:
+                block.close()
+                block.unlink()
+            block = SharedMemory(create=True, size=size)
+        offset = 0
+        for key, image in converted.items():
+            np.ndarray(image.shape, np.uint8, block.buf, offset)[...] = image
+            prepared[key] = (offset, image.shape)
+            offset += image.nbytes
+        return block
+
+
+class MatchClient:
+    """
+    A client of the matching service, used by a template matcher.
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, mode: int = 0, authkey: bytes = None):
+        """
+
+        :param address: the address of the service.
+        :param mode: the template image set to match with.
+        :param authkey: the key of the service. If not given, the one of the key file.
+        :raise OSError: if the service cannot be reached.
+        """
+        self.__conn = Client(address, authkey=authkey or load_authkey())
+        _send(self.__conn, {'op': 'hello', 'mode': mode})
+        logger.info('Connected to the matching service on {}.'.format(address))
+
+    def load_image(self, name: str, image: np.ndarray):
+        """
+        Send a template image, overriding the one of the image set if any.
+        """
+        _, buf = cv.imencode('.png', image)
+        _send(self.__conn, {'op': 'image', 'name': name}, buf)
+
+    def set_screen(self, screen: np.ndarray):
+        """
+        Send the screen to match on.
+        """
+        screen = np.ascontiguousarray(screen)
+        _send(self.__conn, {'op': 'screen', 'shape': screen.shape}, memoryview(screen).cast('B'))
+
+    def match(self, queries: List[Query]) -> List[Tuple[float, Tuple[int, int]]]:
+        """
+        Match templates against the screen.
+
+        :param queries: the templates and how to match each of them.
+        :return: the matching value and the top-left coords of the best match of each template, in screen coords.
+        :raise OSError: if the service fails.
+        """
+        _send(self.__conn, {'op': 'match', 'queries': queries})
+        reply = _recv(self.__conn)
+        if 'results' not in reply:
+            raise OSError('The matching service failed: {}'.format(reply.get('error')))
+        return [(float(val), (int(loc[0]), int(loc[1]))) for val, loc in reply['results']]
+
+    def close(self):
+        self.__conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve template matching to the bots of this host.')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help='the Unix socket or named pipe to listen on')
+    parser.add_argument('--workers', type=int, default=2, help='the number of matching processes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if sys.platform != 'win32' and Path(args.address).exists():
+        Path(args.address).unlink()
+    server = MatchServer(args.address, args.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
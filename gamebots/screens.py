@@ -0,0 +1,112 @@
+"""
+Whole-screen recognition from downsampled signatures.
+
+A signature is a tiny thumbnail of the screen, so comparing two screens costs a resize and a dot product. It tells
+when a screen stops changing, and which of a few known screens, such as the battle result screens, is shown.
+"""
+
+import logging
+from pathlib import Path
+from typing import Tuple
+
+import cv2 as cv
+import numpy as np
+
+logger = logging.getLogger('screens')
+
+# the size (width, height) of a signature
+SIGNATURE_SIZE = (32, 18)
+
+# the max distance between the signatures of two consecutive frames of a still screen
+STABLE_DISTANCE = 0.002
+
+
+def signature(image: np.ndarray) -> np.ndarray:
+    """
+    Return the signature of a screen: a tiny grayscale thumbnail with zero mean and unit norm.
+
+    :param image: the screen, in BGR.
+    :return: the signature as a flat float32 array.
+    """
+    gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    sig = cv.resize(gray, SIGNATURE_SIZE, interpolation=cv.INTER_AREA).astype(np.float32).ravel()
+    sig -= sig.mean()
+    norm = np.linalg.norm(sig)
+    return sig / norm if norm > 0 else sig
+
+
+def distance(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    Return the distance of two signatures, in [0, 2].
+    """
+    return float(1 - a.dot(b))
+
+
+class ScreenClassifier:
+    """
+    A classifier of whole screens, such as the battle result screens, by nearest signature.
+
+    The reference screens are loaded from the `screens` directory in the template image directory, with the file
+    name up to the first dot as the screen name, e.g. `bond.2.png` (see `calibrate`). More are added while running
+    with `learn`, e.g. when a screen is told apart by its buttons.
+    """
+
+    def __init__(self, mode: int = 0, max_distance: float = 0.15, max_references: int = 8):
+        """
+
+        :param mode: the template image set to load the reference screens from.
+        :param max_distance: the max distance to a reference screen to be classified as it.
+        :param max_references: the max number of reference screens of a name added by `learn`.
+        """
+        self.max_distance = max_distance
+        self.max_references = max_references
+
+        self.names = []
+        # the signatures of the reference screens, one row each
+        self.signatures = np.zeros((0, SIGNATURE_SIZE[0] * SIGNATURE_SIZE[1]), dtype=np.float32)
+
+        self.screen_dir = Path(__file__).absolute().parent / 'images{}'.format(mode) / 'screens'
+        for im in sorted(self.screen_dir.glob('*.png')):
+            self.add(im.name[:-4].split('.')[0], cv.imread(str(im), cv.IMREAD_COLOR))
+        logger.debug('{} reference screens loaded.'.format(len(self.names)))
+
+    def add(self, name: str, image: np.ndarray):
+        """
+        Add a reference screen.
+
+        :param name: the name of the screen. Several references may share a name.
+        :param image: the screen, in BGR.
+        """
+        self.names.append(name)
+        self.signatures = np.vstack([self.signatures, signature(image)])
+
+    def learn(self, name: str, image: np.ndarray) -> bool:
+        """
+        Add a screen known by other means as a reference, unless it is already classified as such or there are
+        enough references of the name.
+
+        :param name: the name of the screen.
+        :param image: the screen, in BGR.
+        :return: whether the screen is added.
+        """
+        if self.classify(image)[0] == name or self.names.count(name) >= self.max_references:
+            return False
+        self.add(name, image)
+        logger.debug("Learned a reference of screen '{}'.".format(name))
+        return True
+
+    def classify(self, image: np.ndarray) -> Tuple[str, float]:
+        """
+        Classify a screen.
+
+        :param image: the screen, in BGR.
+        :return: the name of the nearest reference screen and the distance to it.
+            Return '' as the name if no reference screen is near enough.
+        """
+        if not self.names:
+            return '', 2.0
+        dists = 1 - self.signatures.dot(signature(image))
+        i = int(dists.argmin())
+        if dists[i] > self.max_distance:
+            return '', float(dists[i])
+        return self.names[i], float(dists[i])
@@ -0,0 +1,395 @@
+"""
+A simulated device that plays the battle loop with synthetic screens, for load testing without emulators.
+
+Usage: python -m gamebots.simulator [--bots N] [--loops N] [--stages N] [--mode 0] [--latency SEC]
+                                    [--noise N] [--reconnect-rate P]
+
+The screens are composed of the template images of the chosen set over a smooth random background, and change
+as the bot taps: menu -> support -> party -> battle waves -> results -> continue -> support -> ...
+Every bot runs in its own process with its own simulated device. The bots keep their real waits, so the CPU
+time measured is the one of a real run.
+"""
+
+import argparse
+import json
+import logging
+import tempfile
+import threading
+from multiprocessing import Pool
+from pathlib import Path
+from time import time, sleep, process_time
+from typing import Dict, List, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from .device import Device
+
+logger = logging.getLogger('simulator')
+
+# states of the simulated game
+MENU = 'menu'
+SUPPORT = 'support'
+PARTY = 'party'
+BATTLE = 'battle'
+CARDS = 'cards'
+BOND = 'bond'
+DROPS = 'drops'
+FRIEND_REQUEST = 'friend_request'
+CONT = 'cont'
+
+# the top-left coords of the images shown on the screens
+LAYOUT = {
+    'menu': (1150, 10),
+    'quest': (700, 200),
+    'refresh_friends': (798, 110),
+    'friend': (100, 250),
+    'start_quest': (1100, 640),
+    'attack': (1075, 580),
+    'next_step': (1000, 640),
+    'not_apply': (300, 600),
+    'cont': (700, 550),
+    'close': (450, 550),
+    'reconnect': (600, 450),
+}
+
+# the images shown on each screen
+SCREENS = {
+    MENU: ['menu', 'quest'],
+    SUPPORT: ['refresh_friends', 'friend'],
+    PARTY: ['start_quest'],
+    BATTLE: ['attack'],
+    CARDS: [],
+    BOND: [],
+    DROPS: ['next_step'],
+    FRIEND_REQUEST: ['not_apply'],
+    CONT: ['close', 'cont'],
+}
+
+# the screens reached through the network, after which the reconnect dialog may show up
+NETWORK_SCREENS = (SUPPORT, BOND)
+
+# the colors (BGR) of the command cards
+CARD_COLORS = ((40, 40, 220), (220, 90, 30), (40, 200, 40))
+
+# the number of noise frames cycled through
+N_NOISE = 4
+
+
+class SimDevice(Device):
+    """
+    A device that simulates the battle loop of the game.
+
+    Taps take effect after `latency` seconds, during which further taps are ignored. After the screens reached
+    through the network, the reconnect dialog may show up, and must be dismissed before anything else.
+    """
+
+    def __init__(self,
+                 mode: int = 0,
+                 stage_count: int = 3,
+                 turns: int = 1,
+                 latency: float = 0.2,
+                 capture_latency: float = 0.03,
+                 noise: int = 4,
+                 reconnect_rate: float = 0.0,
+                 ap: Tuple[int, int] = (140, 142),
+                 seed: int = None,
+                 **kwargs
+                 ):
+        """
+
+        :param mode: the template image set to draw the screens with.
+        :param stage_count: the number of waves of the quest.
+        :param turns: the number of turns to clear a wave.
+        :param latency: the seconds between a tap and the screen change.
+        :param capture_latency: the seconds a capture takes.
+        :param noise: the max value of the noise added to each pixel.
+        :param reconnect_rate: the probability of the reconnect dialog after a screen reached through the network.
+        :param ap: the current and max AP shown on the menu.
+        :param seed: the seed of the random screens.
+        :param kwargs: the options of `Device`.
+        """
+        super().__init__(**kwargs)
+        self.logger = logging.getLogger('simulator')
+        self.stage_count = stage_count
+        self.turns = turns
+        self.latency = latency
+        self.capture_latency = capture_latency
+        self.reconnect_rate = reconnect_rate
+        self.ap = ap
+        self.rng = np.random.RandomState(seed)
+
+        im_dir = Path(__file__).absolute().parent / 'images{}'.format(mode)
+        self.images = {im.name[:-4]: cv.imread(str(im), cv.IMREAD_COLOR) for im in im_dir.glob('*.png')}
+        self.images['quest'] = self.__pattern((320, 80))
+        self.images['friend'] = self.__pattern((200, 120))
+        btn_path = Path(__file__).absolute().parent / 'config' / 'buttons.json'
+        with open(str(btn_path)) as f:
+            self.buttons = json.load(f)
+
+        self.__backgrounds = {}  # type: Dict[str, np.ndarray]
+        self.__frames = {}  # type: Dict[tuple, np.ndarray]
+        self.__noise = [self.rng.randint(0, noise + 1, (self.size[1], self.size[0], 3)).astype(np.uint8)
+                        for _ in range(N_NOISE)]
+        self.__lock = threading.Lock()
+
+        # the state of the game
+        self.state = MENU
+        self.wave = 1
+        self.__turn = 0
+        self.__picks = 0
+        self.__cards = (0, 1, 2, 0, 1)
+        self.__reentered = False
+        self.__reconnect = False
+        # the state to switch to and when
+        self.__pending = None  # type: Tuple[float, str]
+
+        # counters
+        self.captures = 0
+        self.taps = 0
+        self.battles = 0
+
+    def __pattern(self, size: Tuple[int, int]) -> np.ndarray:
+        """
+        Return a random image with distinct features, used as the quest and friend images.
+        """
+        small = self.rng.randint(0, 256, (size[1] // 10, size[0] // 10, 3)).astype(np.uint8)
+        return cv.resize(small, size, interpolation=cv.INTER_NEAREST)
+
+    def save_images(self, directory: str) -> Tuple[str, str]:
+        """
+        Write the quest and friend images, to be given to the bot.
+
+        :param directory: the directory to write to.
+        :return: the paths to the quest and friend images.
+        """
+        paths = []
+        for name in ('quest', 'friend'):
+            path = Path(directory) / 'sim_{}.png'.format(name)
+            cv.imwrite(str(path), self.images[name])
+            paths.append(str(path))
+        return paths[0], paths[1]
+
+    def __rect(self, name: str) -> Tuple[int, int, int, int]:
+        x, y = LAYOUT[name]
+        h, w = self.images[name].shape[:2]
+        return x, y, w, h
+
+    def __button(self, name: str, i: int = 0, distance: str = '') -> Tuple[int, int, int, int]:
+        btn = self.buttons[name]
+        return btn['x'] + (self.buttons[distance] * i if distance else 0), btn['y'], btn['w'], btn['h']
+
+    @staticmethod
+    def __inside(x: int, y: int, rect: Tuple[int, int, int, int]) -> bool:
+        return rect[0] <= x < rect[0] + rect[2] and rect[1] <= y < rect[1] + rect[3]
+
+    def __background(self, state: str) -> np.ndarray:
+        if state not in self.__backgrounds:
+            small = self.rng.randint(0, 128, (9, 16, 3)).astype(np.uint8)
+            self.__backgrounds[state] = cv.resize(small, self.size, interpolation=cv.INTER_CUBIC)
+        return self.__backgrounds[state]
+
+    def __render(self) -> np.ndarray:
+        """
+        Return the screen of the current state, without noise.
+        """
+        key = (self.state, self.wave, self.__cards, self.__reconnect, self.ap)
+        if key in self.__frames:
+            return self.__frames[key]
+
+        frame = self.__background(self.state).copy()
+        for name in SCREENS[self.state]:
+            x, y, w, h = self.__rect(name)
+            frame[y:y + h, x:x + w] = self.images[name]
+        white = (255, 255, 255)
+        if self.state == MENU:
+            x, y, _, h = self.__button('ap')
+            cv.putText(frame, '{}/{}'.format(*self.ap), (x + 4, y + h - 4), cv.FONT_HERSHEY_SIMPLEX, 0.6, white, 2)
+        elif self.state == BATTLE:
+            x, y, _, h = self.__button('wave')
+            cv.putText(frame, '{}/{}'.format(self.wave, self.stage_count), (x + 4, y + h - 7),
+                       cv.FONT_HERSHEY_SIMPLEX, 0.7, white, 2)
+        elif self.state == CARDS:
+            for i, color in enumerate(self.__cards):
+                x, y, w, h = self.__button('card', i, 'card_distance')
+                cv.rectangle(frame, (x, y), (x + w - 1, y + h - 1), CARD_COLORS[color], -1)
+        if self.__reconnect:
+            x, y, w, h = self.__rect('reconnect')
+            frame[y:y + h, x:x + w] = self.images['reconnect']
+
+        if len(self.__frames) > 64:
+            self.__frames = {}
+        self.__frames[key] = frame
+        return frame
+
+    def __go(self, state: str):
+        """
+        Switch to a state after the latency.
+        """
+        self.__pending = (time() + self.latency, state)
+
+    def __update(self):
+        """
+        Apply the pending state change if due.
+        """
+        if self.__pending is None or self.__pending[0] > time():
+            return
+        self.state = self.__pending[1]
+        self.__pending = None
+        if self.state == CARDS:
+            self.__cards = tuple(int(c) for c in self.rng.randint(0, 3, 5))
+        network = self.state in NETWORK_SCREENS or (self.state == BATTLE and self.wave == 1 and self.__turn == 0)
+        if network and self.rng.random_sample() < self.reconnect_rate:
+            self.__reconnect = True
+        self.logger.debug('Screen {}'.format(self.state))
+
+    def __on_tap(self, x: int, y: int):
+        self.__update()
+        if self.__pending is not None:
+            return
+        if self.__reconnect:
+            if self.__inside(x, y, self.__rect('reconnect')):
+                self.__reconnect = False
+            return
+
+        state = self.state
+        if state == MENU and self.__inside(x, y, self.__rect('quest')):
+            self.__reentered = False
+            self.__go(SUPPORT)
+        elif state == SUPPORT and self.__inside(x, y, self.__rect('friend')):
+            if self.__reentered:
+                self.wave, self.__turn = 1, 0
+                self.__go(BATTLE)
+            else:
+                self.__go(PARTY)
+        elif state == PARTY and self.__inside(x, y, self.__rect('start_quest')):
+            self.wave, self.__turn = 1, 0
+            self.__go(BATTLE)
+        elif state == BATTLE and self.__inside(x, y, self.__rect('attack')):
+            self.__picks = 0
+            self.__go(CARDS)
+        elif state == CARDS:
+            cards = [self.__button('card', i, 'card_distance') for i in range(5)]
+            cards += [self.__button('noble_card', i, 'card_distance') for i in range(3)]
+            if any(self.__inside(x, y, rect) for rect in cards):
+                self.__picks += 1
+            if self.__picks < 3:
+                return
+            self.__turn += 1
+            if self.__turn >= self.turns:
+                self.wave, self.__turn = self.wave + 1, 0
+            if self.wave > self.stage_count:
+                self.battles += 1
+                self.__go(BOND)
+            else:
+                self.__go(BATTLE)
+        elif state == BOND:
+            self.__go(DROPS)
+        elif state == DROPS and self.__inside(x, y, self.__rect('next_step')):
+            self.__go(FRIEND_REQUEST)
+        elif state == FRIEND_REQUEST and self.__inside(x, y, self.__rect('not_apply')):
+            self.__go(CONT)
+        elif state == CONT and self.__inside(x, y, self.__rect('cont')):
+            self.__reentered = True
+            self.__go(SUPPORT)
+        elif state == CONT and self.__inside(x, y, self.__rect('close')):
+            self.__go(MENU)
+
+    def connect(self, addr: str = '127.0.0.1:62001', restart: bool = False) -> bool:
+        self.addr = addr
+        return True
+
+    def reconnect(self, restart: bool = False) -> bool:
+        return True
+
+    def connected(self) -> bool:
+        return True
+
+    def serial(self) -> str:
+        return 'sim-{}'.format(id(self))
+
+    def get_size(self) -> bool:
+        return True
+
+    def tap(self, x: int, y: int) -> bool:
+        with self.__lock:
+            self.taps += 1
+            self.__on_tap(x, y)
+        return True
+
+    def tap_seq(self, points: List[Tuple[int, int]]) -> bool:
+        for x, y in points:
+            self.tap(x, y)
+        return True
+
+    def swipe(self, pos0: Tuple[int, int], pos1: Tuple[int, int], duration: int = 500) -> bool:
+        return True
+
+    def capture(self, method=Device.FROM_SHELL) -> np.ndarray:
+        """
+        Return the simulated screen. The capturing method is ignored.
+        """
+        sleep(self.capture_latency)
+        with self.__lock:
+            self.__update()
+            self.captures += 1
+            frame = self.pool.get('frame', (self.size[1], self.size[0], 3))
+            return cv.add(self.__render(), self.__noise[self.captures % N_NOISE], dst=frame)
+
+
+def _run_bot(args: Tuple[int, int, int, int, float, int, float, str]) -> dict:
+    """
+    Run a bot on a simulated device and return its stats.
+    """
+    from .bot import BattleBot
+    from .engine import Engine
+
+    index, loops, stages, mode, latency, noise, reconnect_rate, match_server = args
+    device = SimDevice(mode=mode, stage_count=stages, latency=latency, noise=noise,
+                       reconnect_rate=reconnect_rate, seed=index)
+    with tempfile.TemporaryDirectory() as tmp:
+        quest, friend = device.save_images(tmp)
+        engine = Engine(mode=mode, device=device, match_server=match_server)
+        bot = BattleBot(quest=quest, friend=friend, stage_count=stages, engine=engine)
+        for stage in range(1, stages + 1):
+            bot.at_stage(stage)(lambda: bot.attack([1, 2, 3]))
+
+        start, cpu = time(), process_time()
+        bot.run(max_loops=loops)
+        wall, cpu = time() - start, process_time() - cpu
+    return {'bot': index, 'battles': device.battles, 'captures': device.captures, 'taps': device.taps,
+            'wall': wall, 'cpu': cpu}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run bots on simulated devices and measure their load.')
+    parser.add_argument('--bots', type=int, default=4, help='the number of bots run at once')
+    parser.add_argument('--loops', type=int, default=2, help='the number of battles of each bot')
+    parser.add_argument('--stages', type=int, default=1, help='the number of waves of the quest')
+    parser.add_argument('--mode', type=int, default=0, help='the template image set')
+    parser.add_argument('--latency', type=float, default=0.2, help='the seconds between a tap and its effect')
+    parser.add_argument('--noise', type=int, default=4, help='the max noise added to each pixel')
+    parser.add_argument('--reconnect-rate', type=float, default=0.0,
+                        help='the probability of the reconnect dialog after a network request')
+    parser.add_argument('--match-server', help='the address of the matching service to match with')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    jobs = [(i, args.loops, args.stages, args.mode, args.latency, args.noise, args.reconnect_rate, args.match_server)
+            for i in range(args.bots)]
+    with Pool(args.bots) as pool:
+        results = pool.map(_run_bot, jobs)
+
+    for r in results:
+        print('bot {bot:3d}: {battles} battles, {captures} captures in {wall:.1f} sec, '
+              'CPU {cpu:.1f} sec ({load:.1f}% of a core, {per:.1f} ms per capture)'.format(
+                load=100 * r['cpu'] / r['wall'], per=1000 * r['cpu'] / max(r['captures'], 1), **r))
+    captures = sum(r['captures'] for r in results)
+    wall = max(r['wall'] for r in results)
+    cpu = sum(r['cpu'] for r in results)
+    print('total: {} battles, {:.1f} captures per sec, {:.1f}% of a core per bot on average'.format(
+        sum(r['battles'] for r in results), captures / wall, 100 * cpu / wall / len(results)))
+
+
+if __name__ == '__main__':
+    main()
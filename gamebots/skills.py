@@ -0,0 +1,85 @@
+"""
+Skill availability readout on the battle screen.
+"""
+
+import logging
+from collections import namedtuple
+from typing import List, Tuple
+
+import cv2 as cv
+import numpy as np
+
+logger = logging.getLogger('skills')
+
+# the min mean value (brightness, 0-255) of an available skill icon. Icons on cooldown are dimmed.
+MIN_BRIGHTNESS = 90
+# the min mean saturation of an available skill icon. Icons on cooldown are grayed out.
+MIN_SATURATION = 40
+
+# the number of servants, of skills per servant and of master skills
+N_SERVANTS = 3
+N_SKILLS = 3
+N_MASTER_SKILLS = 3
+
+# the availability of the skills.
+# servant: a list per servant of whether each of its skills is available; master: the same for the master skills.
+Skills = namedtuple('Skills', ['servant', 'master'])
+
+
+class SkillReader:
+    """
+    A reader of whether the skills are off cooldown, from the brightness and saturation of their icons.
+
+    The icons are the 'skill' button repeated every 'skill_distance' and 'servant_distance' pixels, and the
+    'master_skill' button repeated every 'master_skill_distance' pixels. All of them are measured at once.
+    """
+
+    def __init__(self, buttons: dict, min_brightness: float = MIN_BRIGHTNESS, min_saturation: float = MIN_SATURATION):
+        """
+
+        :param buttons: the button config, see `Engine.buttons`.
+        :param min_brightness: the min mean brightness of an available skill icon.
+        :param min_saturation: the min mean saturation of an available skill icon.
+        """
+        self.min_brightness = min_brightness
+        self.min_saturation = min_saturation
+
+        btn = buttons['skill']
+        self.rois = []  # type: List[Tuple[int, int, int, int]]
+        for servant in range(N_SERVANTS):
+            for skill in range(N_SKILLS):
+                x = btn['x'] + buttons['servant_distance'] * servant + buttons['skill_distance'] * skill
+                self.rois.append((x, btn['y'], btn['w'], btn['h']))
+        btn = buttons['master_skill']
+        for skill in range(N_MASTER_SKILLS):
+            self.rois.append((btn['x'] + buttons['master_skill_distance'] * skill, btn['y'], btn['w'], btn['h']))
+
+    def stats(self, image: np.ndarray) -> np.ndarray:
+        """
+        Return the mean saturation and brightness of every skill icon.
+
+        :param image: the battle screen, in BGR.
+        :return: an array of shape (12, 2): the 9 servant skills in order, then the 3 master skills.
+        """
+        h = min(r[3] for r in self.rois)
+        w = min(r[2] for r in self.rois)
+        stack = np.concatenate([image[y:y + h, x:x + w] for x, y, _, _ in self.rois])
+        hsv = cv.cvtColor(stack, cv.COLOR_BGR2HSV).reshape(len(self.rois), -1, 3)
+        return hsv[..., 1:].mean(axis=1)
+
+    def read(self, image: np.ndarray) -> Skills:
+        """
+        Read the availability of every skill.
+
+        The master skills are only shown while the master skill menu is open; they read as unavailable otherwise.
+
+        :param image: the battle screen, in BGR.
+        :return: the availability of the skills.
+        """
+        stats = self.stats(image)
+        available = (stats[:, 0] >= self.min_saturation) & (stats[:, 1] >= self.min_brightness)
+        n = N_SERVANTS * N_SKILLS
+        result = Skills([[bool(a) for a in available[i:i + N_SKILLS]] for i in range(0, n, N_SKILLS)],
+                        [bool(a) for a in available[n:]])
+        logger.debug('Skills: {}'.format(result))
+        return result
@@ -0,0 +1,177 @@
+"""
+Supervising the battle loop and recovering from failures.
+"""
+
+import logging
+from time import sleep
+
+from .bot import BattleBot, ENTER
+from .device import AdbError, DeviceError, DeviceTimeout
+from .engine import INTERVAL_SHORT, INTERVAL_MID, ScreenError
+
+logger = logging.getLogger('supervisor')
+
+# kinds of failures
+ADB_DROPPED = 'adb_dropped'
+EMULATOR_HUNG = 'emulator_hung'
+NETWORK = 'network'
+UNKNOWN_SCREEN = 'unknown_screen'
+UNKNOWN = 'unknown'
+
+
+class Supervisor:
+    """
+    A supervisor that runs a battle bot and resumes it after failures.
+
+    On a failure of the device (`DeviceError`) or an unexpected screen (`ScreenError`), the adb connection is
+    restored, the network reconnect dialog is dismissed, and the bot resumes from the state of the battle loop
+    recognized on the screen, keeping its battle count. Any other exception is a bug and is raised.
+    """
+
+    def __init__(self, bot: BattleBot, max_failures: int = 10, retry_interval: float = INTERVAL_MID,
+                 wait_timeout: float = 300):
+        """
+
+        :param bot: the bot to supervise.
+        :param max_failures: the max number of failures in a row, and of recovery attempts, before giving up.
+        :param retry_interval: the seconds to wait between two attempts to reconnect.
+        :param wait_timeout: the max seconds the bot waits for an image before the screen is taken as unexpected,
+            see `Engine.wait_timeout`.
+        """
+        self.bot = bot
+        self.max_failures = max_failures
+        self.retry_interval = retry_interval
+        self.wait_timeout = wait_timeout
+
+        # the number of failures of each kind
+        self.failures = {}
+
+    @staticmethod
+    def classify(e: Exception) -> str:
+        """
+        Classify a failure raised by the bot.
+
+        :param e: the exception.
+        :return: the kind of the failure.
+        """
+        if isinstance(e, DeviceTimeout):
+            return EMULATOR_HUNG
+        if isinstance(e, (AdbError, DeviceError)):
+            return ADB_DROPPED
+        if isinstance(e, ScreenError):
+            return UNKNOWN_SCREEN
+        return UNKNOWN
+
+    def __reconnect(self, kind: str, last: bool) -> bool:
+        """
+        Restore the adb connection, as gently as the failure allows.
+
+        Reconnecting does not help a hung emulator, nor an unexpected screen: the device is first checked to
+        respond. Then only the connection of this device is reset. The adb server, shared by every bot of the host,
+        is only restarted at the last attempt.
+
+        :param kind: the kind of the last failure.
+        :param last: whether this is the last attempt.
+        :return: whether the device responds.
+        """
+        device = self.bot.device
+        if kind != ADB_DROPPED:
+            try:
+                if device.get_size():
+                    return True
+            except DeviceError as e:
+                logger.warning('Device not responding: {}'.format(e))
+        if last:
+            logger.warning('Restarting the adb server.')
+        return device.reconnect(restart=last) and device.connected()
+
+    def __locate(self) -> str:
+        """
+        Recognize the state of the battle loop, dismissing the reconnect dialog and unknown screens.
+
+        :return: the state to resume from. Return '' if failed.
+        """
+        engine = self.bot.engine
+        for _ in range(self.max_failures):
+            state = self.bot.locate()
+            if state:
+                return state
+            if engine.exists('reconnect'):
+                self.__count(NETWORK)
+                engine.find_and_tap('reconnect')
+            else:
+                self.__count(UNKNOWN_SCREEN)
+                self.bot.device.tap_rand(640, 360, 50, 50)
+            sleep(INTERVAL_SHORT)
+        return ''
+
+    def __count(self, kind: str):
+        self.failures[kind] = self.failures.get(kind, 0) + 1
+        logger.warning('Failure: {} ({} so far)'.format(kind, self.failures[kind]))
+        if self.bot.telemetry is not None:
+            self.bot.telemetry.failure(kind)
+
+    def __recover(self, kind: str) -> str:
+        """
+        Restore the adb connection and recognize the state of the battle loop.
+
+        :param kind: the kind of the failure.
+        :return: the state to resume from. Return '' if failed.
+        """
+        if kind == EMULATOR_HUNG:
+            # give it time to come back
+            sleep(self.retry_interval)
+        for attempt in range(self.max_failures):
+            try:
+                if self.__reconnect(kind, attempt == self.max_failures - 1):
+                    state = self.__locate()
+                    if state:
+                        return state
+            except DeviceError as e:
+                kind = self.classify(e)
+                self.__count(kind)
+            logger.warning('Recovery attempt {} failed.'.format(attempt + 1))
+            sleep(self.retry_interval)
+        return ''
+
+    def run(self, max_loops: int = 999, state: str = ENTER, resume: bool = False) -> bool:
+        """
+        Run the bot until `max_loops` battles are played or it quits on its own.
+
+        :param max_loops: the max number of loops.
+        :param state: the state to start from, see `BattleBot.run`.
+        :param resume: if set True, keep the battle count of the previous run and resume the battle in progress.
+        :return: whether the bot finished without giving up.
+        """
+        engine = self.bot.engine
+        wait_timeout, engine.wait_timeout = engine.wait_timeout, self.wait_timeout
+        try:
+            return self.__run(max_loops, state, resume)
+        finally:
+            engine.wait_timeout = wait_timeout
+
+    def __run(self, max_loops: int, state: str, resume: bool) -> bool:
+        # the number of failures since the last battle completed
+        consecutive = 0
+        count = self.bot.count
+        while True:
+            try:
+                self.bot.run(max_loops, state=state, resume=resume)
+                return True
+            except (DeviceError, ScreenError) as e:
+                kind = self.classify(e)
+                self.__count(kind)
+                logger.warning('{}: {}'.format(type(e).__name__, e))
+
+            consecutive = consecutive + 1 if self.bot.count == count else 1
+            count = self.bot.count
+            if consecutive > self.max_failures:
+                logger.error('Too many failures without progress. Give up.')
+                return False
+
+            resume = True
+            state = self.__recover(kind)
+            if not state:
+                logger.error('Failed to recover. Give up.')
+                return False
+            logger.info('Resuming from state {} after {} battles.'.format(state, self.bot.count))
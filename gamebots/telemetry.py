@@ -0,0 +1,306 @@
+"""
+A persistent store of the timings of the battle runs, with a command line to query it.
+
+Usage: python -m gamebots.telemetry [--db FILE] [--script NAME] [--device SERIAL] [--days N]
+                                    {runs,daily,phases,failures,compare} [--split DATE]
+
+Every battle is appended to a SQLite database as it completes, along with the time spent in each phase of it,
+the AP item used and the number of friend list refreshes. Failures are recorded as they happen.
+The queries report the throughput per script and device, so that a change can be compared with the runs before it.
+"""
+
+import argparse
+import logging
+import sqlite3
+import sys
+from pathlib import Path
+from time import time, strftime, localtime, mktime, strptime
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger('telemetry')
+
+# the default location of the database
+TELEMETRY_DB = Path.home() / '.fgo-bot' / 'telemetry.db'
+
+# the phases of a battle, in order
+PHASES = ('enter', 'friend', 'battle', 'end')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    start REAL NOT NULL,
+    script TEXT NOT NULL,
+    device TEXT NOT NULL,
+    quest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS battles (
+    id INTEGER PRIMARY KEY,
+    run INTEGER NOT NULL REFERENCES runs(id),
+    seq INTEGER NOT NULL,
+    start REAL NOT NULL,
+    duration REAL NOT NULL,
+    rounds INTEGER NOT NULL,
+    ap_item TEXT,
+    friend_refreshes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    battle INTEGER NOT NULL REFERENCES battles(id),
+    name TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS failures (
+    run INTEGER REFERENCES runs(id),
+    time REAL NOT NULL,
+    kind TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS battles_start ON battles(start);
+'''
+
+
+class Telemetry:
+    """
+    A recorder of the battles of a bot into a SQLite database. Rows are only ever appended.
+
+    The bot calls `start_run` once, then `add_phase`, `use_ap` and `refresh_friends` during each battle and
+    `end_battle` when it completes, which writes the battle and its phases at once.
+    """
+
+    def __init__(self, path: str = str(TELEMETRY_DB), script: str = None):
+        """
+
+        :param path: the path to the database. It is created if missing.
+        :param script: the name of the script recorded with the runs. If not given, use the running script.
+        """
+        self.path = Path(path).absolute()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.script = script or Path(sys.argv[0]).name
+        self.__db = sqlite3.connect(str(self.path))
+        self.__db.executescript(SCHEMA)
+
+        # the current run, and the data of the battle in progress
+        self.run = None
+        self.__seq = 0
+        self.__phases = []  # type: List[Tuple[str, float]]
+        self.__ap_item = None
+        self.__refreshes = 0
+
+    def start_run(self, device: str = '', quest: str = '') -> int:
+        """
+        Start recording a new run.
+
+        :param device: the serial of the device.
+        :param quest: the name of the quest.
+        :return: the id of the run.
+        """
+        cur = self.__db.execute('INSERT INTO runs (start, script, device, quest) VALUES (?, ?, ?, ?)',
+                                (time(), self.script, device, quest))
+        self.__db.commit()
+        self.run = cur.lastrowid
+        self.__seq = 0
+        self.__reset()
+        logger.debug('Recording run {} to {}.'.format(self.run, self.path))
+        return self.run
+
+    def __reset(self):
+        self.__phases = []
+        self.__ap_item = None
+        self.__refreshes = 0
+
+    def add_phase(self, name: str, duration: float):
+        """
+        Record the time spent in a phase of the battle in progress. A phase may be added several times.
+
+        :param name: the name of the phase, see `PHASES`.
+        :param duration: the seconds spent.
+        """
+        self.__phases.append((name, duration))
+
+    def use_ap(self, item: str):
+        """
+        Record the AP item used to enter the battle in progress.
+        """
+        self.__ap_item = item
+
+    def refresh_friends(self):
+        """
+        Record a refresh of the friend list in the battle in progress.
+        """
+        self.__refreshes += 1
+
+    def end_battle(self, start: float, rounds: int):
+        """
+        Write the battle in progress.
+
+        :param start: the time the battle was entered.
+        :param rounds: the number of stages played.
+        """
+        if self.run is None:
+            self.start_run()
+        self.__seq += 1
+        cur = self.__db.execute(
+            'INSERT INTO battles (run, seq, start, duration, rounds, ap_item, friend_refreshes) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (self.run, self.__seq, start, time() - start, rounds, self.__ap_item, self.__refreshes))
+        self.__db.executemany('INSERT INTO phases (battle, name, duration) VALUES (?, ?, ?)',
+                              [(cur.lastrowid, name, duration) for name, duration in self.__phases])
+        self.__db.commit()
+        self.__reset()
+
+    def failure(self, kind: str):
+        """
+        Record a failure of the current run.
+
+        :param kind: the kind of the failure, see `supervisor`.
+        """
+        self.__db.execute('INSERT INTO failures (run, time, kind) VALUES (?, ?, ?)', (self.run, time(), kind))
+        self.__db.commit()
+
+    def close(self):
+        self.__db.close()
+
+
+def _filters(args: argparse.Namespace, alias: str = 'b') -> Tuple[str, list]:
+    """
+    Return the WHERE clause and its parameters of the filters given on the command line.
+    """
+    clauses, params = [], []
+    if args.script:
+        clauses.append('r.script = ?')
+        params.append(args.script)
+    if args.device:
+        clauses.append('r.device = ?')
+        params.append(args.device)
+    if args.days:
+        clauses.append('{}.{} >= ?'.format(alias, 'time' if alias == 'f' else 'start'))
+        params.append(time() - args.days * 86400)
+    return ('WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+
+def _print(header: List[str], rows: List[tuple]):
+    """
+    Print a table, with the floats rounded.
+    """
+    rows = [['{:.1f}'.format(v) if isinstance(v, float) else '' if v is None else str(v) for v in row]
+            for row in rows]
+    widths = [max(len(s) for s in col) for col in zip(header, *rows)]
+    for row in [header] + rows:
+        print('  '.join(s.rjust(w) for s, w in zip(row, widths)))
+
+
+def query_runs(db: sqlite3.Connection, args: argparse.Namespace):
+    """
+    Print every run: its battles, mean battle time, battles per hour, AP items, refreshes and failures.
+    """
+    where, params = _filters(args)
+    rows = db.execute(
+        "SELECT r.id, strftime('%Y-%m-%d %H:%M', r.start, 'unixepoch', 'localtime'), r.script, r.device, "
+        'COUNT(b.id), AVG(b.duration), 3600.0 * COUNT(b.id) / (MAX(b.start + b.duration) - MIN(b.start)), '
+        'SUM(b.ap_item IS NOT NULL), SUM(b.friend_refreshes), '
+        '(SELECT COUNT(*) FROM failures f WHERE f.run = r.id) '
+        'FROM runs r JOIN battles b ON b.run = r.id {} GROUP BY r.id ORDER BY r.start'.format(where), params)
+    _print(['run', 'start', 'script', 'device', 'battles', 'avg sec', 'per hour', 'ap items', 'refreshes',
+            'failures'], rows.fetchall())
+
+
+def query_daily(db: sqlite3.Connection, args: argparse.Namespace):
+    """
+    Print the battles per day, script and device, with the change of the mean battle time from the day before.
+    """
+    where, params = _filters(args)
+    rows = db.execute(
+        "SELECT strftime('%Y-%m-%d', b.start, 'unixepoch', 'localtime') AS day, r.script, r.device, "
+        'COUNT(*), AVG(b.duration), 3600.0 / AVG(b.duration), AVG(b.friend_refreshes) '
+        'FROM battles b JOIN runs r ON b.run = r.id {} GROUP BY day, r.script, r.device '
+        'ORDER BY r.script, r.device, day'.format(where), params).fetchall()
+    # the change of the mean battle time from the previous day of the same script and device
+    result = []
+    prev = {}  # type: Dict[tuple, float]
+    for row in rows:
+        key = row[1:3]
+        change = 100.0 * (row[4] / prev[key] - 1) if key in prev else None
+        prev[key] = row[4]
+        result.append(row + (change,))
+    _print(['day', 'script', 'device', 'battles', 'avg sec', 'per hour', 'refreshes', 'sec change %'], result)
+
+
+def query_phases(db: sqlite3.Connection, args: argparse.Namespace):
+    """
+    Print the mean and max time of each phase of the battles, per script and device.
+    """
+    where, params = _filters(args)
+    rows = db.execute(
+        'SELECT r.script, r.device, p.name, COUNT(DISTINCT b.id), SUM(p.duration) / COUNT(DISTINCT b.id), '
+        'MAX(p.duration) FROM phases p JOIN battles b ON p.battle = b.id JOIN runs r ON b.run = r.id {} '
+        'GROUP BY r.script, r.device, p.name'.format(where), params).fetchall()
+    rows.sort(key=lambda row: (row[0], row[1], PHASES.index(row[2]) if row[2] in PHASES else len(PHASES)))
+    _print(['script', 'device', 'phase', 'battles', 'avg sec', 'max sec'], rows)
+
+
+def query_failures(db: sqlite3.Connection, args: argparse.Namespace):
+    """
+    Print the number of failures of each kind, per script and device.
+    """
+    where, params = _filters(args, alias='f')
+    rows = db.execute(
+        'SELECT r.script, r.device, f.kind, COUNT(*), '
+        "strftime('%Y-%m-%d %H:%M', MAX(f.time), 'unixepoch', 'localtime') "
+        'FROM failures f JOIN runs r ON f.run = r.id {} GROUP BY r.script, r.device, f.kind '
+        'ORDER BY r.script, r.device, COUNT(*) DESC'.format(where), params)
+    _print(['script', 'device', 'failure', 'count', 'last'], rows.fetchall())
+
+
+def query_compare(db: sqlite3.Connection, args: argparse.Namespace):
+    """
+    Print the battles per hour before and after a date, per script and device.
+    """
+    if not args.split:
+        raise SystemExit('compare needs --split DATE')
+    split = mktime(strptime(args.split, '%Y-%m-%d'))
+    where, params = _filters(args)
+    rows = db.execute(
+        'SELECT r.script, r.device, b.start >= ? AS after, COUNT(*), AVG(b.duration) '
+        'FROM battles b JOIN runs r ON b.run = r.id {} GROUP BY r.script, r.device, after'.format(where),
+        [split] + params).fetchall()
+    by_key = {}
+    for script, device, after, n, avg in rows:
+        by_key.setdefault((script, device), {})[after] = (n, avg)
+    result = []
+    for (script, device), sides in sorted(by_key.items()):
+        (n0, avg0), (n1, avg1) = sides.get(0, (0, None)), sides.get(1, (0, None))
+        change = 100.0 * (avg0 / avg1 - 1) if avg0 and avg1 else None
+        result.append((script, device, n0, 3600.0 / avg0 if avg0 else None, n1, 3600.0 / avg1 if avg1 else None,
+                       change))
+    print('Battles per hour before and after {}:'.format(strftime('%Y-%m-%d', localtime(split))))
+    _print(['script', 'device', 'before', 'per hour', 'after', 'per hour', 'change %'], result)
+
+
+QUERIES = {
+    'runs': query_runs,
+    'daily': query_daily,
+    'phases': query_phases,
+    'failures': query_failures,
+    'compare': query_compare,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the recorded battle runs.')
+    parser.add_argument('query', choices=sorted(QUERIES), help='the report to print')
+    parser.add_argument('--db', default=str(TELEMETRY_DB), help='the path to the database')
+    parser.add_argument('--script', help='only the runs of this script')
+    parser.add_argument('--device', help='only the runs on this device')
+    parser.add_argument('--days', type=float, help='only the last N days')
+    parser.add_argument('--split', help='the date (YYYY-MM-DD) to compare the runs before and after')
+    args = parser.parse_args()
+
+    if not Path(args.db).is_file():
+        raise SystemExit('No database at {}.'.format(args.db))
+    db = sqlite3.connect(args.db)
+    try:
+        QUERIES[args.query](db, args)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,20 @@
 Template matching.
 """
 
-# import numpy as np
+import json
 import logging
+from collections import namedtuple
 from pathlib import Path
-from typing import Callable, Tuple
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple, TYPE_CHECKING
 
 import cv2 as cv
+import numpy as np
+
+from .buffers import BufferPool
+
+if TYPE_CHECKING:
+    from .matchserver import MatchClient
 
 # from matplotlib import pyplot as plt
 
@@ -16,24 +24,381 @@ logger = logging.getLogger('tm')
 # the template matching method
 TM_METHOD = cv.TM_CCOEFF_NORMED
 
+# the template matching methods that can be set in the manifest
+METHODS = {
+    'ccoeff_normed': cv.TM_CCOEFF_NORMED,
+    'ccorr_normed': cv.TM_CCORR_NORMED,
+    'sqdiff_normed': cv.TM_SQDIFF_NORMED,
+}
+
+# the min area (in pixels, once scaled) of a template searched on the whole screen for it to be matched in the
+# frequency domain, see `fft_score_map`. Below it, spatial matching is faster; see `benchmark_fft`.
+FFT_MIN_AREA = 48 * 48
+
+# the size in pixels of the blocks compared between two screens, see `dirty_blocks`
+DIRTY_BLOCK = 32
+# the max difference of a pixel (0-255, per channel) between two screens still counted as unchanged
+DIRTY_TOLERANCE = 16
+
+# the default manifest entry of a template
+DEFAULT_ENTRY = {
+    'threshold': None,
+    'method': 'ccoeff_normed',
+    'roi': None,
+    'color': 'color',
+    'scale': 1.0,
+    'states': []
+}
+
+
+def prepare(image: np.ndarray, gray: bool = False, scale: float = 1.0, pool: BufferPool = None) -> np.ndarray:
+    """
+    Convert an image for matching.
+
+    :param image: the image, in BGR.
+    :param gray: whether to convert it to grayscale.
+    :param scale: the factor to resize it by.
+    :param pool: the pool to take the converted image from. If not given, a new one is allocated.
+    :return: the converted image. The same image if nothing is to be done.
+    """
+    if gray:
+        dst = pool.get('gray', image.shape[:2]) if pool else None
+        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY, dst=dst)
+    if scale != 1.0:
+        dst = None
+        if pool:
+            h, w = image.shape[:2]
+            dst = pool.get('scaled', (int(round(h * scale)), int(round(w * scale))) + image.shape[2:])
+        image = cv.resize(image, None, dst=dst, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+    return image
+
+
+def result_buffer(pool: BufferPool, image: np.ndarray, template: np.ndarray) -> np.ndarray:
+    """
+    Return a buffer from the pool for the result of matching a template against an image.
+    Return None if the template does not fit in the image.
+    """
+    h, w = image.shape[:2]
+    th, tw = template.shape[:2]
+    if th > h or tw > w:
+        return None
+    return pool.get('result', (h - th + 1, w - tw + 1), np.float32)
+
+
+def score_map(image: np.ndarray, template: np.ndarray, method: str = 'ccoeff_normed',
+              result: np.ndarray = None) -> np.ndarray:
+    """
+    Return the map of matching scores of a template over an image. The higher the score, the better the match.
+
+    :param image: the image to search in.
+    :param template: the template image.
+    :param method: the name of the matching method in `METHODS`.
+    :param result: the float32 buffer to write the scores into, see `result_buffer`. If not given, allocate one.
+    :return: the scores.
+    """
+    res = cv.matchTemplate(image, template, METHODS[method], result=result)
+    if method == 'sqdiff_normed':
+        res = np.subtract(1, res, out=res)
+    return res
+
+
+def best_match(screen: np.ndarray, template: np.ndarray, method: str = 'ccoeff_normed',
+               roi: Tuple[int, int, int, int] = None, scale: float = 1.0,
+               pool: BufferPool = None) -> Tuple[float, Tuple[int, int]]:
+    """
+    Return the best match of a template on a screen, or a region of it.
+
+    :param screen: the screen, converted for matching (see `prepare`).
+    :param template: the template image, converted the same way.
+    :param method: the name of the matching method in `METHODS`.
+    :param roi: the region to search in (x, y, w, h), in screen coords. If not given, search the whole screen.
+    :param scale: the factor the screen and the template are resized by.
+    :param pool: the pool to take the result buffer from. If not given, allocate one.
+    :return: the matching value and the top-left coords of the best match, in screen coords.
+    """
+    x = y = 0
+    if roi is not None:
+        rx, ry, rw, rh = (int(v * scale) for v in roi)
+        screen = screen[ry:ry + rh, rx:rx + rw]
+        x, y = int(rx / scale), int(ry / scale)
+    res = score_map(screen, template, method, result_buffer(pool, screen, template) if pool else None)
+    _, max_val, _, max_loc = cv.minMaxLoc(res)
+    return max_val, (int(max_loc[0] / scale) + x, int(max_loc[1] / scale) + y)
+
+
+# a screen transformed for matching in the frequency domain, see `screen_spectra`.
+# spectra: the DFT of each channel, padded to `size` (rows, cols); sums: the running sums of the channels;
+# sqsums: the running sums of the squares, added over the channels.
+ScreenSpectra = namedtuple('ScreenSpectra', ['shape', 'size', 'spectra', 'sums', 'sqsums'])
+
+# a template transformed for matching in the frequency domain, see `template_spectra`.
+# spectra: the DFT of each channel minus its mean, padded to the size of the screen spectra;
+# norm: the sum of the squares of the channels minus their means.
+TemplateSpectra = namedtuple('TemplateSpectra', ['shape', 'spectra', 'norm'])
+
+
+def screen_spectra(screen: np.ndarray) -> ScreenSpectra:
+    """
+    Transform a screen for matching in the frequency domain, once for all the templates matched on it.
+
+    :param screen: the screen, converted for matching (see `prepare`).
+    :return: the spectra and running sums of the screen.
+    """
+    h, w = screen.shape[:2]
+    size = cv.getOptimalDFTSize(h), cv.getOptimalDFTSize(w)
+    spectra = []
+    for channel in cv.split(screen):
+        padded = cv.copyMakeBorder(channel, 0, size[0] - h, 0, size[1] - w, cv.BORDER_CONSTANT)
+        spectra.append(cv.dft(np.float32(padded), nonzeroRows=h))
+    sums, sqsums = cv.integral2(screen, sdepth=cv.CV_64F, sqdepth=cv.CV_64F)
+    if sqsums.ndim == 3:
+        sqsums = cv.transform(sqsums, np.ones((1, sqsums.shape[2])))
+    return ScreenSpectra(screen.shape, size, spectra, sums, sqsums)
+
+
+def template_spectra(template: np.ndarray, size: Tuple[int, int]) -> TemplateSpectra:
+    """
+    Transform a template for matching in the frequency domain, once per size of screen spectra.
+
+    :param template: the template image, converted for matching.
+    :param size: the size of the screen spectra.
+    :return: the spectra and norm of the template.
+    """
+    h, w = template.shape[:2]
+    spectra = []
+    norm = 0.0
+    for channel in cv.split(np.float32(template)):
+        channel -= channel.mean()
+        norm += float(channel.ravel().dot(channel.ravel()))
+        padded = cv.copyMakeBorder(channel, 0, size[0] - h, 0, size[1] - w, cv.BORDER_CONSTANT)
+        spectra.append(cv.dft(padded, nonzeroRows=h))
+    return TemplateSpectra(template.shape, spectra, norm)
+
+
+def fft_score_map(screen: ScreenSpectra, template: TemplateSpectra, pool: BufferPool = None) -> np.ndarray:
+    """
+    Return the map of `TM_CCOEFF_NORMED` scores of a template over a screen, computed in the frequency domain.
+    The same as `score_map`, up to rounding.
+
+    The correlation with the zero-mean template is the inverse transform of the product of the spectra, added over
+    the channels, and the deviation of each window of the screen comes from the running sums.
+
+    :param screen: the screen spectra, see `screen_spectra`.
+    :param template: the template spectra for the size of the screen spectra, see `template_spectra`.
+    :param pool: the pool to take the buffers from. If not given, allocate them.
+    :return: the scores, of the size of `score_map`.
+    """
+    h, w = template.shape[:2]
+    rh, rw = screen.shape[0] - h + 1, screen.shape[1] - w + 1
+    if template.norm == 0:
+        # a plain template has no correlation with anything
+        return np.zeros((rh, rw), np.float32)
+
+    def buffer(tag: str, shape: tuple, dtype=np.float32) -> np.ndarray:
+        return pool.get(tag, shape, dtype) if pool else np.empty(shape, dtype)
+
+    product = buffer('fft_product', screen.size)
+    cv.mulSpectrums(screen.spectra[0], template.spectra[0], 0, product, conjB=True)
+    for a, b in zip(screen.spectra[1:], template.spectra[1:]):
+        cv.add(product, cv.mulSpectrums(a, b, 0, conjB=True), product)
+    corr = buffer('fft_corr', screen.size)
+    cv.dft(product, corr, cv.DFT_INVERSE | cv.DFT_SCALE | cv.DFT_REAL_OUTPUT, nonzeroRows=rh)
+
+    def window(sums: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        cv.subtract(sums[h:h + rh, w:w + rw], sums[:rh, w:w + rw], dst)
+        cv.subtract(dst, sums[h:h + rh, :rw], dst)
+        return cv.add(dst, sums[:rh, :rw], dst)
+
+    # the sum of the squared deviations of each window: the sum of the squares minus the squared sums over the area
+    sums = window(screen.sums, buffer('fft_sums', (rh, rw) + screen.sums.shape[2:], np.float64))
+    cv.multiply(sums, sums, sums)
+    var = cv.transform(sums.reshape(rh, rw, -1), np.full((1, sums.size // (rh * rw)), -1.0 / (h * w)))
+    cv.add(var, window(screen.sqsums, buffer('fft_sqsums', (rh, rw), np.float64)), var)
+    # nor has a plain window: the deviation of any other window of 8-bit pixels is at least about 1
+    var[var < 0.5] = np.inf
+    den = np.float32(cv.sqrt(var * template.norm))
+
+    res = cv.divide(corr[:rh, :rw], den, dtype=cv.CV_32F)
+    return np.clip(res, -1, 1, out=res)
+
+
+def benchmark_fft(sizes: List[int] = (16, 24, 32, 48, 64, 96, 128, 192, 256), shape: Tuple[int, int] = (720, 1280),
+                  rounds: int = 5, gray: bool = False) -> List[dict]:
+    """
+    Measure the time of matching square templates of several sizes on a random screen, in space and in frequency.
+
+    :param sizes: the sizes of the templates.
+    :param shape: the size of the screen (rows, cols).
+    :param rounds: the number of matches per template.
+    :param gray: whether to match in grayscale.
+    :return: the stats of each size: 'size', 'spatial' (seconds per match), 'fft' (seconds per match, the screen
+        transformed once) and 'screen' (seconds to transform the screen). The crossover is logged: the smallest
+        size from which matching in frequency is always faster, the screen transform included.
+    """
+    screen = np.random.randint(0, 256, shape + (() if gray else (3,)), np.uint8)
+    screen = cv.GaussianBlur(screen, (5, 5), 0)
+    start = perf_counter()
+    for _ in range(rounds):
+        spectra = screen_spectra(screen)
+    screen_time = (perf_counter() - start) / rounds
+
+    stats = []
+    for size in sizes:
+        template = screen[size:size * 2, size:size * 2].copy()
+        start = perf_counter()
+        for _ in range(rounds):
+            score_map(screen, template)
+        spatial = (perf_counter() - start) / rounds
+        t_spectra = template_spectra(template, spectra.size)
+        start = perf_counter()
+        for _ in range(rounds):
+            fft_score_map(spectra, t_spectra)
+        fft = (perf_counter() - start) / rounds
+        stats.append({'size': size, 'spatial': spatial, 'fft': fft, 'screen': screen_time})
+        logger.info('Template {0}x{0}: {1:.1f} ms in space, {2:.1f} + {3:.1f} ms in frequency.'.format(
+            size, 1000 * spatial, 1000 * fft, 1000 * screen_time))
+
+    crossover = None
+    for s in reversed(stats):
+        if s['fft'] + s['screen'] >= s['spatial']:
+            break
+        crossover = s['size']
+    if crossover:
+        logger.info('Matching in frequency is faster from {0}x{0} templates.'.format(crossover))
+    else:
+        logger.info('Matching in frequency is not faster for these sizes.')
+    return stats
+
+
+def frame_diff(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    Return the mean absolute difference of two images of the same size.
+
+    :param a: the first image.
+    :param b: the second image.
+    :return: the mean difference per pixel and channel, in [0, 255].
+    """
+    return float(cv.absdiff(a, b).mean())
+
+
+def dirty_blocks(a: np.ndarray, b: np.ndarray, block: int = DIRTY_BLOCK, tolerance: int = DIRTY_TOLERANCE,
+                 pool: BufferPool = None) -> np.ndarray:
+    """
+    Return which blocks of two images of the same size differ.
+
+    A block is dirty if any of its pixels differs by more than `tolerance` in a channel, so that the capture
+    noise is ignored but not a small change. The changed pixels are counted per block from an integral image.
+
+    :param a: the first image.
+    :param b: the second image.
+    :param block: the size of the blocks in pixels. The last row and column of blocks may be smaller.
+    :param tolerance: the max difference of an unchanged pixel.
+    :param pool: the pool to take the buffers from. If not given, allocate them.
+    :return: a bool array of (ceil(h / block), ceil(w / block)), True for the dirty blocks.
+    """
+    h, w = a.shape[:2]
+    channels = a.shape[2:]
+    diff = cv.absdiff(a, b, dst=pool.get('diff', a.shape) if pool else None)
+    cv.threshold(diff, tolerance, 1, cv.THRESH_BINARY, dst=diff)
+    counts = cv.integral(diff, sum=pool.get('diff_sum', (h + 1, w + 1) + channels, np.int32) if pool else None)
+    ys = np.append(np.arange(0, h, block), h)
+    xs = np.append(np.arange(0, w, block), w)
+    corners = counts[np.ix_(ys, xs)]
+    changed = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+    return changed.any(axis=2) if changed.ndim == 3 else changed > 0
+
+
+def match_all(image: np.ndarray, template: np.ndarray, threshold: float, overlap: float = 0.3,
+              result: np.ndarray = None) -> List[Tuple[int, int]]:
+    """
+    Find every occurrence of a template in an image.
+
+    All the locations above `threshold` are picked from the correlation map at once, and the overlapping
+    ones are reduced to the best of them by non-maximum suppression.
+
+    :param image: the image to search in.
+    :param template: the template image.
+    :param threshold: the threshold of matching.
+    :param overlap: the max ratio of intersection over union of two kept matches.
+    :param result: the float32 buffer to write the correlation map into, see `result_buffer`.
+        If not given, allocate one.
+    :return: the top-left coords of the results, the best match first.
+    """
+    res = cv.matchTemplate(image, template, TM_METHOD, result=result)
+    # keep the local maxima above threshold only
+    peaks = (res >= threshold) & (res >= cv.dilate(res, np.ones((3, 3), np.uint8)))
+    ys, xs = np.nonzero(peaks)
+    if len(xs) == 0:
+        return []
+    order = np.argsort(-res[ys, xs])
+    xs, ys = xs[order], ys[order]
+
+    th, tw = template.shape[:2]
+    size = tw * th
+    kept = []
+    alive = np.ones(len(xs), dtype=bool)
+    for i in range(len(xs)):
+        if not alive[i]:
+            continue
+        kept.append((int(xs[i]), int(ys[i])))
+        inter = np.clip(tw - np.abs(xs - xs[i]), 0, None) * np.clip(th - np.abs(ys - ys[i]), 0, None)
+        alive &= inter / (2 * size - inter) <= overlap
+    return kept
+
 
 class TM:
-    def __init__(self, feed: Callable, threshold: float = 0.85, mode=0):
+    def __init__(self, feed: Callable, threshold: float = 0.85, mode=0, pool: BufferPool = None,
+                 client: 'MatchClient' = None, fft_min_area: int = FFT_MIN_AREA, dirty_block: int = DIRTY_BLOCK,
+                 dirty_tolerance: int = DIRTY_TOLERANCE):
         """
         :param feed: the screencap feed function
-        :param threshold: the default threshold of matching.
+        :param threshold: the default threshold of matching, for the images without one in the manifest.
+        :param pool: the pool of the converted screens and the matching results, usually shared with the device.
+            If not given, a new one is created.
+        :param client: the client of the matching service to match with, see `matchserver`.
+            If not given, or if the service fails, match in this process.
+        :param fft_min_area: the min area of a template searched on the whole screen with 'ccoeff_normed'
+            for it to be matched in the frequency domain, see `fft_score_map`. Set it 0 to always match in space.
+        :param dirty_block: the size of the blocks compared between two screens, see `dirty_blocks`. The match of
+            a template is reused on the next screen if no block of its search area changed. Set it 0 to match
+            every screen anew.
+        :param dirty_tolerance: the max difference of a pixel between two screens still counted as unchanged.
         """
 
         self.feed = feed
+        self.pool = pool or BufferPool()
 
         self.threshold = threshold
         self.mode = mode
         # template image set
         self.images = {}
+        # template images converted for matching, see `prepare`, made on demand
+        self.prepared_images = {}
+        # the spectra of the template images, see `template_spectra`, made on demand
+        self.fft_min_area = fft_min_area
+        self.template_spectra = {}
+        # the matching settings of the images, see `DEFAULT_ENTRY`
+        self.manifest = {}
+        self.dirty_block = dirty_block
+        self.dirty_tolerance = dirty_tolerance
+        # the matching value, the top-left coords of the best match and the blocks of the search area,
+        # by (image, roi), kept while the search area is unchanged
+        self.__results = {}  # type: Dict[tuple, Tuple[float, Tuple[int, int], Tuple[slice, slice]]]
+        # the images of the set are loaded by the service on its own
+        self.client = None
         self.load_images()
+        self.client = client
 
         # the screencap image. Needs to be updated before matching.
         self.screen = None
+        # the screen converted for matching, and its spectra, by (gray, scale)
+        self.__prepared = {}
+        self.__spectra = {}
+        # whether the screen was sent to the matching service
+        self.__sent = False
+        # the screen the kept match results were matched on. Only its dirty blocks are updated, so that slow
+        # changes add up until they exceed the tolerance.
+        self.__reference = None  # type: np.ndarray
 
     def load_image(self, im: Path, name=''):
         """
@@ -45,6 +410,14 @@ class TM:
         assert im.is_file() and im.name.endswith('.png')
         name = name or im.name[:-4]
         self.images[name] = cv.imread(str(im), cv.IMREAD_COLOR)
+        for key in [key for key in self.prepared_images if key[0] == name]:
+            del self.prepared_images[key]
+        for key in [key for key in self.template_spectra if key[0] == name]:
+            del self.template_spectra[key]
+        for key in [key for key in self.__results if key[0] == name]:
+            del self.__results[key]
+        if self.client is not None:
+            self.__remote(self.client.load_image, name, self.images[name])
         # self.images[name] = cv.cvtColor(self.images[name], cv.COLOR_BGR2RGB)
         # plt.figure(name)
         # plt.imshow(self.images[name])
@@ -53,7 +426,7 @@ class TM:
 
     def load_images(self):
         """
-        Load template images from directory.
+        Load template images from directory, along with the manifest (manifest.json) if present.
         """
         if self.mode == 0:
             im_dir = Path(__file__).absolute().parent / 'images0'
@@ -65,8 +438,42 @@ class TM:
         for im in im_dir.glob('*.png'):
             self.load_image(im)
 
+        manifest = im_dir / 'manifest.json'
+        if manifest.is_file():
+            with open(str(manifest)) as f:
+                self.manifest = json.load(f)
+            self.__results = {}
+            logger.debug('Manifest loaded with {} entries.'.format(len(self.manifest)))
+
         logger.info('Images loaded successfully.')
 
+    def entry(self, im: str) -> dict:
+        """
+        Return the matching settings of given image, with the defaults filled in.
+
+        :param im: the name of the image
+        :return: the manifest entry, see `DEFAULT_ENTRY`.
+        """
+        entry = dict(DEFAULT_ENTRY)
+        entry.update(self.manifest.get(im, {}))
+        if entry['threshold'] is None:
+            entry['threshold'] = self.threshold
+        return entry
+
+    def get_threshold(self, im: str, threshold: float = None, default: float = None) -> float:
+        """
+        Return the threshold of matching of given image.
+
+        :param im: the name of the image
+        :param threshold: the threshold given by the caller, which takes precedence if not None.
+        :param default: the threshold if neither given nor in the manifest. If not given, the default threshold.
+        :return: the threshold.
+        """
+        for value in (threshold, self.manifest.get(im, {}).get('threshold'), default):
+            if value is not None:
+                return value
+        return self.threshold
+
     def getsize(self, im: str) -> Tuple[int, int]:
         """
         Return the size of given image.
@@ -82,57 +489,333 @@ class TM:
         Update the screencap image from feed.
         """
         self.screen = self.feed()
+        self.__prepared = {}
+        self.__spectra = {}
+        self.__sent = False
+        self.__track_changes()
         logger.debug('Screen updated.')
 
-    def probability(self, im: str) -> float:
+    def set_screen(self, screen: np.ndarray):
         """
-        Return the probability of the existence of given image.
+        Set the screen directly, e.g. a recorded frame.
+
+        :param screen: the screen, in BGR.
+        """
+        self.screen = screen
+        self.__prepared = {}
+        self.__spectra = {}
+        self.__sent = False
+        self.__track_changes()
+
+    def __track_changes(self):
+        """
+        Drop the match results whose search area changed on the new screen, see `dirty_blocks`.
+        """
+        ref = self.__reference
+        if not self.dirty_block or ref is None or ref.shape != self.screen.shape:
+            self.__results = {}
+            self.__reference = self.screen.copy() if self.dirty_block else None
+            return
+        dirty = dirty_blocks(ref, self.screen, self.dirty_block, self.dirty_tolerance, self.pool)
+        if dirty.all():
+            np.copyto(ref, self.screen)
+            self.__results = {}
+            return
+        b = self.dirty_block
+        for by, bx in zip(*np.nonzero(dirty)):
+            ref[by * b:(by + 1) * b, bx * b:(bx + 1) * b] = self.screen[by * b:(by + 1) * b, bx * b:(bx + 1) * b]
+        self.__results = {key: result for key, result in self.__results.items() if not dirty[result[2]].any()}
+        logger.debug('{} of {} blocks changed, {} results kept.'.format(
+            np.count_nonzero(dirty), dirty.size, len(self.__results)))
+
+    def __remember(self, im: str, roi: Tuple[int, int, int, int], max_val: float, max_loc: Tuple[int, int]):
+        """
+        Keep a match result until its search area changes.
 
         :param im: the name of the image.
-        :return: the probability (confidence).
+        :param roi: the region given by the caller, the key of the result.
+        """
+        area = roi or self.entry(im)['roi']
+        blocks = (slice(None), slice(None))
+        if area is not None and self.dirty_block:
+            x, y, w, h = area
+            b = self.dirty_block
+            blocks = (slice(y // b, -(-(y + h) // b)), slice(x // b, -(-(x + w) // b)))
+        self.__results[im, roi] = (max_val, max_loc, blocks)
+
+    def __screen(self, gray: bool = False, scale: float = 1.0) -> np.ndarray:
+        """
+        Return the screen, converted for matching.
+        """
+        if (gray, scale) not in self.__prepared:
+            self.__prepared[gray, scale] = prepare(self.screen, gray, scale, self.pool)
+        return self.__prepared[gray, scale]
+
+    def __area(self, roi: Tuple[int, int, int, int] = None, gray: bool = False,
+               scale: float = 1.0) -> Tuple[np.ndarray, int, int]:
+        """
+        Return a region of the screen without copying, along with its top-left coords.
+
+        :param roi: the region (x, y, w, h). If not given, return the whole screen.
+        :param gray: whether to return the grayscale screen.
+        :param scale: the factor the screen is resized by.
+        :return: the region and its top-left coords, in screen coords.
+        """
+        screen = self.__screen(gray, scale)
+        if roi is None:
+            return screen, 0, 0
+        x, y, w, h = (int(v * scale) for v in roi)
+        return screen[y:y + h, x:x + w], int(x / scale), int(y / scale)
+
+    def __template(self, im: str, gray: bool = False, scale: float = 1.0) -> np.ndarray:
+        """
+        Return the template image, converted for matching.
+        """
+        if (im, gray, scale) not in self.prepared_images:
+            self.prepared_images[im, gray, scale] = prepare(self.images[im], gray, scale)
+        return self.prepared_images[im, gray, scale]
+
+    def __fft_match(self, im: str, gray: bool = False, scale: float = 1.0) -> Tuple[float, Tuple[int, int]]:
+        """
+        Match the template image against the whole screen in the frequency domain.
+
+        :return: the matching value and the top-left coords of the best match, in screen coords.
+        """
+        if (gray, scale) not in self.__spectra:
+            self.__spectra[gray, scale] = screen_spectra(self.__screen(gray, scale))
+        spectra = self.__spectra[gray, scale]
+        key = (im, gray, scale) + spectra.size
+        if key not in self.template_spectra:
+            self.template_spectra[key] = template_spectra(self.__template(im, gray, scale), spectra.size)
+        res = fft_score_map(spectra, self.template_spectra[key], self.pool)
+        _, max_val, _, max_loc = cv.minMaxLoc(res)
+        return max_val, (int(max_loc[0] / scale), int(max_loc[1] / scale))
+
+    def __remote(self, f: Callable, *args):
+        """
+        Call the matching service. If it fails, stop using it.
+
+        :return: the result of the call. Return None if failed.
         """
-        assert self.screen is not None
         try:
-            template = self.images[im]
-        except KeyError:
+            return f(*args)
+        except (OSError, EOFError) as e:
+            logger.error('The matching service failed, match locally from now on: {}'.format(e))
+            self.client = None
+            return None
+
+    def __match_remote(self, ims: List[str], roi: Tuple[int, int, int, int] = None) -> list:
+        """
+        Match template images with the matching service, in one request.
+
+        :return: the matching value and the top-left coords of the best match of each image.
+            Return None if the service failed.
+        """
+        if not self.__sent:
+            self.__remote(self.client.set_screen, self.screen)
+            self.__sent = True
+        queries = []
+        for im in ims:
+            entry = self.entry(im)
+            queries.append((im, roi or entry['roi'], entry['method'], entry['color'] == 'gray', entry['scale']))
+        if self.client is None:
+            return None
+        return self.__remote(self.client.match, queries)
+
+    def __match(self, im: str, roi: Tuple[int, int, int, int] = None) -> Tuple[float, Tuple[int, int]]:
+        """
+        Match the template image against the screen, or a region of it.
+
+        :param im: the name of the image.
+        :param roi: the region to search in (x, y, w, h). If not given, use the region in the manifest, if any.
+        :return: the matching value and the top-left coords of the best match, in screen coords.
+            Return (0.0, (-1, -1)) if the image is unknown.
+        """
+        assert self.screen is not None
+        if im not in self.images:
             logger.error('Unexpected image name {}'.format(im))
-            return 0.0
+            return 0.0, (-1, -1)
 
-        res = cv.matchTemplate(self.screen, template, TM_METHOD)
-        _, max_val, _, max_loc = cv.minMaxLoc(res)
+        roi = tuple(roi) if roi else None
+        if (im, roi) in self.__results:
+            max_val, max_loc, _ = self.__results[im, roi]
+            logger.debug('im: {} unchanged, max_val = {}, max_loc = {}'.format(im, max_val, max_loc))
+            return max_val, max_loc
+
+        if self.client is not None:
+            results = self.__match_remote([im], roi)
+            if results is not None:
+                self.__remember(im, roi, *results[0])
+                return results[0]
+
+        entry = self.entry(im)
+        gray = entry['color'] == 'gray'
+        scale = entry['scale']
+        template = self.__template(im, gray, scale)
+        screen = self.__screen(gray, scale)
+        area = roi or entry['roi']
+        th, tw = template.shape[:2]
+        if (area is None and entry['method'] == 'ccoeff_normed' and 0 < self.fft_min_area <= th * tw
+                and th <= screen.shape[0] and tw <= screen.shape[1]):
+            max_val, max_loc = self.__fft_match(im, gray, scale)
+        else:
+            max_val, max_loc = best_match(screen, template, entry['method'], area, scale, self.pool)
+        self.__remember(im, roi, max_val, max_loc)
         logger.debug('im: {} max_val = {}, max_loc = {}'.format(im, max_val, max_loc))
+        return max_val, max_loc
+
+    def probability(self, im: str, roi: Tuple[int, int, int, int] = None) -> float:
+        """
+        Return the probability of the existence of given image.
+
+        :param im: the name of the image.
+        :param roi: the region to search in (x, y, w, h). If not given, use the region in the manifest, if any.
+        :return: the probability (confidence).
+        """
+        max_val, _ = self.__match(im, roi)
         return max_val
 
-    def find(self, im: str, threshold: float = None) -> Tuple[int, int]:
+    def probabilities(self, ims: List[str], roi: Tuple[int, int, int, int] = None) -> Dict[str, float]:
+        """
+        Return the probability of the existence of several images at once.
+        With the matching service, they are matched in one request.
+
+        :param ims: the names of the images.
+        :param roi: the region to search in (x, y, w, h). If not given, use the regions in the manifest, if any.
+        :return: the probability of each image.
+        """
+        assert self.screen is not None
+        roi = tuple(roi) if roi else None
+        if self.client is not None:
+            # the images whose search area is unchanged are not sent
+            todo = [im for im in ims if im in self.images and (im, roi) not in self.__results]
+            results = self.__match_remote(todo, roi) if todo else []
+            if results is not None:
+                for im, (max_val, max_loc) in zip(todo, results):
+                    self.__remember(im, roi, max_val, max_loc)
+                return {im: self.__results[im, roi][0] if (im, roi) in self.__results else 0.0 for im in ims}
+        return {im: self.probability(im, roi) for im in ims}
+
+    def find(self, im: str, threshold: float = None, roi: Tuple[int, int, int, int] = None) -> Tuple[int, int]:
         """
         Find the template image on screen and return its top-left coords.
 
         Return None if the matching value is less than `threshold`.
 
         :param im: the name of the image
-        :param threshold: the threshold of matching. If not given, will be set to the default threshold.
+        :param threshold: the threshold of matching.
+            If not given, use the threshold in the manifest, or the default threshold.
+        :param roi: the region to search in (x, y, w, h). If not given, use the region in the manifest, if any.
         :return: the top-left coords of the result. Return (-1, -1) if not found.
         """
-        threshold = threshold or self.threshold
+        threshold = self.get_threshold(im, threshold)
+        max_val, max_loc = self.__match(im, roi)
+        return max_loc if max_val >= threshold else (-1, -1)
+
+    def exists(self, im: str, threshold: float = None, roi: Tuple[int, int, int, int] = None) -> bool:
+        """
+        Check if a given image exists on screen.
+
+        :param im: the name of the image
+        :param threshold: the threshold of matching.
+            If not given, use the threshold in the manifest, or the default threshold.
+        :param roi: the region to search in (x, y, w, h). If not given, use the region in the manifest, if any.
+        """
+        threshold = self.get_threshold(im, threshold)
+        return self.probability(im, roi) >= threshold
+
+    def find_all(self, im: str, threshold: float = None, roi: Tuple[int, int, int, int] = None,
+                 overlap: float = 0.3) -> List[Tuple[int, int]]:
+        """
+        Find every occurrence of the template image on screen and return their top-left coords.
+        See `match_all`.
+
+        :param im: the name of the image
+        :param threshold: the threshold of matching.
+            If not given, use the threshold in the manifest, or the default threshold.
+        :param roi: the region to search in (x, y, w, h). If not given, use the region in the manifest, if any.
+        :param overlap: the max ratio of intersection over union of two kept matches.
+        :return: the top-left coords of the results, the best match first.
+        """
+        threshold = self.get_threshold(im, threshold)
 
         assert self.screen is not None
         try:
             template = self.images[im]
         except KeyError:
             logger.error('Unexpected image name {}'.format(im))
-            return -1, -1
+            return []
 
-        res = cv.matchTemplate(self.screen, template, TM_METHOD)
-        _, max_val, _, max_loc = cv.minMaxLoc(res)
-        logger.debug('max_val = {}, max_loc = {}'.format(max_val, max_loc))
-        return max_loc if max_val >= threshold else (-1, -1)
+        area, x, y = self.__area(roi or self.entry(im)['roi'])
+
+        locs = match_all(area, template, threshold, overlap, result_buffer(self.pool, area, template))
+        logger.debug('im: {} found {} matches'.format(im, len(locs)))
+        return [(lx + x, ly + y) for lx, ly in locs]
 
-    def exists(self, im: str, threshold: float = None) -> bool:
+    def crop(self, roi: Tuple[int, int, int, int]) -> np.ndarray:
         """
-        Check if a given image exists on screen.
+        Return a copy of a region of the screen.
 
-        :param im: the name of the image
-        :param threshold: the threshold of matching. If not given, will be set to the default threshold.
+        :param roi: the region in (x, y, w, h).
+        :return: the region of the screen.
+        """
+        assert self.screen is not None
+        x, y, w, h = roi
+        return self.screen[y:y + h, x:x + w].copy()
+
+    def find_rows(self, ims: List[str], roi: Tuple[int, int, int, int], row_height: int,
+                  threshold: float = None) -> List[Tuple[str, Tuple[int, int]]]:
         """
-        threshold = threshold or self.threshold
-        return self.probability(im) >= threshold
+        Match a set of templates against every row of a region in one pass.
+
+        The region is tiled into rows of `row_height` pixels. Each template is correlated once with the
+        whole region, and the best match whose top-left corner lies in each row is picked.
+
+        :param ims: the names of the images.
+        :param roi: the region in (x, y, w, h).
+        :param row_height: the height of a row in pixels.
+        :param threshold: the threshold of matching.
+            If not given, use the threshold of each image in the manifest, or the default threshold.
+        :return: the name and the top-left coords of the best match of each row, from top to bottom.
+            Return ('', (-1, -1)) for the rows without match.
+        """
+        assert self.screen is not None
+        x, y, w, h = roi
+        area = self.screen[y:y + h, x:x + w]
+        n_rows = -(-h // row_height)
+
+        best_val = np.full(n_rows, -1.0, dtype=np.float32)
+        best_im = [''] * n_rows
+        best_loc = np.zeros((n_rows, 2), dtype=np.int64)
+        for im in ims:
+            try:
+                template = self.images[im]
+            except KeyError:
+                logger.error('Unexpected image name {}'.format(im))
+                continue
+
+            res = cv.matchTemplate(area, template, TM_METHOD, result=result_buffer(self.pool, area, template))
+            res_h, res_w = res.shape
+            tiles = np.full((n_rows * row_height, res_w), -1.0, dtype=np.float32)
+            tiles[:res_h] = res
+            tiles = tiles.reshape(n_rows, -1)
+            idx = tiles.argmax(axis=1)
+            val = tiles[np.arange(n_rows), idx]
+            # only the matches above the threshold of the image compete
+            val[val < self.get_threshold(im, threshold)] = -1.0
+
+            better = val > best_val
+            best_val[better] = val[better]
+            best_loc[better, 0] = x + idx[better] % res_w
+            best_loc[better, 1] = y + np.arange(n_rows)[better] * row_height + idx[better] // res_w
+            for r in np.flatnonzero(better):
+                best_im[r] = im
+
+        logger.debug('Row matching values: {}'.format(best_val))
+        result = []
+        for r in range(n_rows):
+            if best_im[r]:
+                result.append((best_im[r], (int(best_loc[r, 0]), int(best_loc[r, 1]))))
+            else:
+                result.append(('', (-1, -1)))
+        return result
@@ -0,0 +1,59 @@
+from pathlib import Path
+
+import pytest
+
+from gamebots.assist import MailboxTask, RewardTask
+from gamebots.engine import Engine
+from gamebots.simulator import SimDevice
+
+
+def test_mailbox_batch_stops_when_rows_stay(tmp_path):
+    # the taps take effect too late, so the tapped row stays on the screen
+    device = SimDevice(latency=100.0, capture_latency=0.0, seed=1)
+    engine = Engine(device=device)
+    quest, _ = device.save_images(str(tmp_path))
+    engine.tm.load_image(Path(quest), name='e_0')
+
+    task = MailboxTask(engine, n_iter=1)
+    task.tap_interval = 0.0
+    task.max_stalls = 2
+    engine.tm.update_screen()
+    assert task.run_batch(['e_0']) == -1
+    assert device.taps == task.max_stalls
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_reward_waits_for_dialogs_strictly(monkeypatch, stream):
+    engine = Engine(device=SimDevice(latency=0.0, capture_latency=0.0, seed=1))
+    waits = {}
+    monkeypatch.setattr(engine, 'wait_until', lambda im, threshold=None, **kwargs: waits.setdefault(im, threshold))
+    monkeypatch.setattr(engine, 'exists', lambda im, threshold=None, **kwargs: True)
+    monkeypatch.setattr(engine, 'find_and_tap', lambda im, threshold=None, **kwargs: True)
+    monkeypatch.setattr(engine, 'wait', lambda sec: None)
+
+    task = RewardTask(engine, n_iter=1)
+    task.run(stream=stream, rate=100.0)
+    # as strict as before the manifest, which is looser for tapping them
+    assert waits['confirm'] == waits['close'] == 0.97
+    assert engine.tm.get_threshold('confirm') == 0.9
+
+
+@pytest.mark.parametrize('changes, swipes', [(True, 3), (False, 1)])
+def test_mailbox_batch_checkpoints_swipes(tmp_path, monkeypatch, changes, swipes):
+    device = SimDevice(latency=0.0, capture_latency=0.0, seed=1)
+    engine = Engine(device=device)
+    _, friend = device.save_images(str(tmp_path))
+    # no wanted item on the screen
+    engine.tm.load_image(Path(friend), name='e_0')
+    monkeypatch.setattr(engine, 'wait', lambda sec: engine.tm.update_screen())
+    if changes:
+        # the list goes on
+        monkeypatch.setattr('gamebots.assist.frame_diff', lambda a, b: 100.0)
+
+    task = MailboxTask(engine, n_iter=3)
+    done = []
+    task.on_checkpoint = done.append
+    engine.tm.update_screen()
+    assert task.run_batch(['e_0']) == 0
+    # stopped after n_iter swipes, or at the end of the list
+    assert done == list(range(1, swipes + 1))
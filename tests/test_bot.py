@@ -0,0 +1,157 @@
+import pytest
+
+from gamebots.bot import BattleBot, AP_REGEN
+from gamebots.drops import DropCounter
+from gamebots.engine import Engine, ScreenError
+from gamebots.simulator import SimDevice, BATTLE, BOND, CONT, MENU
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    monkeypatch.setattr('gamebots.bot.INTERVAL_SHORT', 0.01)
+    device = SimDevice(latency=0.0, capture_latency=0.0, seed=1)
+    quest, friend = device.save_images(str(tmp_path))
+    engine = Engine(device=device)
+    # no masks are loaded from the tree in the tests
+    engine.digits.loaded[:] = False
+    return BattleBot(quest=quest, friend=friend, engine=engine)
+
+
+def cut_ap_glyphs(bot):
+    """
+    Cut every glyph of the digit reader from the AP shown on the menu, as `calibrate --digits` does.
+    """
+    device, reader = bot.device, bot.engine.digits
+    ap = device.ap
+    for text in ('123/456', '789/100'):
+        device.ap = tuple(int(v) for v in text.split('/'))
+        assert reader.add_glyphs(device.capture(), bot.engine.button('ap'), text)
+    device.ap = ap
+    assert reader.ready
+
+
+def cut_wave_glyphs(bot):
+    """
+    Cut every glyph, then the glyphs of the wave counter from the battle screens, whose font is larger.
+    """
+    cut_ap_glyphs(bot)
+    device, state = bot.device, bot.device.state
+    device.state = BATTLE
+    for wave in range(1, device.stage_count + 1):
+        device.wave = wave
+        text = '{}/{}'.format(wave, device.stage_count)
+        assert bot.engine.digits.add_glyphs(device.capture(), bot.engine.button('wave'), text)
+    device.state, device.wave = state, 1
+
+
+@pytest.mark.parametrize('fast_end', [False, True])
+def test_end_battle_deadline(bot, fast_end):
+    # the result screens never show up
+    bot.device.state = BATTLE
+    bot.fast_end = fast_end
+    bot.poll_interval = 0.01
+    bot.engine.wait_timeout = 0.3
+    with pytest.raises(ScreenError):
+        bot.end_battle()
+    assert bot.device.state == BATTLE
+
+
+def test_end_battle_fast_learns_screens(bot, monkeypatch):
+    device = bot.device
+    bot.fast_end = True
+    bot.poll_interval = 0.01
+    bot.engine.wait_timeout = 10
+    matched = []
+    exists = bot.engine.exists
+    monkeypatch.setattr(bot.engine, 'exists', lambda im, **kwargs: matched.append(im) or exists(im, **kwargs))
+
+    # the drop and friend request screens are told apart by their buttons, then learned
+    device.state = BOND
+    bot.end_battle()
+    # the last tap takes effect on the next capture
+    device.capture()
+    assert device.state == CONT
+    assert sorted(set(bot.engine.screens.names)) == ['drops', 'friend_request']
+    assert {'next_step', 'not_apply'} <= set(matched)
+
+    # with a reference of the bond screen, no button is matched anymore
+    device.state = BOND
+    bot.engine.screens.add('bond', device.capture())
+    matched.clear()
+    bot.end_battle()
+    device.capture()
+    assert device.state == CONT
+    assert set(matched) == {'reconnect'}
+
+
+@pytest.mark.parametrize('ap, masks, secs', [
+    ((140, 142), True, 0),
+    ((10, 142), True, 30 * AP_REGEN),
+    # the AP cannot be read, so wait for the full cost
+    ((10, 142), False, 40 * AP_REGEN),
+])
+def test_wait_ap(bot, monkeypatch, ap, masks, secs):
+    slept = []
+    monkeypatch.setattr('gamebots.bot.sleep', slept.append)
+    bot.ap_cost, bot.wait_ap = 40, True
+    bot.device.ap = ap
+    if masks:
+        cut_ap_glyphs(bot)
+        assert bot.read_ap() == ap
+    else:
+        assert bot.read_ap() == (-1, -1)
+
+    assert bot.device.state == MENU
+    assert bot._BattleBot__wait_ap()
+    assert sum(slept) == secs
+    # the game refused to enter the quest: at least one more AP
+    slept.clear()
+    assert bot._BattleBot__wait_ap(at_least=1)
+    assert sum(slept) == max(secs, AP_REGEN)
+
+
+def test_wait_ap_above_max(bot, monkeypatch):
+    monkeypatch.setattr('gamebots.bot.sleep', lambda secs: pytest.fail('slept'))
+    cut_ap_glyphs(bot)
+    bot.ap_cost, bot.wait_ap = 150, True
+    assert not bot._BattleBot__wait_ap()
+
+
+@pytest.mark.parametrize('masks', [True, False])
+def test_play_battle_reads_waves(bot, monkeypatch, masks):
+    monkeypatch.setattr('gamebots.bot.INTERVAL_LONG', 0.01)
+    device = bot.device
+    # each wave takes two turns
+    device.turns = 2
+    if masks:
+        cut_wave_glyphs(bot)
+    played = []
+    for stage in range(1, 4):
+        bot.at_stage(stage)(lambda stage=stage: played.append(stage) or bot.attack([1, 2, 3]))
+
+    device.state = BATTLE
+    bot.tm.update_screen()
+    if masks:
+        assert bot._BattleBot__get_current_stage() == 1
+        # a stage is played again until the wave counter changes
+        assert bot.play_battle() == 6
+        assert played == [1, 1, 2, 2, 3, 3]
+        device.capture()
+        assert device.state == BOND
+    else:
+        assert bot._BattleBot__get_current_stage() == -1
+        # without the wave counter, every stage is assumed to take one round
+        assert bot.play_battle() == 3
+        assert played == [1, 2, 3]
+        device.capture()
+        assert device.state == BATTLE and device.wave == 2
+
+
+def test_run_flushes_drops(bot, tmp_path):
+    counter = DropCounter(str(tmp_path), str(tmp_path / 'drops.csv'))
+    flushed = []
+    counter.flush = lambda: flushed.append(True)
+    bot.drops = counter
+    bot.run(max_loops=0)
+    assert flushed
+    counter.close()
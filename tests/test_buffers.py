@@ -0,0 +1,41 @@
+import numpy as np
+
+from gamebots.buffers import BufferPool
+from gamebots.tm import prepare
+
+
+def test_rings():
+    pool = BufferPool(depth=2)
+    a = pool.get('screen', (4, 6, 3))
+    b = pool.get('screen', (4, 6, 3))
+    assert a is not b and a.shape == (4, 6, 3) and a.dtype == np.uint8
+    # handed out in turn
+    assert pool.get('screen', (4, 6, 3)) is a
+    assert pool.get('screen', (4, 6, 3)) is b
+
+    # another tag, shape or dtype is another ring
+    assert not any(np.shares_memory(pool.get('gray', (4, 6, 3)), x) for x in (a, b))
+    assert not any(np.shares_memory(pool.get('screen', (4, 6)), x) for x in (a, b))
+    assert pool.get('screen', (4, 6, 3), np.float32).dtype == np.float32
+    assert pool.nbytes == 2 * (72 + 72 + 24 + 72 * 4)
+
+
+def test_clear():
+    pool = BufferPool(depth=1)
+    a = pool.get('screen', (4, 6))
+    assert pool.get('screen', (4, 6)) is a
+    pool.clear()
+    assert pool.nbytes == 0
+    assert pool.get('screen', (4, 6)) is not a
+
+
+def test_prepare_reuses_buffers():
+    pool = BufferPool()
+    image = np.random.RandomState(0).randint(0, 256, (40, 60, 3)).astype(np.uint8)
+    first = prepare(image, gray=True, scale=0.5, pool=pool)
+    nbytes = pool.nbytes
+    for _ in range(4):
+        prepare(image, gray=True, scale=0.5, pool=pool)
+    # no more memory once every shape has been seen
+    assert pool.nbytes == nbytes
+    assert np.array_equal(first, prepare(image, gray=True, scale=0.5))
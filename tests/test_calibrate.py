@@ -0,0 +1,86 @@
+import json
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from gamebots.calibrate import best_threshold, calibrate, cost, tight_roi, write_manifest, ROI_PADDING
+from gamebots.simulator import SimDevice, LAYOUT, SCREENS, MENU, SUPPORT, BATTLE, CONT
+
+
+def test_best_threshold():
+    threshold, margin = best_threshold(np.array([0.95, 0.99, 0.97]), np.array([0.5, 0.81, 0.7]))
+    assert threshold == pytest.approx(0.88) and margin == pytest.approx(0.14)
+
+    # not separable: the threshold with the fewest errors, and a negative margin
+    threshold, margin = best_threshold(np.array([0.6, 0.95, 0.97, 0.99]), np.array([0.5, 0.8, 0.7]))
+    assert threshold == pytest.approx(0.95) and margin == pytest.approx(-0.2)
+    threshold, margin = best_threshold(np.array([0.9, 0.95]), np.array([0.92, 0.3, 0.4]))
+    assert threshold == pytest.approx(0.9) and margin == pytest.approx(-0.02)
+
+    # without negative frames, anything above 0 separates
+    threshold, margin = best_threshold(np.array([0.8, 0.9]), np.array([]))
+    assert threshold == pytest.approx(0.4) and margin == pytest.approx(0.8)
+
+
+def test_tight_roi():
+    size = (1280, 720)
+    assert tight_roi([(100, 200), (140, 180)], (50, 30), size) == (
+        100 - ROI_PADDING, 180 - ROI_PADDING, 90 + 2 * ROI_PADDING, 50 + 2 * ROI_PADDING)
+    # clamped to the screen
+    assert tight_roi([(5, 700)], (50, 30), size) == (0, 700 - ROI_PADDING, 55 + ROI_PADDING, 20 + ROI_PADDING)
+    assert tight_roi([(1250, 0)], (30, 20), size) == (1250 - ROI_PADDING, 0, 30 + ROI_PADDING, 20 + ROI_PADDING)
+
+
+def test_cost():
+    full = cost((1280, 720), (50, 30), None, 'color', 1.0)
+    assert cost((1280, 720), (50, 30), None, 'gray', 1.0) == pytest.approx(full / 3)
+    assert cost((1280, 720), (50, 30), None, 'color', 0.5) == pytest.approx(full / 16)
+    assert cost((1280, 720), (50, 30), (0, 0, 100, 60), 'color', 1.0) < full / 100
+
+
+@pytest.fixture(scope='module')
+def corpus(tmp_path_factory):
+    """
+    Record the screens of the simulator, labeled with the templates shown on each.
+    """
+    frames = tmp_path_factory.mktemp('frames')
+    device = SimDevice(latency=0.0, capture_latency=0.0, seed=3)
+    labels = {}
+    for state in (MENU, SUPPORT, BATTLE, CONT):
+        device.state = state
+        for i in range(2):
+            name = '{}_{}.png'.format(state, i)
+            cv.imwrite(str(frames / name), device.capture())
+            labels[name] = [im for im in SCREENS[state] if im not in ('quest', 'friend')]
+    with open(str(frames / 'labels.json'), 'w') as f:
+        json.dump(labels, f)
+    return frames
+
+
+def test_calibrate(corpus, tmp_path):
+    report = calibrate(corpus, jobs=2, templates=['attack', 'menu', 'reset'])
+    # only the templates shown on a frame
+    assert sorted(report) == ['attack', 'menu']
+    for im, r in report.items():
+        assert len(r['positives']) == 2 and r['margin'] > 0.05, im
+        assert r['positives'].min() > r['threshold'] > r['negatives'].max()
+        s = r['suggested']
+        assert s['margin'] >= 0.05 and s['cost'] <= r['current']['cost']
+        assert r['current']['cost'] / s['cost'] > 10, im
+
+    # the suggested region holds the template
+    for im in report:
+        roi = report[im]['suggested']['roi']
+        x, y = LAYOUT[im]
+        assert roi is None or roi[0] <= x < roi[0] + roi[2] and roi[1] <= y < roi[1] + roi[3]
+
+    path = tmp_path / 'manifest.json'
+    write_manifest(report, path=path)
+    with open(str(path)) as f:
+        manifest = json.load(f)
+    s = report['attack']['suggested']
+    assert manifest['attack']['threshold'] == round(s['threshold'], 4)
+    assert (manifest['attack']['scale'], manifest['attack']['roi']) == (s['scale'], s['roi'])
+    # the other templates and settings are kept
+    assert manifest['reset']['threshold'] == 0.9 and manifest['attack']['method'] == 'ccoeff_normed'
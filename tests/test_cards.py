@@ -0,0 +1,112 @@
+import json
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from gamebots.cards import CardReader, Cards, pick_cards, ARTS, BUSTER, QUICK
+from gamebots.simulator import CARD_COLORS
+
+B, A, Q = BUSTER, ARTS, QUICK
+# the colors of the simulator: a red, a blue and a green
+COLOR_OF = {B: CARD_COLORS[0], A: CARD_COLORS[1], Q: CARD_COLORS[2]}
+
+
+@pytest.fixture(scope='module')
+def buttons():
+    with open(str(Path(__file__).absolute().parent.parent / 'gamebots' / 'config' / 'buttons.json')) as f:
+        return json.load(f)
+
+
+def frame(buttons, colors, owners=None, nps=(None, None, None), seed=0):
+    """
+    Draw a card selection screen: each card is a rectangle of its color, with the portrait of its servant on top,
+    over a dark background, with some noise.
+    """
+    rng = np.random.RandomState(seed)
+    image = cv.resize(rng.randint(0, 60, (9, 16, 3)).astype(np.uint8), (1280, 720), interpolation=cv.INTER_CUBIC)
+    portraits = [cv.resize(rng.randint(0, 256, (4, 6, 3)).astype(np.uint8), (100, 30),
+                           interpolation=cv.INTER_NEAREST) for _ in range(3)]
+    card, noble, distance = buttons['card'], buttons['noble_card'], buttons['card_distance']
+    for i, color in enumerate(colors):
+        x, y, w, h = card['x'] + distance * i, card['y'], card['w'], card['h']
+        cv.rectangle(image, (x, y), (x + w - 1, y + h - 1), COLOR_OF[color], -1)
+        if owners:
+            image[y:y + 30, x:x + w] = portraits[owners[i] - 1]
+    for i, color in enumerate(nps):
+        x, y, w, h = noble['x'] + distance * i, noble['y'], noble['w'], noble['h']
+        # a noble phantasm not ready is not shown, the background stays
+        if color:
+            cv.rectangle(image, (x, y), (x + w - 1, y + h - 1), COLOR_OF[color], -1)
+    noise = rng.randint(-8, 9, image.shape)
+    return np.clip(image.astype(int) + noise, 0, 255).astype(np.uint8)
+
+
+def test_colors(buttons):
+    reader = CardReader(buttons)
+    cards = reader.read(frame(buttons, [B, A, Q, Q, B], nps=(None, A, B)))
+    assert cards.colors == [B, A, Q, Q, B]
+    assert cards.np_ready == [False, True, True]
+    assert cards.np_colors == ['', A, B]
+
+
+def test_colors_dimmed(buttons):
+    # the cards dim while the game animates them
+    image = frame(buttons, [A, B, Q, A, Q], nps=(Q, None, None))
+    cards = CardReader(buttons).read((image * 0.6).astype(np.uint8))
+    assert cards.colors == [A, B, Q, A, Q]
+    assert cards.np_ready == [True, False, False]
+
+
+@pytest.mark.parametrize('color, bgr', [
+    # an orange red, a light blue and a yellow green, as the cards of the game lean
+    (B, (30, 80, 230)), (A, (240, 150, 50)), (Q, (60, 210, 150)),
+    # and darker
+    (B, (20, 20, 120)), (A, (110, 50, 10)), (Q, (20, 100, 30)),
+])
+def test_color_tones(buttons, color, bgr, monkeypatch):
+    monkeypatch.setitem(COLOR_OF, color, bgr)
+    others = [c for c in (B, A, Q) if c != color]
+    cards = CardReader(buttons).read(frame(buttons, [color] + others * 2, nps=(color, None, None)))
+    assert cards.colors == [color] + others * 2
+    assert cards.np_colors == [color, '', '']
+
+
+def test_owners(buttons):
+    image = frame(buttons, [B, A, Q, Q, B], owners=[2, 1, 2, 3, 1])
+    reader = CardReader(buttons)
+    # numbered in order of appearance without portraits
+    assert reader.read(image).owners == [1, 2, 1, 3, 2]
+
+    card = buttons['card']
+    for servant, i in ((1, 1), (2, 0), (3, 3)):
+        x = card['x'] + buttons['card_distance'] * i
+        reader.add_servant(servant, image[card['y']:card['y'] + card['h'], x:x + card['w']])
+    other = frame(buttons, [Q, Q, A, B, B], owners=[3, 2, 2, 1, 3], seed=0)
+    assert reader.read(other).owners == [3, 2, 2, 1, 3]
+
+
+def cards(colors, owners=(1, 2, 3, 1, 2), np_colors=('', '', '')):
+    return Cards(list(colors), list(owners), [bool(c) for c in np_colors], list(np_colors))
+
+
+@pytest.mark.parametrize('recognized, nps, picked', [
+    # a chain of one color
+    (cards([B, A, Q, B, B]), (), [1, 4, 5]),
+    (cards([Q, A, Q, B, Q]), (), [1, 3, 5]),
+    # else a chain of one servant, Buster first
+    (cards([Q, A, Q, B, A], owners=[1, 2, 1, 1, 3]), (), [4, 1, 3]),
+    # else Buster first
+    (cards([Q, A, Q, B, A], owners=[1, 2, 3, 1, 2]), (), [4, 2, 5]),
+    # a noble phantasm ready goes first, then cards of its color
+    (cards([B, A, Q, A, A], np_colors=('', A, '')), [2], [7, 2, 4]),
+    # or of its servant
+    (cards([A, A, A, Q, B], owners=[1, 1, 2, 3, 1], np_colors=(B, '', '')), [1], [6, 5, 1]),
+    # a noble phantasm not ready is skipped
+    (cards([B, A, Q, B, B], np_colors=('', '', '')), [1], [1, 4, 5]),
+    # two of them, then Buster
+    (cards([Q, A, Q, B, A], np_colors=(B, A, '')), [1, 2], [6, 7, 4]),
+])
+def test_pick_cards(recognized, nps, picked):
+    assert pick_cards(recognized, nps=nps) == picked
@@ -0,0 +1,91 @@
+import os
+import sys
+from pathlib import Path
+from time import sleep, time
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+import gamebots
+from gamebots import fakeadb
+from gamebots.device import Device, ScreenStream
+from gamebots.engine import Engine
+
+
+@pytest.fixture
+def device(tmp_path, monkeypatch):
+    monkeypatch.setenv('FGO_FAKE_ADB', str(tmp_path / 'adb'))
+    # SDCARD_PULL pulls into the working directory, from which fakeadb must still be importable
+    monkeypatch.setenv('PYTHONPATH', str(Path(gamebots.__file__).parent.parent))
+    monkeypatch.chdir(tmp_path)
+    return Device(timeout=10, adb_path=[sys.executable, '-m', 'gamebots.fakeadb'])
+
+
+@pytest.fixture
+def screen(device):
+    screen = np.random.RandomState(0).randint(0, 256, (720, 1280, 3)).astype(np.uint8)
+    fakeadb.set_screen(screen)
+    return screen
+
+
+@pytest.mark.parametrize('method', sorted(Device.CAPTURE_METHODS.values()))
+def test_capture(device, screen, method):
+    assert np.array_equal(device.capture(method), screen)
+
+
+def test_select_capture(device, screen, tmp_path):
+    cache = tmp_path / 'capture.json'
+    method = device.select_capture(rounds=1, cache=cache, duration=0.1)
+    assert method in Device.CAPTURE_METHODS.values() and cache.is_file()
+    stats = device.capture_stats
+    assert sorted(stats) == sorted(Device.CAPTURE_METHODS)
+    assert all(s['fps'] > 0 and s['min'] <= s['latency'] <= s['max'] for s in stats.values())
+    # the choice is stored for the device
+    captures = len(fakeadb.commands())
+    device.capture_method = None
+    assert device.select_capture(rounds=1, cache=cache) == method
+    assert fakeadb.commands()[captures:] == ['get-serialno']
+
+
+def test_engine_captures_from_shell(device, screen):
+    engine = Engine(device=device)
+    engine.tm.update_screen()
+    assert np.array_equal(engine.tm.screen, screen)
+    assert fakeadb.commands() == ['shell screencap -p']
+
+
+def test_raw_capture_reuses_frames(device, screen):
+    first = device.capture(Device.RAW)
+    second = device.capture(Device.RAW)
+    assert first is not second
+    nbytes = device.pool.nbytes
+    # the frames of the pool are handed out in turn, without allocating
+    assert device.capture(Device.RAW) is first
+    assert device.pool.nbytes == nbytes
+
+
+@pytest.mark.parametrize('options', [None, 'rtsp_transport;tcp'])
+def test_stream_from_file(tmp_path, monkeypatch, options):
+    if options is not None:
+        monkeypatch.setenv('OPENCV_FFMPEG_CAPTURE_OPTIONS', options)
+    path = str(tmp_path / 'screen.avi')
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*'MJPG'), 30, (320, 180))
+    for i in range(6):
+        writer.write(np.full((180, 320, 3), 40 * i, dtype=np.uint8))
+    writer.release()
+
+    stream = ScreenStream(path, timeout=10)
+    stream.start()
+    try:
+        assert stream.latest().shape == (180, 320, 3)
+        # a file is decoded to its end, and its last frame stays available
+        deadline = time() + 10
+        while stream.frames < 6 and time() < deadline:
+            sleep(0.05)
+        assert stream.frames == 6 and not stream.failed
+        assert abs(float(stream.latest().mean()) - 200) < 2
+    finally:
+        stream.stop()
+    # the options of the stream are not left behind
+    assert os.environ.get('OPENCV_FFMPEG_CAPTURE_OPTIONS') == options
@@ -0,0 +1,51 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from gamebots.digits import DigitReader, GLYPHS
+
+ROI = (0, 0, 120, 30)
+
+
+def render(text, font=cv.FONT_HERSHEY_SIMPLEX):
+    image = np.zeros((30, 120, 3), dtype=np.uint8)
+    cv.putText(image, text, (4, 24), font, 0.7, (255, 255, 255), 2)
+    return image
+
+
+@pytest.fixture
+def reader():
+    reader = DigitReader(mode=0)
+    # no masks are loaded from the tree in the tests
+    reader.loaded[:] = False
+    return reader
+
+
+def test_not_ready_without_every_glyph(reader):
+    assert not reader.ready
+    assert reader.read(render('1/3'), ROI) == ''
+
+    glyphs = reader.add_glyphs(render('1/3'), ROI, '1/3')
+    assert sorted(glyphs) == ['/', '1', '3']
+    assert reader.missing == [c for c in GLYPHS if c not in '1/3']
+    assert reader.read_fraction(render('1/3'), ROI) == (-1, -1)
+
+
+def test_cut_and_read(reader):
+    assert reader.add_glyphs(render('0123'), ROI, '0123')
+    assert reader.add_glyphs(render('4567'), ROI, '4567')
+    assert reader.add_glyphs(render('89/'), ROI, '89/')
+    assert reader.ready
+
+    assert reader.read_fraction(render('2/3'), ROI) == (2, 3)
+    assert reader.read_fraction(render('120/142'), ROI) == (120, 142)
+    # another font does not pass for the one cut
+    assert reader.read(render('2/3', cv.FONT_HERSHEY_COMPLEX), ROI) == ''
+
+
+def test_cut_fails_on_wrong_region(reader):
+    # the region holds fewer glyphs than the text, or cuts through them, e.g. when it is off
+    assert reader.add_glyphs(render('1/3'), (0, 0, 120, 30), '1/30') == {}
+    assert reader.add_glyphs(render('1/3'), (0, 0, 120, 15), '1/3') == {}
+    assert reader.add_glyphs(render('1/3'), (0, 0, 30, 30), '1/') == {}
+    assert not reader.loaded.any()
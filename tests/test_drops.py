@@ -0,0 +1,69 @@
+import csv
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from gamebots.drops import DropCounter
+
+
+def pattern(rng, h, w):
+    return rng.randint(0, 256, (h, w, 3)).astype(np.uint8)
+
+
+@pytest.fixture
+def icons(tmp_path):
+    rng = np.random.RandomState(0)
+    icons = {'bone': pattern(rng, 24, 24), 'gem': pattern(rng, 24, 24)}
+    (tmp_path / 'items').mkdir()
+    for name, icon in icons.items():
+        cv.imwrite(str(tmp_path / 'items' / '{}.png'.format(name)), icon)
+    return icons
+
+
+def drop_screen(icons, counts, seed=1):
+    rng = np.random.RandomState(seed)
+    frame = (pattern(rng, 180, 320) // 4).astype(np.uint8)
+    x = 10
+    for name, n in counts.items():
+        for _ in range(n):
+            frame[40:64, x:x + 24] = icons[name]
+            x += 30
+    return frame
+
+
+def read_log(path):
+    with open(str(path), newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_counts_to_csv(tmp_path, icons):
+    log = tmp_path / 'drops.csv'
+    counter = DropCounter(str(tmp_path / 'items'), str(log), ap_cost=40)
+    assert sorted(counter.items) == ['bone', 'gem']
+
+    frame = drop_screen(icons, {'bone': 3, 'gem': 1})
+    counter.submit(frame)
+    # the frame is copied, so the caller may reuse its buffer right away
+    frame[:] = 0
+    counter.submit(drop_screen(icons, {'gem': 2}, seed=2))
+    counter.flush()
+
+    rows = sorted(read_log(log), key=lambda row: row['run'])
+    assert [(row['run'], row['ap_cost'], row['bone'], row['gem']) for row in rows] == [
+        ('1', '40', '3', '1'), ('2', '40', '0', '2')]
+    assert list(rows[0]) == ['time', 'script', 'run', 'ap_cost', 'bone', 'gem']
+    counter.close()
+
+
+def test_keeps_existing_columns(tmp_path, icons):
+    log = tmp_path / 'drops.csv'
+    log.write_text('time,script,run,ap_cost,gem\n')
+    # the region holds only the first icons
+    counter = DropCounter(str(tmp_path / 'items'), str(log), roi=(0, 0, 70, 180))
+    counter.submit(drop_screen(icons, {'gem': 3}))
+    counter.close()
+
+    rows = read_log(log)
+    assert len(rows) == 1 and list(rows[0]) == ['time', 'script', 'run', 'ap_cost', 'gem']
+    assert rows[0]['gem'] == '2'
@@ -0,0 +1,113 @@
+from pathlib import Path
+
+import pytest
+
+from gamebots.engine import Engine, ScreenError, Task
+from gamebots.simulator import SimDevice, MENU, SUPPORT
+
+
+@pytest.fixture
+def engine(tmp_path):
+    device = SimDevice(latency=0.0, capture_latency=0.0, seed=1)
+    engine = Engine(device=device)
+    quest, friend = device.save_images(str(tmp_path))
+    engine.tm.load_image(Path(quest), name='quest')
+    return engine
+
+
+def test_find_and_tap(engine):
+    engine.tm.update_screen()
+    assert engine.device.state == MENU
+    assert engine.exists('menu')
+    assert engine.find_and_tap('quest')
+    engine.wait_until('refresh_friends', interval=0.0)
+    assert engine.device.state == SUPPORT
+
+
+def test_find_and_tap_missing(engine):
+    engine.tm.update_screen()
+    assert not engine.find_and_tap('attack')
+    assert engine.device.taps == 0
+
+
+def test_tasks(engine):
+    class Count(Task):
+        name = 'count'
+
+        def run(self, n):
+            for i in range(n):
+                self.checkpoint(i + 1)
+            return n
+
+    task = Count(engine)
+    done = []
+    task.on_checkpoint = done.append
+    assert engine.tasks['count'] is task
+    assert engine.run_task('count', 3) == 3
+    assert done == [1, 2, 3]
+    assert task.tm is engine.tm and task.device is engine.device
+
+
+def test_wait_until_timeout(engine):
+    assert engine.wait_until('menu', interval=0.0, timeout=0.5)
+    assert not engine.wait_until('attack', interval=0.05, timeout=0.2)
+
+
+def test_wait_timeout(engine):
+    engine.wait_timeout = 0.2
+    with pytest.raises(ScreenError):
+        engine.wait_until('attack', interval=0.05)
+    # an explicit timeout still returns
+    assert not engine.wait_until('attack', interval=0.05, timeout=0.1)
+
+
+def test_deadline(engine):
+    assert engine.deadline() is None
+    engine.check_deadline(None, 'Nothing')
+    engine.wait_timeout = 0.1
+    deadline = engine.deadline()
+    engine.check_deadline(deadline, 'Something')
+    engine.wait(0.15)
+    with pytest.raises(ScreenError, match='Something'):
+        engine.check_deadline(deadline, 'Something')
+
+
+def quest_rect(engine):
+    engine.tm.update_screen()
+    x, y = engine.tm.find('quest')
+    return (x, y) + engine.tm.getsize('quest')
+
+
+def test_tap_and_confirm(engine):
+    rect = quest_rect(engine)
+    assert engine.tap_and_confirm(*rect, interval=0.01)
+    assert engine.device.taps == 1
+    assert engine.device.state == SUPPORT
+
+
+def test_tap_and_confirm_retries_lost_tap(engine, monkeypatch):
+    device = engine.device
+    tap = device.tap
+    lost = []
+    # the game misses the first tap
+    monkeypatch.setattr(device, 'tap', lambda x, y: lost.append((x, y)) if not lost else tap(x, y))
+    rect = quest_rect(engine)
+    assert engine.tap_and_confirm(*rect, interval=0.01, timeout=0.2)
+    assert len(lost) == 1 and device.taps == 1
+    assert device.state == SUPPORT
+
+
+def test_tap_and_confirm_slow_screen(engine):
+    device = engine.device
+    # the screen changes after the first wait, the taps made meanwhile are ignored
+    device.latency = 0.3
+    rect = quest_rect(engine)
+    assert engine.tap_and_confirm(*rect, interval=0.01, timeout=0.2)
+    assert device.taps == 2 and device.state == SUPPORT
+
+
+def test_tap_and_confirm_gives_up(engine):
+    # nothing to tap there
+    assert not engine.tap_and_confirm(600, 600, 20, 20, retries=2, interval=0.01, timeout=0.1)
+    assert engine.device.taps == 3
+    assert engine.device.state == MENU
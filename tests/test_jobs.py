@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from gamebots.engine import get_engine, share_engines
+from gamebots.jobs import JobQueue, JobWorker, BATTLE, QUEUED, RUNNING, DONE, FAILED, CANCELLED
+from gamebots.simulator import SimDevice
+
+# a battle bot that plays two battles, then quits as if out of AP
+SCRIPT = '''
+from gamebots.bot import BattleBot
+
+
+class Quitter(BattleBot):
+    def run(self, max_loops=999, state='enter', resume=False):
+        for _ in range(min(2, max_loops)):
+            self.count += 1
+            self.checkpoint(self.count)
+
+    def leave(self):
+        pass
+
+
+bot = Quitter(quest='sim_quest.png', friend='sim_friend.png')
+'''
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    yield queue
+    queue.close()
+
+
+@pytest.fixture
+def device():
+    device = SimDevice(latency=0.0, capture_latency=0.0, seed=1)
+    yield device
+    share_engines(False)
+
+
+def test_queue(queue):
+    a = queue.add('bot0.py', count=3)
+    b = queue.add('sortmailbox.py', 'mailbox', args={'batch': True})
+    c = queue.add('bot1.py')
+    assert [job.status for job in queue.jobs()] == [QUEUED] * 3
+    assert queue.jobs(QUEUED)[1].args == {'batch': True}
+
+    job = queue.next()
+    assert (job.id, job.status) == (a, QUEUED)
+    queue.checkpoint(a, 2)
+    assert queue.cancel(c)
+    # a running job cannot be cancelled, and is taken again first, as left by a killed worker
+    assert not queue.cancel(a)
+    job = queue.next()
+    assert (job.id, job.status, job.done, job.count) == (a, RUNNING, 2, 3)
+
+    queue.finish(a)
+    queue.finish(queue.next().id, FAILED, 'error')
+    assert queue.next() is None
+    assert [(job.id, job.status, job.error) for job in queue.jobs()] == [
+        (a, DONE, None), (b, FAILED, 'error'), (c, CANCELLED, None)]
+
+
+def test_battle_jobs(queue, device, tmp_path):
+    device.save_images(str(tmp_path))
+    script = tmp_path / 'quitter.py'
+    script.write_text(SCRIPT)
+    full = queue.add(str(script), BATTLE, count=2)
+    short = queue.add(str(script), BATTLE, count=3)
+    unbounded = queue.add(str(script), BATTLE)
+
+    assert JobWorker(queue, device=device).run() == 3
+    jobs = {job.id: job for job in queue.jobs()}
+    assert (jobs[full].status, jobs[full].done) == (DONE, 2)
+    # the bot quit before the count
+    assert (jobs[short].status, jobs[short].done) == (FAILED, 2)
+    assert jobs[short].error == 'The bot quit after 2 of 3 battles.'
+    # without a count, the job runs until the bot quits
+    assert (jobs[unbounded].status, jobs[unbounded].done, jobs[unbounded].count) == (DONE, 2, None)
+
+
+def test_shared_engine_thresholds(device):
+    share_engines(device=device)
+    battle, assist = get_engine(threshold=0.5), get_engine(threshold=0.97)
+    assert battle.tm is assist.tm and battle.device is assist.device
+    assert (battle.threshold, assist.threshold) == (0.5, 0.97)
+
+    rng = np.random.RandomState(5)
+    t = rng.randint(0, 256, (20, 30, 3)).astype(np.uint8)
+    screen = np.zeros((100, 200, 3), dtype=np.uint8)
+    # a weak match: a third of it is covered
+    screen[40:60, 50:80] = t
+    screen[40:60, 50:60] = 0
+    battle.tm.images['t'] = t
+    battle.tm.set_screen(screen)
+    assert battle.exists('t') and not assist.exists('t')
+    assert assist.exists('t', threshold=0.5)
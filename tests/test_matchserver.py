@@ -0,0 +1,77 @@
+import os
+import stat
+import sys
+import threading
+from multiprocessing import AuthenticationError
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from gamebots.matchserver import MatchServer, MatchClient, load_authkey
+from gamebots.simulator import SimDevice, MENU
+from gamebots.tm import TM
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='Unix sockets')
+
+
+@pytest.fixture
+def server(tmp_path):
+    key = load_authkey(tmp_path / 'run' / 'match.key', create=True)
+    server = MatchServer(str(tmp_path / 'run' / 'match.sock'), workers=2, authkey=key)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    while not os.path.exists(server.address):
+        thread.join(0.01)
+    yield server
+    server.close()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_private_files(server, tmp_path):
+    assert stat.S_IMODE(os.stat(server.address).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(str(tmp_path / 'run' / 'match.key')).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(str(tmp_path / 'run')).st_mode) == 0o700
+    assert len(server.authkey) == 64
+    # the key is kept
+    assert load_authkey(tmp_path / 'run' / 'match.key', create=True) == server.authkey
+
+    with pytest.raises(AuthenticationError):
+        MatchClient(server.address, authkey=b'fgo-bot')
+
+
+def test_match(server, tmp_path):
+    device = SimDevice(latency=0.0, capture_latency=0.0, seed=1)
+    assert device.state == MENU
+    quest, _ = device.save_images(str(tmp_path))
+
+    # the same frame for both, as the frames of the simulator are noisy
+    screen = device.capture()
+    local = TM(feed=lambda: screen)
+    remote = TM(feed=lambda: screen, client=MatchClient(server.address, authkey=server.authkey))
+    for tm in (local, remote):
+        tm.load_image(Path(quest), name='quest')
+        tm.update_screen()
+
+    ims = ['quest', 'menu', 'attack', 'missing']
+    expected = local.probabilities(ims)
+    assert remote.probabilities(ims) == pytest.approx(expected, abs=1e-4)
+    assert remote.client is not None
+    assert remote.find('quest') == local.find('quest') != (-1, -1)
+    # the templates known, each matched once
+    assert server.matches == 3
+
+    # a region and a scale of the screen, shared with the workers anew
+    remote.manifest['menu'] = dict(remote.manifest['menu'], scale=0.5, color='gray')
+    local.manifest['menu'] = remote.manifest['menu']
+    roi = (0, 0, 640, 360)
+    assert remote.probability('menu', roi) == pytest.approx(local.probability('menu', roi), abs=1e-4)
+
+    # a template loaded again replaces the one the workers converted
+    for tm in (local, remote):
+        tm.load_image(Path(quest), name='menu')
+        tm.update_screen()
+    assert remote.find('menu') == local.find('menu') == local.find('quest')
+    assert remote.probability('menu') == pytest.approx(local.probability('menu'), abs=1e-4)
+    remote.client.close()
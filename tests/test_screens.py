@@ -0,0 +1,35 @@
+import numpy as np
+
+from gamebots.screens import ScreenClassifier, signature, distance, STABLE_DISTANCE
+
+
+def screen(seed):
+    rng = np.random.RandomState(seed)
+    small = rng.randint(0, 256, (9, 16, 3)).astype(np.uint8)
+    return np.kron(small, np.ones((80, 80, 1), np.uint8))
+
+
+def test_signature():
+    a = screen(0)
+    noisy = np.clip(a + np.random.RandomState(1).randint(-4, 5, a.shape), 0, 255).astype(np.uint8)
+    assert distance(signature(a), signature(noisy)) < STABLE_DISTANCE
+    assert distance(signature(a), signature(screen(1))) > 0.5
+    assert distance(signature(a), signature(a // 2 + 10)) < STABLE_DISTANCE
+
+
+def test_classify_and_learn():
+    classifier = ScreenClassifier(mode=-1, max_references=2)
+    assert classifier.classify(screen(0)) == ('', 2.0)
+
+    classifier.add('bond', screen(0))
+    name, dist = classifier.classify(screen(0))
+    assert name == 'bond' and dist < 1e-5
+    assert classifier.classify(screen(1))[0] == ''
+
+    # a screen already known is not learned again, and the references of a name are limited
+    assert not classifier.learn('bond', screen(0))
+    assert classifier.learn('drops', screen(1))
+    assert classifier.learn('drops', screen(2))
+    assert not classifier.learn('drops', screen(3))
+    assert classifier.names == ['bond', 'drops', 'drops']
+    assert classifier.classify(screen(2))[0] == 'drops'
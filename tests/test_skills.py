@@ -0,0 +1,57 @@
+import json
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from gamebots.skills import SkillReader
+
+
+@pytest.fixture(scope='module')
+def reader():
+    with open(str(Path(__file__).absolute().parent.parent / 'gamebots' / 'config' / 'buttons.json')) as f:
+        return SkillReader(json.load(f))
+
+
+def icon(rng, ready):
+    """
+    Draw a skill icon: a colorful emblem, or once used, the emblem grayed out and dimmed under its cooldown.
+    """
+    hsv = np.dstack([rng.randint(0, 180, (5, 5)), rng.randint(120, 256, (5, 5)), rng.randint(150, 256, (5, 5))])
+    image = cv.cvtColor(cv.resize(hsv.astype(np.uint8), (50, 50), interpolation=cv.INTER_NEAREST),
+                        cv.COLOR_HSV2BGR)
+    if not ready:
+        gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY) // 3
+        image = cv.cvtColor(gray, cv.COLOR_GRAY2BGR)
+        cv.putText(image, '3', (15, 37), cv.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2)
+    return image
+
+
+def frame(reader, ready, seed=0):
+    rng = np.random.RandomState(seed)
+    image = cv.resize(rng.randint(0, 80, (9, 16, 3)).astype(np.uint8), (1280, 720), interpolation=cv.INTER_CUBIC)
+    for (x, y, w, h), r in zip(reader.rois, ready):
+        if r is not None:
+            image[y:y + h, x:x + w] = icon(rng, r)
+    return image
+
+
+def test_ready_and_cooldown(reader):
+    ready = [True, False, True, False, False, True, True, True, False]
+    # the master skill menu is closed
+    skills = reader.read(frame(reader, ready + [None] * 3))
+    assert skills.servant == [ready[0:3], ready[3:6], ready[6:9]]
+    assert skills.master == [False] * 3
+
+    skills = reader.read(frame(reader, ready + [True, False, True], seed=1))
+    assert skills.master == [True, False, True]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_thresholds(reader, seed):
+    stats = reader.stats(frame(reader, [True] * 6 + [False] * 6, seed=seed))
+    ready, cooldown = stats[:6], stats[6:]
+    # both the saturation and the brightness tell them apart, with a margin
+    assert (ready[:, 0] > reader.min_saturation * 1.5).all() and (cooldown[:, 0] < reader.min_saturation / 2).all()
+    assert (ready[:, 1] > reader.min_brightness * 1.5).all() and (cooldown[:, 1] < reader.min_brightness).all()
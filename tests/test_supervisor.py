@@ -0,0 +1,96 @@
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from gamebots import fakeadb
+from gamebots.bot import ENTER
+from gamebots.device import Device
+from gamebots.engine import ScreenError
+from gamebots.supervisor import Supervisor, ADB_DROPPED, EMULATOR_HUNG, UNKNOWN_SCREEN
+
+ADDR = '127.0.0.1:5555'
+
+
+class FakeBot:
+    """
+    A bot that raises the given failures, one per run, then finishes.
+    """
+
+    def __init__(self, device, failures):
+        self.device = device
+        self.engine = SimpleNamespace(wait_timeout=None)
+        self.telemetry = None
+        self.count = 0
+        self.failures = list(failures)
+        self.runs = []
+
+    def run(self, max_loops, state=ENTER, resume=False):
+        self.runs.append((state, resume))
+        if self.failures:
+            failure = self.failures.pop(0)
+            if failure is not None:
+                raise failure
+            # fail on the next adb command
+            self.device.tap(10, 10)
+        self.count += 1
+
+    def locate(self):
+        return ENTER
+
+
+@pytest.fixture
+def device(tmp_path, monkeypatch):
+    monkeypatch.setenv('FGO_FAKE_ADB', str(tmp_path))
+    device = Device(timeout=2, adb_path=[sys.executable, '-m', 'gamebots.fakeadb'])
+    assert device.connect(ADDR)
+    return device
+
+
+def adb_commands():
+    return [c.split()[0] for c in fakeadb.commands()]
+
+
+def test_adb_dropped_resets_only_this_connection(device):
+    fakeadb.inject('error')
+    bot = FakeBot(device, [None])
+    supervisor = Supervisor(bot, retry_interval=0)
+    assert supervisor.run()
+
+    assert bot.runs == [(ENTER, False), (ENTER, True)]
+    assert supervisor.failures == {ADB_DROPPED: 1}
+    assert adb_commands() == ['connect', 'shell', 'disconnect', 'connect', 'devices']
+    assert device.connected()
+
+
+def test_server_restarted_at_last_attempt(device):
+    # the tap, then the first reconnect (disconnect and connect) fail
+    fakeadb.inject('error', 3)
+    bot = FakeBot(device, [None])
+    supervisor = Supervisor(bot, max_failures=2, retry_interval=0)
+    assert supervisor.run()
+
+    commands = adb_commands()
+    assert commands.count('kill-server') == 1
+    assert commands.index('kill-server') > commands.index('disconnect')
+    assert device.connected()
+
+
+def test_hung_emulator_is_probed_first(device):
+    fakeadb.inject('hang')
+    bot = FakeBot(device, [None])
+    supervisor = Supervisor(bot, retry_interval=0)
+    assert supervisor.run()
+
+    assert supervisor.failures == {EMULATOR_HUNG: 1}
+    # the device responds again, its connection is left alone
+    assert fakeadb.commands() == ['connect ' + ADDR, 'shell input tap 10 10', 'shell wm size']
+
+
+def test_screen_errors_only(device):
+    bot = FakeBot(device, [ScreenError('attack'), ValueError('bug')])
+    supervisor = Supervisor(bot, retry_interval=0, wait_timeout=60)
+    with pytest.raises(ValueError):
+        supervisor.run()
+    assert supervisor.failures == {UNKNOWN_SCREEN: 1}
+    assert bot.engine.wait_timeout is None
@@ -0,0 +1,87 @@
+import argparse
+import sqlite3
+from time import time, strftime, localtime
+
+import pytest
+
+from gamebots.telemetry import Telemetry, query_compare, query_daily, query_failures, query_phases, query_runs
+
+
+def args(**kwargs):
+    values = dict(script=None, device=None, days=None, split=None)
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = tmp_path / 'telemetry.db'
+    for script, device, rounds in [('a.py', 'dev1', 3), ('b.py', 'dev2', 2)]:
+        telemetry = Telemetry(str(path), script=script)
+        telemetry.start_run(device, 'quest')
+        for i in range(2):
+            telemetry.add_phase('battle', 2.0)
+            telemetry.add_phase('enter', 1.0)
+            telemetry.add_phase('battle', 3.0)
+            if i:
+                telemetry.use_ap('gold')
+                telemetry.refresh_friends()
+            telemetry.end_battle(time() - 10, rounds)
+        telemetry.failure('ADB_DROPPED')
+        telemetry.close()
+    db = sqlite3.connect(str(path))
+    yield db
+    db.close()
+
+
+def table(capsys):
+    return [line.split() for line in capsys.readouterr().out.splitlines()]
+
+
+def test_query_runs(db, capsys):
+    query_runs(db, args())
+    rows = table(capsys)
+    assert rows[0][0] == 'run' and len(rows) == 3
+    # the start is printed as a date and a time
+    assert [row[3:6] for row in rows[1:]] == [['a.py', 'dev1', '2'], ['b.py', 'dev2', '2']]
+    # one AP item, one refresh and one failure per run
+    assert [row[-3:] for row in rows[1:]] == [['1', '1', '1']] * 2
+
+    query_runs(db, args(device='dev2'))
+    assert [row[3] for row in table(capsys)[1:]] == ['b.py']
+    query_runs(db, args(script='a.py', device='dev2'))
+    assert len(table(capsys)) == 1
+
+
+def test_query_daily(db, capsys):
+    query_daily(db, args(days=1))
+    rows = table(capsys)
+    today = strftime('%Y-%m-%d', localtime())
+    assert [row[:4] for row in rows[1:]] == [[today, 'a.py', 'dev1', '2'], [today, 'b.py', 'dev2', '2']]
+    # no day before to compare with
+    assert all(len(row) == 7 for row in rows[1:])
+
+
+def test_query_phases(db, capsys):
+    query_phases(db, args(script='a.py'))
+    rows = table(capsys)
+    # in the order of the battle, with the time of a phase added up per battle
+    assert [row[2:] for row in rows[1:]] == [['enter', '2', '1.0', '1.0'], ['battle', '2', '5.0', '3.0']]
+
+
+def test_query_failures(db, capsys):
+    query_failures(db, args())
+    rows = table(capsys)
+    assert [row[:4] for row in rows[1:]] == [['a.py', 'dev1', 'ADB_DROPPED', '1'],
+                                             ['b.py', 'dev2', 'ADB_DROPPED', '1']]
+
+
+def test_query_compare(db, capsys):
+    with pytest.raises(SystemExit):
+        query_compare(db, args())
+    query_compare(db, args(split='2000-01-01', script='a.py'))
+    rows = table(capsys)
+    assert rows[0][-1] == '2000-01-01:'
+    # every battle is after the date, and the empty cells are not in the split line
+    assert rows[2][:4] == ['a.py', 'dev1', '0', '2']
+    assert float(rows[2][4]) == pytest.approx(360, rel=0.05)
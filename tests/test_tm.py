@@ -0,0 +1,187 @@
+import numpy as np
+import pytest
+
+from gamebots.buffers import BufferPool
+from gamebots.tm import (TM, best_match, dirty_blocks, fft_score_map, match_all, prepare, score_map,
+                         screen_spectra, template_spectra)
+
+
+def pattern(rng, h, w):
+    return rng.randint(0, 256, (h, w, 3)).astype(np.uint8)
+
+
+@pytest.fixture
+def tm():
+    tm = TM(feed=None)
+    tm.images = {}
+    tm.manifest = {}
+    return tm
+
+
+def test_find_rows_manifest_threshold(tm):
+    rng = np.random.RandomState(0)
+    a, b = pattern(rng, 20, 30), pattern(rng, 20, 30)
+    screen = np.zeros((300, 200, 3), dtype=np.uint8)
+    screen[10:30, 20:50] = a
+    # a weak match of b: half of it is covered
+    screen[110:130, 60:90] = b
+    screen[110:130, 60:75] = 0
+    tm.images = {'a': a, 'b': b}
+    tm.set_screen(screen)
+
+    rows = tm.find_rows(['a', 'b'], (0, 0, 200, 300), 100)
+    assert rows == [('a', (20, 10)), ('', (-1, -1)), ('', (-1, -1))]
+
+    tm.manifest = {'b': {'threshold': 0.3}}
+    rows = tm.find_rows(['a', 'b'], (0, 0, 200, 300), 100)
+    assert rows[:2] == [('a', (20, 10)), ('b', (60, 110))]
+
+    # the threshold given takes precedence
+    rows = tm.find_rows(['a', 'b'], (0, 0, 200, 300), 100, threshold=0.99)
+    assert rows[1] == ('', (-1, -1))
+
+
+def test_match_all_suppresses_overlaps():
+    rng = np.random.RandomState(1)
+    # a periodic template also matches, less well, at every shift of its period
+    t = np.tile(pattern(rng, 4, 4), (4, 4, 1))
+    image = pattern(rng, 100, 200)
+    spots = [(10, 20), (100, 30), (150, 70)]
+    for x, y in spots:
+        image[y:y + 16, x:x + 16] = t
+
+    assert len(match_all(image, t, 0.6, overlap=1.0)) > len(spots)
+    locs = match_all(image, t, 0.6)
+    assert sorted(locs) == spots
+    assert match_all(image, t, 0.6, result=np.empty((85, 185), np.float32)) == locs
+    assert match_all(np.zeros((100, 200, 3), dtype=np.uint8), t, 0.9) == []
+
+
+def test_find_all_in_region(tm):
+    rng = np.random.RandomState(2)
+    t = pattern(rng, 16, 16)
+    screen = np.zeros((100, 200, 3), dtype=np.uint8)
+    for x, y in [(10, 20), (100, 30), (150, 70)]:
+        screen[y:y + 16, x:x + 16] = t
+    tm.images = {'t': t}
+    tm.set_screen(screen)
+
+    assert sorted(tm.find_all('t', 0.9)) == [(10, 20), (100, 30), (150, 70)]
+    # the coords are in screen coords
+    assert sorted(tm.find_all('t', 0.9, roi=(90, 0, 110, 100))) == [(100, 30), (150, 70)]
+    assert tm.find_all('missing') == []
+
+
+def test_manifest_thresholds():
+    tm = TM(feed=None, threshold=0.97)
+    # only the thresholds the bots hard-coded are in the manifest, the others follow the default of the bot
+    assert tm.get_threshold('menu') == 0.97
+    assert tm.get_threshold('reset') == 0.9
+    assert tm.get_threshold('reset', 0.8) == 0.8
+    assert TM(feed=None, threshold=0.85).get_threshold('attack') == 0.85
+    # an explicit 0 is a threshold too
+    assert tm.get_threshold('reset', 0.0) == 0.0
+    assert tm.get_threshold('menu', None, 0) == 0
+    tm.manifest['menu']['threshold'] = 0.0
+    assert tm.get_threshold('menu', None, 0.8) == 0.0
+
+
+@pytest.mark.parametrize('gray', [False, True])
+def test_fft_score_map(gray):
+    rng = np.random.RandomState(3)
+    screen = prepare(pattern(rng, 90, 160), gray)
+    template = prepare(pattern(rng, 20, 30), gray)
+    spectra = screen_spectra(screen)
+    pool = BufferPool()
+    expected = score_map(screen, template)
+    for _ in range(2):
+        res = fft_score_map(spectra, template_spectra(template, spectra.size), pool)
+        assert res.shape == expected.shape
+        assert np.allclose(res, expected, atol=1e-3)
+
+    plain = np.full_like(template, 7)
+    assert not fft_score_map(spectra, template_spectra(plain, spectra.size)).any()
+
+
+def test_fft_match(tm):
+    rng = np.random.RandomState(4)
+    t = pattern(rng, 24, 32)
+    screen = pattern(rng, 180, 320) // 2
+    screen[50:74, 100:132] = t
+    tm.images = {'t': t}
+    # match it in the frequency domain, whatever its size
+    tm.fft_min_area = 1
+    tm.set_screen(screen)
+    fft = tm.probability('t'), tm.find('t')
+
+    spatial = TM(feed=None, fft_min_area=0)
+    spatial.images, spatial.manifest = tm.images, tm.manifest
+    spatial.set_screen(screen)
+    assert fft[1] == spatial.find('t') == (100, 50)
+    assert fft[0] == pytest.approx(spatial.probability('t'), abs=1e-4)
+
+
+def test_dirty_blocks():
+    rng = np.random.RandomState(6)
+    a = pattern(rng, 70, 100)
+    noise = rng.randint(-8, 9, a.shape)
+    b = np.clip(a.astype(int) + noise, 0, 255).astype(np.uint8)
+    # the capture noise is ignored
+    dirty = dirty_blocks(a, b, block=32, tolerance=16)
+    assert dirty.shape == (3, 4) and not dirty.any()
+
+    # but not a single pixel changed
+    b[65, 99, 1] ^= 0xff
+    dirty = dirty_blocks(a, b, block=32, tolerance=16, pool=BufferPool())
+    assert np.argwhere(dirty).tolist() == [[2, 3]]
+    assert dirty_blocks(a[..., 1], b[..., 1], block=32, tolerance=16).sum() == 1
+
+
+def test_results_kept_while_unchanged(tm, monkeypatch):
+    calls = []
+
+    def counting(*args, **kwargs):
+        calls.append(args[1].shape)
+        return best_match(*args, **kwargs)
+
+    monkeypatch.setattr('gamebots.tm.best_match', counting)
+    rng = np.random.RandomState(7)
+    t = pattern(rng, 16, 16)
+    screen = pattern(rng, 128, 256)
+    screen[8:24, 8:24] = t
+    screen[40:50, 40:50] = 100
+    tm.images = {'t': t}
+    tm.fft_min_area = 0
+    roi = (0, 0, 64, 64)
+
+    def match(screen):
+        tm.set_screen(screen.copy())
+        return tm.probability('t', roi)
+
+    assert match(screen) > 0.99 and len(calls) == 1
+    # a change outside the region
+    screen[100:110, 200:210] = 0
+    assert match(screen) > 0.99 and len(calls) == 1
+    # another region is another result
+    tm.probability('t', (0, 0, 32, 32))
+    assert len(calls) == 2
+
+    # a slow fade is caught once it adds up
+    screen[40:50, 40:50] += 10
+    match(screen)
+    assert len(calls) == 2
+    screen[40:50, 40:50] += 10
+    match(screen)
+    assert len(calls) == 3
+
+    # the whole screen depends on every block
+    tm.probability('t')
+    screen[100:110, 200:210] = 255
+    tm.set_screen(screen.copy())
+    tm.probability('t')
+    assert len(calls) == 5
+
+    tm.dirty_block = 0
+    match(screen)
+    match(screen)
+    assert len(calls) == 7